@@ -3,18 +3,42 @@ import io
 sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
 sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
 
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session
-from flask_socketio import SocketIO
+from flask import Flask, Response, render_template, request, jsonify, redirect, url_for, session, stream_with_context
+from flask_socketio import SocketIO, join_room
 import requests
 import re
 import os
+import json
+import time
 import subprocess
+import select
 import socket as _socket
 import threading as _threading
+from concurrent.futures import ThreadPoolExecutor, wait as _wait_futures, FIRST_COMPLETED
 from datetime import datetime, timedelta
 from pathlib import Path
 from gmail_service import GmailService
-from models import db, User, Session, GmailAccount, EmailMessage
+from gmail_registry import create_registry
+from mail_outbox import MailOutbox
+from mail_read_state import ReadStateQueue
+from session_cache import SessionCache
+from gemini_keys import GeminiKeyPool, RATE_LIMIT_STATUSES, DEFAULT_RPM, DEFAULT_TPM
+from response_cache import ResponseCache, DatabaseCacheStore
+from prompt_builder import PromptBuilder, format_report
+from context_gather import ContextGatherer
+from conversation import Summarizer, format_transcript
+from conversation_store import ConversationStore
+from hedging import HedgePolicy, LatencyTracker
+import singleflight
+from singleflight import single_flight
+from models import (db, enable_sqlite_tuning, User, Session, GmailAccount, EmailMessage, CachedResponse,
+                    ConversationTurn, ConversationState)
+import email_search
+import migrations
+from email_index import EmailVectorIndex, HashingEmbedder, wants_mail
+from email_text import html_to_text
+from mail_sync import (MailSyncManager, decode_pubsub_push, email_to_dict,
+                       has_changes, inbox_page)
 
 
 def _load_env():
@@ -35,7 +59,19 @@ _load_env()
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode="threading")
+# "threading" (Werkzeug dev server) or "gevent" (see run_server.py --async):
+# in gevent mode every request and socket is a greenlet, so slow Gemini/Gmail
+# calls wait cooperatively instead of pinning an OS thread each.
+ASYNC_MODE = os.environ.get("ARIA_ASYNC_MODE", "threading")
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=ASYNC_MODE)
+
+
+def _run_blocking(fn, *args):
+    """Run CPU-bound work off the event loop in gevent mode, inline otherwise."""
+    if ASYNC_MODE == "gevent":
+        from gevent import get_hub
+        return get_hub().threadpool.apply(fn, args)
+    return fn(*args)
 
 # Database configuration
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///aria_email.db'
@@ -46,11 +82,88 @@ app.config['SESSION_COOKIE_SECURE'] = False  # localhost не используе
 app.config['SESSION_COOKIE_HTTPONLY'] = True  # Защита от XSS
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'  # Для OAuth redirect
 
-# Initialize database
+# Initialize database. WAL and the other pragmas are set on every new
+# connection so the sync threads, inbox reads and session lookups do not
+# serialize on the database file
+enable_sqlite_tuning(
+    cache_mb=int(os.environ.get("SQLITE_CACHE_MB", "64")),
+    mmap_mb=int(os.environ.get("SQLITE_MMAP_MB", "256")),
+)
 db.init_app(app)
 
-# Initialize Gmail service
-gmail_service = GmailService()
+# Initialize Gmail service (OAuth flow; the single-account token.json)
+gmail_service = GmailService(batch_size=int(os.environ.get("GMAIL_BATCH_SIZE", "50")))
+# One Gmail client per connected account, tokens stored on GmailAccount.
+# GMAIL_FETCH_WORKERS bounds how many accounts sync at the same time
+gmail_registry = create_registry(app, gmail_service)
+
+
+def _session_gmail():
+    """The session's GmailAccount and its Gmail client (None when not connected)."""
+    gmail_email = session.get('gmail_email')
+    account = GmailAccount.query.filter_by(email=gmail_email).first() if gmail_email else None
+    return account, (gmail_registry.get(account.id) if account else None)
+
+
+# Embeddings of cached emails, for choosing the ones a chat question is about
+email_index = EmailVectorIndex(
+    os.path.join(app.instance_path, 'email_vectors'),
+    HashingEmbedder(dim=int(os.environ.get("EMAIL_EMBED_DIM", "512"))),
+)
+# Emails a chat prompt may carry, and how close to the question they must be
+EMAIL_CONTEXT_MAX = int(os.environ.get("EMAIL_CONTEXT_MAX", "3"))
+EMAIL_CONTEXT_MIN_SCORE = float(os.environ.get("EMAIL_CONTEXT_MIN_SCORE", "0.2"))
+# Newest emails used when the question is about the inbox but matches none
+EMAIL_CONTEXT_RECENT = int(os.environ.get("EMAIL_CONTEXT_RECENT", "5"))
+
+
+def _publish_inbox_delta(account, delta):
+    # Replies that quoted the old inbox are stale now
+    response_cache.invalidate("emails")
+    # Runs on the sync thread: new emails are embedded here, not at chat time
+    email_index.discard(account.id, delta.get("deleted", []))
+    email_index.refresh()
+    socketio.emit("inbox_delta", delta, namespace="/mail", to=f"account:{account.id}")
+
+
+# One background sync per Gmail account, shared by every open tab. With
+# GMAIL_PUSH_TOPIC set (projects/<project>/topics/<topic>) Gmail pushes
+# changes through Pub/Sub to /api/gmail/push and the timer is a fallback.
+mail_sync = MailSyncManager(
+    app, gmail_registry, _publish_inbox_delta,
+    min_interval=float(os.environ.get("MAIL_SYNC_MIN_INTERVAL", "30")),
+    max_interval=float(os.environ.get("MAIL_SYNC_MAX_INTERVAL", "300")),
+    push_topic=os.environ.get("GMAIL_PUSH_TOPIC") or None,
+)
+# Shared secret of the push endpoint; without it pushes are refused
+GMAIL_PUSH_TOKEN = os.environ.get("GMAIL_PUSH_TOKEN", "")
+if mail_sync.push_topic and not GMAIL_PUSH_TOKEN:
+    print("[SYNC] GMAIL_PUSH_TOPIC is set but GMAIL_PUSH_TOKEN is not: push notifications "
+          "will be refused, accounts sync on the timer only", flush=True)
+
+
+def _publish_outbox_status(account_id, job):
+    socketio.emit("outbox_status", job, namespace="/mail", to=f"account:{account_id}")
+
+
+# Outgoing mail is queued in the database and sent in the background
+mail_outbox = MailOutbox(
+    app, gmail_registry, _publish_outbox_status,
+    max_concurrent=int(os.environ.get("MAIL_SEND_WORKERS", "4")),
+    max_attempts=int(os.environ.get("MAIL_SEND_MAX_ATTEMPTS", "6")),
+)
+# Read/unread clicks update the cache at once and reach Gmail in batches
+read_state = ReadStateQueue(
+    app, gmail_registry,
+    flush_delay=float(os.environ.get("READ_STATE_FLUSH_DELAY", "2")),
+)
+# Session tokens are checked from memory; expired sessions are swept hourly
+session_cache = SessionCache(
+    app,
+    ttl=float(os.environ.get("SESSION_CACHE_TTL", "300")),
+    max_entries=int(os.environ.get("SESSION_CACHE_SIZE", "10000")),
+    sweep_interval=float(os.environ.get("SESSION_SWEEP_INTERVAL", "3600")),
+)
 
 # ⚠️ ВАЖНО: Редирект 127.0.0.1 → localhost (для OAuth) 
 @app.before_request
@@ -68,6 +181,16 @@ def redirect_127_to_localhost():
 # Create database tables
 with app.app_context():
     db.create_all()
+    migrations.migrate()
+    email_search.ensure_index()
+    os.makedirs(app.instance_path, exist_ok=True)
+    email_index.load()
+    embedded = email_index.refresh()
+    if embedded:
+        print(f"[INDEX] Embedded {embedded} cached emails", flush=True)
+mail_outbox.start()
+read_state.start()
+session_cache.start()
 
 context_memory = []
 settings = {
@@ -75,13 +198,78 @@ settings = {
     "language": "EN",
     "personality": "default",
 }
-chat_history = []
 
 GEMINI_API_KEYS = [
     k.strip() for k in os.environ.get("GEMINI_API_KEYS", "").split(",") if k.strip()
 ]
 GEMINI_BASE = "https://generativelanguage.googleapis.com/v1beta"
-_gemini_key_index = 0
+# Per-key budgets (free tier defaults); 0 disables a budget
+GEMINI_KEY_RPM = int(os.environ.get("GEMINI_KEY_RPM", DEFAULT_RPM))
+GEMINI_KEY_TPM = int(os.environ.get("GEMINI_KEY_TPM", DEFAULT_TPM))
+# How long a call may wait for a key to come back within its budget
+GEMINI_KEY_WAIT = float(os.environ.get("GEMINI_KEY_WAIT", "5"))
+key_pool = GeminiKeyPool(GEMINI_API_KEYS, rpm=GEMINI_KEY_RPM, tpm=GEMINI_KEY_TPM)
+# Hedging: when a call is slower than usual, race a duplicate on another key.
+# The robot hedges early and often (someone is waiting for the voice), the
+# dashboard chat only in clear outliers.
+GEMINI_HEDGE = os.environ.get("GEMINI_HEDGE", "1") == "1"
+gemini_latency = LatencyTracker()
+HEDGE_POLICIES = {
+    "chat": HedgePolicy(
+        "chat", percentile=0.95, min_delay=3.0,
+        budget_pct=float(os.environ.get("HEDGE_CHAT_BUDGET_PCT", "5")),
+    ),
+    "robot": HedgePolicy(
+        "robot", percentile=0.75, min_delay=0.8,
+        budget_pct=float(os.environ.get("HEDGE_ROBOT_BUDGET_PCT", "25")),
+    ),
+}
+# Every Gemini attempt (chat, stream open, robot, hedges) runs on this pool,
+# so its size caps concurrent Gemini calls server-wide
+GEMINI_WORKERS = int(os.environ.get("GEMINI_WORKERS", "32"))
+_gemini_executor = ThreadPoolExecutor(max_workers=GEMINI_WORKERS, thread_name_prefix="gemini")
+# How often a waiting handler checks whether its client is still connected
+CLIENT_POLL_INTERVAL = float(os.environ.get("CLIENT_POLL_INTERVAL", "0.5"))
+CLIENT_GONE = "Client disconnected"
+
+LLM_CACHE_SIZE = int(os.environ.get("LLM_CACHE_SIZE", "256"))
+LLM_CACHE_TTL = float(os.environ.get("LLM_CACHE_TTL", "3600"))
+# Answers built on live data (weather, inbox) go stale much sooner
+LLM_CACHE_LIVE_TTL = float(os.environ.get("LLM_CACHE_LIVE_TTL", "600"))
+LLM_CACHE_PERSIST = os.environ.get("LLM_CACHE_PERSIST", "0") == "1"
+# Input-token budgets for assembled prompts (system prompt + history)
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "8000"))
+ROBOT_PROMPT_TOKEN_BUDGET = int(os.environ.get("ROBOT_PROMPT_TOKEN_BUDGET", "3000"))
+# Upper bound of history turns handed to the prompt builder before trimming
+PROMPT_MAX_TURNS = int(os.environ.get("PROMPT_MAX_TURNS", "40"))
+# Past this many turns the older ones are folded into a summary in the background
+CHAT_SUMMARIZE_AFTER = int(os.environ.get("CHAT_SUMMARIZE_AFTER", "30"))
+CHAT_KEEP_TURNS = int(os.environ.get("CHAT_KEEP_TURNS", "12"))
+# Recent turns kept in memory per conversation, and how many conversations
+CONVERSATION_RING_SIZE = int(os.environ.get("CONVERSATION_RING_SIZE", "60"))
+CONVERSATION_MAX_LOADED = int(os.environ.get("CONVERSATION_MAX_LOADED", "256"))
+CONVERSATION_IDLE_SECONDS = float(os.environ.get("CONVERSATION_IDLE_SECONDS", "1800"))
+ROBOT_CONVERSATION_ID = "robot"
+
+# Per-source deadlines (seconds) for the chat context-gathering stage
+CONTEXT_DEADLINE_EMAILS = float(os.environ.get("CONTEXT_DEADLINE_EMAILS", "1.0"))
+CONTEXT_DEADLINE_WEATHER = float(os.environ.get("CONTEXT_DEADLINE_WEATHER", "2.5"))
+# Calls of one source that may run at once (timed-out ones included)
+CONTEXT_WORKERS_PER_SOURCE = int(os.environ.get("CONTEXT_WORKERS_PER_SOURCE", "4"))
+
+
+def _with_app_context(fn):
+    with app.app_context():
+        return fn()
+
+
+context_gatherer = ContextGatherer(max_workers_per_source=CONTEXT_WORKERS_PER_SOURCE, wrap=_with_app_context)
+
+response_cache = ResponseCache(
+    max_entries=LLM_CACHE_SIZE,
+    ttl=LLM_CACHE_TTL,
+    store=DatabaseCacheStore(app, db, CachedResponse) if LLM_CACHE_PERSIST else None,
+)
 
 PERSONALITY_PROMPTS = {
     "default": (
@@ -179,6 +367,11 @@ def _epoch_to_localtime(epoch, tz_offset):
     return dt.strftime("%Y-%m-%d %H:%M")
 
 
+def _city_key(city):
+    return city.strip().lower()
+
+
+@single_flight("fetch_weather", key=_city_key)
 def fetch_weather(city):
     try:
         resp = requests.get(
@@ -221,6 +414,7 @@ def fetch_weather(city):
         return None
 
 
+@single_flight("fetch_forecast", key=_city_key)
 def fetch_forecast(city):
     try:
         resp = requests.get(
@@ -288,73 +482,568 @@ def index():
     return render_template("index.html")
 
 
-def _gemini_call(model, system_text, contents):
-    global _gemini_key_index
+def _gemini_payload(system_text, contents):
+    return {
+        "contents": contents,
+        "systemInstruction": {"parts": [{"text": system_text}]},
+        "generationConfig": {
+            "temperature": 0.7,
+            "maxOutputTokens": 2048,
+        },
+    }
+
+
+def _gemini_text(resp_data):
+    """Join the visible (non-thought) text parts of a Gemini response chunk."""
+    candidates = resp_data.get("candidates") or []
+    if not candidates:
+        return ""
+    parts = candidates[0].get("content", {}).get("parts", [])
+    return "".join(p["text"] for p in parts if "text" in p and "thought" not in p)
+
+
+def _estimate_tokens(payload):
+    # ~4 characters per token is close enough for budgeting
+    return len(json.dumps(payload, ensure_ascii=False)) // 4
+
+
+def _gemini_error(resp_status, resp_data):
+    """Return (message, error_object, is_rate_limit) for a failed response."""
+    error = resp_data.get("error", {}) if isinstance(resp_data, dict) else {}
+    msg = error.get("message", str(resp_data))
+    rate_limited = error.get("status", "") in RATE_LIMIT_STATUSES or resp_status == 429
+    return msg, error, rate_limited
+
+
+def _timed_attempt(attempt, started, *args):
+    # Latency and the hedge delay count from here, not from the time of submit
+    started[0] = time.time()
+    return attempt(*args)
+
+
+def _request_socket():
+    """The client socket of the current request, or None if not exposed."""
+    sock = request.environ.get("werkzeug.socket")
+    if sock is None:
+        # gevent.pywsgi: wsgi.input reads from a makefile() of the socket
+        rfile = getattr(request.environ.get("wsgi.input"), "rfile", None)
+        sock = getattr(getattr(rfile, "raw", None), "_sock", None)
+    return sock
+
+
+def _client_gone():
+    """True once the client has closed the connection of the current request.
+
+    The request body is already read, so a readable socket with nothing to
+    peek at means EOF. Always False when the server does not expose the socket.
+    """
+    sock = _request_socket()
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        return bool(readable) and sock.recv(1, _socket.MSG_PEEK) == b""
+    except (OSError, ValueError):
+        return True
+
+
+def _gemini_race(latency_key, est_tokens, attempt, hedge=None, discard=None, gone=None):
+    """Run ``attempt(index, key, cancel)`` on pool keys until one settles.
+
+    An attempt returns ``("ok", value)``, ``("retry", error)`` for errors that
+    should move on to another key (rate limits, transport errors) or
+    ``("error", message)`` for final ones, and reports the key outcome to
+    key_pool itself. With a ``hedge`` policy name, a duplicate attempt is
+    started on a different key once the first one runs longer than the
+    policy's delay; the first ``ok`` wins, ``cancel`` is set for the rest and
+    ``discard`` is called with every result that arrives after that.
+    Every attempt's run time goes into gemini_latency, losers and failures
+    included; a winning hedge counts from the start of the attempt it raced.
+    ``gone`` is polled while waiting; once it returns True no further key or
+    hedge is tried and the race settles as "Client disconnected".
+    Returns ``(value, None)`` or ``(None, error_message)``.
+    """
+    policy = HEDGE_POLICIES.get(hedge) if GEMINI_HEDGE and len(key_pool) > 1 else None
+    if policy is not None:
+        policy.note_request()
+    cancel = _threading.Event()
+    tried = set()
+    running = {}  # future -> [time it started running, None while queued]
+    hedge_future = None
+    hedged_from = None
     last_error = ""
-    for _attempt in range(len(GEMINI_API_KEYS)):
-        key = GEMINI_API_KEYS[_gemini_key_index]
-        url = f"{GEMINI_BASE}/models/{model}:generateContent?key={key}"
-        payload = {
-            "contents": contents,
-            "systemInstruction": {"parts": [{"text": system_text}]},
-            "generationConfig": {
-                "temperature": 0.7,
-                "maxOutputTokens": 2048,
-            },
-        }
-        try:
-            resp = requests.post(url, json=payload, timeout=60)
-            resp_data = resp.json()
-            if resp.status_code == 200 and "candidates" in resp_data:
-                parts = resp_data["candidates"][0]["content"]["parts"]
-                text_parts = [p["text"] for p in parts if "text" in p and "thought" not in p]
-                return "".join(text_parts), None
-            error = resp_data.get("error", {})
-            status = error.get("status", "")
-            msg = error.get("message", str(resp_data))
-            if status in ("RESOURCE_EXHAUSTED", "RATE_LIMIT_EXCEEDED") or resp.status_code == 429:
-                last_error = msg
-                _gemini_key_index = (_gemini_key_index + 1) % len(GEMINI_API_KEYS)
+
+    def submit(lease):
+        started = [None]
+        fut = _gemini_executor.submit(_timed_attempt, attempt, started, *lease, cancel)
+        running[fut] = started
+        return fut
+
+    def finish_loser(fut, started):
+        if started[0] is not None:
+            gemini_latency.observe(latency_key, time.time() - started[0])
+        if discard is not None:
+            discard(*fut.result())
+
+    def settle():
+        cancel.set()
+        for fut, started in running.items():
+            fut.add_done_callback(lambda f, s=started: finish_loser(f, s))
+
+    while True:
+        if not running:
+            if len(tried) >= len(key_pool):
+                break
+            lease = key_pool.acquire(tokens=est_tokens, exclude=tried, wait=GEMINI_KEY_WAIT)
+            if lease is None:
+                break
+            tried.add(lease[0])
+            submit(lease)
+
+        hedge_in = None
+        first_started = None
+        if policy is not None and hedge_future is None and len(running) == 1:
+            first_started = next(iter(running.values()))[0]
+            # Still queued for a worker: the hedge delay has not started yet
+            hedge_in = max(0.0, (first_started or time.time()) + policy.delay(gemini_latency, latency_key)
+                           - time.time())
+        timeout = hedge_in
+        if gone is not None:
+            timeout = CLIENT_POLL_INTERVAL if timeout is None else min(timeout, CLIENT_POLL_INTERVAL)
+        done, _pending = _wait_futures(list(running), timeout=timeout, return_when=FIRST_COMPLETED)
+
+        if not done:
+            if gone is not None and gone():
+                settle()
+                return None, CLIENT_GONE
+            if first_started is None or hedge_in > timeout:
                 continue
-            return None, f"API error ({resp.status_code}): {msg}"
-        except Exception as e:
-            last_error = str(e)
-            _gemini_key_index = (_gemini_key_index + 1) % len(GEMINI_API_KEYS)
+            lease = None
+            if policy.try_spend():
+                lease = key_pool.acquire(tokens=est_tokens, exclude=tried, wait=0)
+                if lease is None:
+                    policy.refund()
+            if lease is None:
+                # No budget or no spare key: just keep waiting for the first attempt
+                hedge_future = False
+                continue
+            tried.add(lease[0])
+            hedge_future = submit(lease)
+            hedged_from = first_started
+            print(f"[HEDGE] {hedge}: {latency_key} slower than {hedge_in:.1f}s, racing key #{lease[0]}", flush=True)
+            continue
+
+        for fut in done:
+            started = running.pop(fut)[0]
+            kind, value = fut.result()
+            if fut is hedge_future and kind == "ok":
+                started = hedged_from
+            gemini_latency.observe(latency_key, time.time() - started)
+            if kind == "ok":
+                if fut is hedge_future:
+                    policy.note_win()
+                settle()
+                return value, None
+            if kind == "error":
+                settle()
+                return None, value
+            last_error = value
+    return None, _keys_exhausted_message(last_error, est_tokens)
+
+
+def _gemini_attempt(model, payload, est_tokens, index, key, cancel):
+    url = f"{GEMINI_BASE}/models/{model}:generateContent?key={key}"
+    t0 = time.time()
+    try:
+        resp = requests.post(url, json=payload, timeout=60)
+        resp_data = resp.json()
+    except Exception as e:
+        key_pool.record_failure(index, e)
+        return "retry", str(e)
+    if resp.status_code == 200 and "candidates" in resp_data:
+        usage = resp_data.get("usageMetadata", {}).get("totalTokenCount")
+        key_pool.record_success(index, time.time() - t0, tokens=usage, reserved=est_tokens)
+        return "ok", _gemini_text(resp_data)
+    msg, error, rate_limited = _gemini_error(resp.status_code, resp_data)
+    if rate_limited:
+        key_pool.record_rate_limit(index, error)
+        return "retry", msg
+    key_pool.release(index)
+    return "error", f"API error ({resp.status_code}): {msg}"
+
+
+def _gemini_call(model, system_text, contents, hedge=None, gone=None):
+    """Return ``(text, error)``; ``hedge`` names a HEDGE_POLICIES entry."""
+    payload = _gemini_payload(system_text, contents)
+    est_tokens = _estimate_tokens(payload)
+
+    def attempt(index, key, cancel):
+        return _gemini_attempt(model, payload, est_tokens, index, key, cancel)
+
+    # A losing duplicate cannot be aborted mid-request; its reply is dropped
+    return _gemini_race(f"{model}:call", est_tokens, attempt, hedge=hedge, gone=gone)
+
+
+def _keys_exhausted_message(last_error, est_tokens):
+    wait = key_pool.next_available_in(est_tokens)
+    if wait:
+        return f"All API keys exhausted (next key free in {wait:.0f}s). Last error: {last_error}"
+    return f"All API keys exhausted. Last error: {last_error}"
+
+
+def _cached_gemini_call(model, system_text, contents, tags=(), hedge=None, gone=None):
+    """_gemini_call behind response_cache; only successful replies are stored.
+
+    ``tags`` name the live data the prompt was built from (e.g. "emails") so
+    the entry can be invalidated when that data changes.
+    """
+    cached = response_cache.get(model, system_text, contents)
+    if cached is not None:
+        return cached, None
+    t0 = time.time()
+    ai_text, err = _gemini_call(model, system_text, contents, hedge=hedge, gone=gone)
+    if not err and ai_text:
+        response_cache.put(
+            model, system_text, contents, ai_text, tags=tags,
+            ttl=LLM_CACHE_LIVE_TTL if tags else None, latency=time.time() - t0,
+        )
+    return ai_text, err
+
+
+class GeminiStreamError(Exception):
+    """Raised by _gemini_stream when no key could produce a reply."""
+
+
+def _sse_chunks(resp):
+    """Yield ``(text, total_tokens)`` for every SSE chunk of a Gemini stream."""
+    for line in resp.iter_lines(decode_unicode=True):
+        if not line or not line.startswith("data:"):
             continue
-    return None, f"All API keys exhausted. Last error: {last_error}"
+        try:
+            chunk = json.loads(line[5:].strip())
+        except ValueError:
+            continue
+        if "error" in chunk:
+            raise GeminiStreamError(chunk["error"].get("message", "stream error"))
+        yield _gemini_text(chunk), chunk.get("usageMetadata", {}).get("totalTokenCount")
+
+
+class _OpenStream:
+    """A Gemini stream that has produced its first piece of text."""
 
+    def __init__(self, index, resp, chunks, first, usage, t0):
+        self.index = index
+        self.resp = resp
+        self.chunks = chunks
+        self.first = first
+        self.usage = usage
+        self.t0 = t0
 
-def get_recent_emails(limit=5):
-    """Fetch recent emails from the database for context."""
+    def discard(self):
+        self.resp.close()
+        key_pool.release(self.index)
+
+
+def _gemini_stream_open(model, payload, index, key, cancel):
+    """Open a stream and read up to its first text; an attempt for _gemini_race."""
+    url = f"{GEMINI_BASE}/models/{model}:streamGenerateContent?alt=sse&key={key}"
+    t0 = time.time()
     try:
-        from models import EmailMessage, GmailAccount
-        
-        # Get recent emails ordered by received_at
-        emails = EmailMessage.query.order_by(
-            EmailMessage.received_at.desc()
-        ).limit(limit).all()
-        
-        if not emails:
-            return None
-        
-        email_context = "\n\n[RECENT EMAILS FROM YOUR INBOX]\n"
-        for i, email in enumerate(emails, 1):
-            email_context += f"\n--- Email {i} ---\n"
-            email_context += f"Subject: {email.subject}\n"
-            email_context += f"From: {email.sender}\n"
-            email_context += f"Date: {email.received_at.strftime('%Y-%m-%d %H:%M:%S')}\n"
-            if email.body:
-                # Limit body to 500 chars per email to avoid token overflow
-                body_preview = email.body[:500]
-                if len(email.body) > 500:
-                    body_preview += "...[truncated]"
-                email_context += f"Content: {body_preview}\n"
-        
-        email_context += "\n\nYou can help the user with any questions about these emails."
-        return email_context
+        resp = requests.post(url, json=payload, timeout=60, stream=True)
+    except Exception as e:
+        key_pool.record_failure(index, e)
+        return "retry", str(e)
+
+    if resp.status_code != 200:
+        with resp:
+            try:
+                resp_data = resp.json()
+            except ValueError:
+                resp_data = {"error": {"message": resp.text[:200]}}
+        msg, error, rate_limited = _gemini_error(resp.status_code, resp_data)
+        if rate_limited:
+            key_pool.record_rate_limit(index, error)
+            return "retry", msg
+        key_pool.release(index)
+        return "error", f"API error ({resp.status_code}): {msg}"
+
+    chunks = _sse_chunks(resp)
+    first, usage = "", None
+    try:
+        for text, tokens in chunks:
+            usage = tokens or usage
+            if cancel.is_set():
+                break
+            if text:
+                first = text
+                break
+    except GeminiStreamError as e:
+        resp.close()
+        key_pool.release(index)
+        return "error", str(e)
+    except Exception as e:
+        resp.close()
+        key_pool.record_failure(index, e)
+        return "retry", str(e)
+    if cancel.is_set():
+        # Another key won the race
+        resp.close()
+        key_pool.release(index)
+        return "cancelled", None
+    return "ok", _OpenStream(index, resp, chunks, first, usage, t0)
+
+
+def _discard_stream(kind, value):
+    if kind == "ok":
+        value.discard()
+
+
+def _gemini_stream(model, system_text, contents, hedge=None):
+    """Yield reply text pieces from streamGenerateContent (SSE) as they arrive.
+
+    Keys are picked from key_pool the same way as in _gemini_call, but only
+    until the first piece of text arrived; after that a failure is final.
+    With ``hedge`` the race is on time to first text and the losing stream is
+    closed. Closing the generator closes the upstream HTTP response.
+    """
+    payload = _gemini_payload(system_text, contents)
+    est_tokens = _estimate_tokens(payload)
+
+    def attempt(index, key, cancel):
+        return _gemini_stream_open(model, payload, index, key, cancel)
+
+    stream, err = _gemini_race(
+        f"{model}:stream", est_tokens, attempt, hedge=hedge, discard=_discard_stream,
+    )
+    if err:
+        raise GeminiStreamError(err)
+
+    usage = stream.usage
+    with stream.resp:
+        try:
+            if stream.first:
+                yield stream.first
+            for text, tokens in stream.chunks:
+                usage = tokens or usage
+                if text:
+                    yield text
+        except GeneratorExit:
+            # The consumer stopped early (e.g. the browser went away)
+            key_pool.release(stream.index)
+            raise
+        except Exception as e:
+            key_pool.record_failure(stream.index, e)
+            raise
+    key_pool.record_success(stream.index, time.time() - stream.t0, tokens=usage, reserved=est_tokens)
+
+
+def _summarize_history(previous, turns):
+    """Summarizer callback: fold ``turns`` into the running summary with Gemini."""
+    prompt = (
+        "Summarize this conversation between the user and ARIA in a few sentences. "
+        "Keep names, facts, preferences, decisions and unfinished requests.\n\n"
+    )
+    if previous:
+        prompt += f"Summary of the conversation before this part:\n{previous}\n\n"
+    prompt += format_transcript(turns)
+    model = settings.get("model", "gemini-2.0-flash")
+    text, err = _gemini_call(
+        model, "You write short, factual conversation summaries.",
+        [{"role": "user", "parts": [{"text": prompt}]}],
+    )
+    if err:
+        raise RuntimeError(err)
+    return text
+
+
+summarizer = Summarizer(_summarize_history, name="chat-summary")
+conversations = ConversationStore(
+    app, db, ConversationTurn, ConversationState, summarizer,
+    ring_size=CONVERSATION_RING_SIZE, summarize_after=CHAT_SUMMARIZE_AFTER,
+    keep_turns=CHAT_KEEP_TURNS, max_loaded=CONVERSATION_MAX_LOADED,
+    idle_seconds=CONVERSATION_IDLE_SECONDS,
+)
+
+
+def _conversation_id():
+    """Conversation of the current request: the logged-in user, else the browser session."""
+    token = request.headers.get('X-Session-Token')
+    if token:
+        user = verify_session_token(token)
+        if user:
+            return f"user:{user.id}"
+    if 'conversation_id' not in session:
+        session['conversation_id'] = secrets.token_urlsafe(16)
+    return f"session:{session['conversation_id']}"
+
+
+RECENT_EMAILS_HEADER = "\n\n[RECENT EMAILS FROM YOUR INBOX]\n"
+RELEVANT_EMAILS_HEADER = "\n\n[EMAILS FROM YOUR INBOX RELATED TO THE QUESTION]\n"
+RECENT_EMAILS_FOOTER = "\n\nYou can help the user with any questions about these emails."
+
+
+def _email_prompt_query():
+    # Only the start of the precomputed plain text is read, never the raw HTML
+    return db.session.query(
+        EmailMessage.id, EmailMessage.subject, EmailMessage.sender, EmailMessage.received_at,
+        db.func.substr(EmailMessage.body_text, 1, 501).label('text'),
+    )
+
+
+def get_recent_emails(account_id, limit=5):
+    """Fetch an account's recent emails from the database as prompt blocks, newest first."""
+    try:
+        emails = _email_prompt_query().filter(EmailMessage.account_id == account_id)\
+            .order_by(EmailMessage.received_at.desc()).limit(limit).all()
+        return _email_blocks(emails)
     except Exception as e:
         print(f"Error fetching emails from database: {e}")
-        return None
+        return []
+
+
+def get_relevant_emails(question, account_id):
+    """``(header, blocks)`` of the emails the question is about; no blocks if none.
+    
+    The closest emails of the account in the vector index that pass its
+    relevance gate; failing those, the newest few if the question is about
+    the inbox itself. Without an account there is no mail to show.
+    """
+    if account_id is None:
+        return None, []
+    try:
+        ids = email_index.select(question, account_id=account_id, k=EMAIL_CONTEXT_MAX,
+                                 min_score=EMAIL_CONTEXT_MIN_SCORE)
+        if ids:
+            rows = {row.id: row for row in _email_prompt_query().filter(EmailMessage.id.in_(ids))}
+            return RELEVANT_EMAILS_HEADER, _email_blocks([rows[i] for i in ids if i in rows])
+    except Exception as e:
+        print(f"[INDEX] Email search failed: {e}", flush=True)
+    if wants_mail(question):
+        return RECENT_EMAILS_HEADER, get_recent_emails(account_id, limit=EMAIL_CONTEXT_RECENT)
+    return None, []
+
+
+def _email_blocks(emails):
+    """Prompt blocks for rows of _email_prompt_query(), in the given order."""
+    blocks = []
+    for i, email in enumerate(emails, 1):
+        block = f"\n--- Email {i} ---\n"
+        block += f"Subject: {email.subject}\n"
+        block += f"From: {email.sender}\n"
+        block += f"Date: {email.received_at.strftime('%Y-%m-%d %H:%M:%S')}\n"
+        if email.text:
+            # Limit body to 500 chars per email to avoid token overflow
+            body_preview = email.text[:500]
+            if len(email.text) > 500:
+                body_preview += "...[truncated]"
+            block += f"Content: {body_preview}\n"
+        blocks.append(block)
+    return blocks
+
+
+def _history_contents(turns):
+    contents = []
+    for msg in turns:
+        role = "user" if msg["role"] == "user" else "model"
+        contents.append({"role": role, "parts": [{"text": msg["text"]}]})
+    return contents
+
+
+def _add_conversation(builder, conversation):
+    """Add the conversation summary and recent turns, read in one snapshot."""
+    summary, turns = conversation.snapshot(PROMPT_MAX_TURNS)
+    if summary:
+        builder.add("summary", f"\n\nSummary of the earlier conversation:\n{summary}",
+                    priority=45, min_tokens=150)
+    builder.set_history(_history_contents(turns))
+
+
+def _base_prompt(budget):
+    """PromptBuilder preloaded with the personality and the context memory."""
+    builder = PromptBuilder(budget)
+    personality = settings.get("personality", "default")
+    builder.add("personality", PERSONALITY_PROMPTS.get(personality, PERSONALITY_PROMPTS["default"]))
+    if context_memory:
+        memory_text = "\n".join(f"- {m['text']}" for m in context_memory)
+        builder.add("memory", f"\n\nContext memory:\n{memory_text}", priority=50, min_tokens=200)
+    return builder
+
+
+def _build_chat_prompt(conversation, user_message, email_data=None):
+    """Assemble (model, prompt, cache_tags) for a dashboard chat turn.
+
+    ``prompt`` is a BuiltPrompt fitted to PROMPT_TOKEN_BUDGET; lowest priority
+    first, the recent emails, old history, memory and the open email body are
+    trimmed. Expects the user's message to already be the last turn of
+    ``conversation`` (a ConversationBuffer).
+    """
+    model = settings.get("model", "gemini-2.0-flash")
+    cache_tags = []
+    builder = _base_prompt(PROMPT_TOKEN_BUDGET)
+
+    # Enrichment sources run concurrently; a slow one is skipped, not awaited
+    sources = {}
+    if not email_data:
+        # If no email is explicitly open, only the emails the question is about
+        gmail_email = session.get('gmail_email')
+        account = GmailAccount.query.filter_by(email=gmail_email).first() if gmail_email else None
+        account_id = account.id if account else None
+        sources["emails"] = (lambda: get_relevant_emails(user_message, account_id), CONTEXT_DEADLINE_EMAILS)
+    weather_city = detect_weather_query(user_message)
+    if weather_city:
+        sources["weather"] = (lambda: fetch_weather(weather_city), CONTEXT_DEADLINE_WEATHER)
+    context, timings = context_gatherer.gather(sources)
+
+    # Add email context if email is open
+    if email_data:
+        email_context = f"\n\n[CURRENT EMAIL CONTEXT]\n"
+        if email_data.get("subject"):
+            email_context += f"Subject: {email_data['subject']}\n"
+        if email_data.get("from"):
+            email_context += f"From: {email_data['from']}\n"
+        if email_data.get("to"):
+            email_context += f"To: {email_data['to']}\n"
+        if email_data.get("date"):
+            email_context += f"Date: {email_data['date']}\n"
+        if email_data.get("body"):
+            # The dashboard sends the body as shown, usually HTML
+            email_context += f"Content:\n{html_to_text(email_data['body'])}\n"
+        builder.add("open_email", email_context, priority=60, min_tokens=300)
+        builder.add("open_email_hint", "\nYou can help analyze, summarize, reply to, or perform actions related to this email.")
+    else:
+        header, email_blocks = context.get("emails") or (None, [])
+        if email_blocks:
+            builder.add("emails", items=email_blocks, priority=20,
+                        header=header, footer=RECENT_EMAILS_FOOTER)
+            cache_tags.append("emails")
+
+    w = context.get("weather")
+    if w:
+        cache_tags.append("weather")
+        builder.add("weather", (
+            f"\n\n[REAL-TIME WEATHER DATA for {w['city']}, {w['country']}]"
+            f"\nLocal time: {w.get('localtime', 'N/A')}"
+            f"\nTemperature: {w['temp']}°C (feels like {w['feels_like']}°C)"
+            f"\nDay high: {w['temp_max']}°C, Day low: {w['temp_min']}°C"
+            f"\nCondition: {w['description']}"
+            f"\nHumidity: {w['humidity']}%"
+            f"\nWind: {w['wind_kph']} km/h {w.get('wind_dir', '')}"
+            f"\nPressure: {w['pressure']} hPa"
+            f"\nCloudiness: {w['clouds']}%"
+            f"\nVisibility: {w['vis_km']} km"
+            f"\nSunrise: {w.get('sunrise', 'N/A')}, Sunset: {w.get('sunset', 'N/A')}"
+            f"\n\nUse this real data to answer the user's weather question accurately. "
+            f"Stay in your personality while presenting the data."
+        ), priority=70)
+
+    _add_conversation(builder, conversation)
+    prompt = builder.build()
+    prompt.report["context"] = timings
+    print(f"[PROMPT] chat: {format_report(prompt.report)}", flush=True)
+    if timings:
+        print("[PROMPT] context: " + ", ".join(
+            f"{name}={t['status']}/{t['ms']}ms" for name, t in timings.items()), flush=True)
+    return model, prompt, cache_tags
 
 
 @app.route("/api/chat", methods=["POST"])
@@ -366,71 +1055,99 @@ def chat():
     if not user_message:
         return jsonify({"error": "Empty message"}), 400
 
-    chat_history.append({"role": "user", "text": user_message})
+    conversation_id = _conversation_id()
+    conversation = conversations.append(conversation_id, "user", user_message)
 
     try:
-        model = settings.get("model", "gemini-2.0-flash")
-
-        personality = settings.get("personality", "default")
-        system_text = PERSONALITY_PROMPTS.get(personality, PERSONALITY_PROMPTS["default"])
-        if context_memory:
-            memory_text = "\n".join(f"- {m['text']}" for m in context_memory)
-            system_text += f"\n\nContext memory:\n{memory_text}"
-
-        # Add email context if email is open
-        if email_data:
-            email_context = f"\n\n[CURRENT EMAIL CONTEXT]\n"
-            if email_data.get("subject"):
-                email_context += f"Subject: {email_data['subject']}\n"
-            if email_data.get("from"):
-                email_context += f"From: {email_data['from']}\n"
-            if email_data.get("to"):
-                email_context += f"To: {email_data['to']}\n"
-            if email_data.get("date"):
-                email_context += f"Date: {email_data['date']}\n"
-            if email_data.get("body"):
-                email_context += f"Content:\n{email_data['body']}\n"
-            email_context += "\nYou can help analyze, summarize, reply to, or perform actions related to this email."
-            system_text += email_context
+        model, prompt, cache_tags = _build_chat_prompt(conversation, user_message, email_data)
+        report = prompt.report
+        if _client_gone():
+            err = CLIENT_GONE
         else:
-            # If no email is explicitly open, fetch recent emails from database
-            recent_emails = get_recent_emails(limit=10)
-            if recent_emails:
-                system_text += recent_emails
-
-        weather_city = detect_weather_query(user_message)
-        if weather_city:
-            w = fetch_weather(weather_city)
-            if w:
-                system_text += (
-                    f"\n\n[REAL-TIME WEATHER DATA for {w['city']}, {w['country']}]"
-                    f"\nLocal time: {w.get('localtime', 'N/A')}"
-                    f"\nTemperature: {w['temp']}°C (feels like {w['feels_like']}°C)"
-                    f"\nDay high: {w['temp_max']}°C, Day low: {w['temp_min']}°C"
-                    f"\nCondition: {w['description']}"
-                    f"\nHumidity: {w['humidity']}%"
-                    f"\nWind: {w['wind_kph']} km/h {w.get('wind_dir', '')}"
-                    f"\nPressure: {w['pressure']} hPa"
-                    f"\nCloudiness: {w['clouds']}%"
-                    f"\nVisibility: {w['vis_km']} km"
-                    f"\nSunrise: {w.get('sunrise', 'N/A')}, Sunset: {w.get('sunset', 'N/A')}"
-                    f"\n\nUse this real data to answer the user's weather question accurately. "
-                    f"Stay in your personality while presenting the data."
-                )
-
-        contents = []
-        for msg in chat_history[-20:]:
-            role = "user" if msg["role"] == "user" else "model"
-            contents.append({"role": role, "parts": [{"text": msg["text"]}]})
-
-        ai_text, err = _gemini_call(model, system_text, contents)
+            ai_text, err = _cached_gemini_call(
+                model, prompt.system_text, prompt.contents, tags=cache_tags, hedge="chat",
+                gone=_client_gone,
+            )
+        if err == CLIENT_GONE:
+            # Nobody reads the reply: do not store a turn the user never saw
+            print("[CHAT] client disconnected, reply dropped", flush=True)
+            return jsonify({"error": err}), 499
         if err:
             ai_text = err
     except Exception as e:
         ai_text = f"Connection error: {str(e)}"
+        report = None
+
+    conversations.append(conversation_id, "assistant", ai_text)
+    return jsonify({"reply": ai_text, "prompt": report})
+
 
-    chat_history.append({"role": "assistant", "text": ai_text})
-    return jsonify({"reply": ai_text})
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.route("/api/chat/stream", methods=["POST"])
+def chat_stream():
+    """Same as /api/chat, but streams the reply as Server-Sent Events.
+
+    Emits ``delta`` events with partial text, then one ``done`` event with the
+    full reply (or ``error``). The reply is stored in the conversation even if
+    the browser goes away mid-stream.
+    """
+    data = request.get_json()
+    user_message = data.get("message", "")
+    email_data = data.get("email", None)
+
+    if not user_message:
+        return jsonify({"error": "Empty message"}), 400
+
+    # Resolved here: the session cookie cannot change once streaming started
+    conversation_id = _conversation_id()
+    conversation = conversations.append(conversation_id, "user", user_message)
+
+    def generate():
+        pieces = []
+        try:
+            model, prompt, cache_tags = _build_chat_prompt(conversation, user_message, email_data)
+            system_text, contents = prompt.system_text, prompt.contents
+            cached = response_cache.get(model, system_text, contents)
+            if cached is not None:
+                pieces.append(cached)
+                yield _sse("delta", {"text": cached})
+                yield _sse("done", {"reply": cached, "cached": True})
+                return
+            t0 = time.time()
+            for piece in _gemini_stream(model, system_text, contents, hedge="chat"):
+                pieces.append(piece)
+                yield _sse("delta", {"text": piece})
+            reply = "".join(pieces)
+            if reply:
+                response_cache.put(
+                    model, system_text, contents, reply, tags=cache_tags,
+                    ttl=LLM_CACHE_LIVE_TTL if cache_tags else None, latency=time.time() - t0,
+                )
+            yield _sse("done", {"reply": reply, "prompt": prompt.report})
+        except Exception as e:
+            err = str(e) if isinstance(e, GeminiStreamError) else f"Connection error: {str(e)}"
+            pieces = pieces or [err]
+            yield _sse("error", {"reply": "".join(pieces), "error": err})
+        finally:
+            conversations.append(conversation_id, "assistant", "".join(pieces))
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/api/chat/history", methods=["GET"])
+def chat_history():
+    """Older turns of the caller's conversation, newest first (``?before=<id>``)."""
+    before = request.args.get("before", type=int)
+    limit = min(request.args.get("limit", 50, type=int), 200)
+    turns = conversations.history(_conversation_id(), before_id=before, limit=limit)
+    return jsonify({"turns": turns, "next_before": turns[-1]["id"] if turns else None})
 
 
 @app.route("/api/weather", methods=["GET"])
@@ -467,7 +1184,7 @@ def get_settings():
     return jsonify({
         **settings,
         "api_keys_count": len(GEMINI_API_KEYS),
-        "current_key_index": _gemini_key_index,
+        "api_keys": key_pool.snapshot(),
     })
 
 
@@ -505,6 +1222,27 @@ def server_status():
     return jsonify({"status": "online"})
 
 
+@app.route("/api/metrics", methods=["GET"])
+def metrics():
+    return jsonify({
+        "llm_cache": response_cache.stats(),
+        "single_flight": singleflight.all_stats(),
+        "summarizer": summarizer.stats(),
+        "conversations": conversations.stats(),
+        "mail_sync": mail_sync.stats(),
+        "mail_outbox": mail_outbox.stats(),
+        "read_state": read_state.stats(),
+        "email_index": email_index.stats(),
+        "sessions": session_cache.stats(),
+        "gmail_accounts": gmail_registry.stats(),
+        "hedging": {
+            "enabled": GEMINI_HEDGE,
+            "policies": {name: p.stats() for name, p in HEDGE_POLICIES.items()},
+            "latency": gemini_latency.stats(),
+        },
+    })
+
+
 @app.route("/api/play-music", methods=["POST"])
 def play_music():
     data = request.get_json()
@@ -552,6 +1290,9 @@ def play_music():
         ]
         
         for search_query in search_strategies:
+            if _client_gone():
+                print("[MUSIC] client disconnected, search stopped", flush=True)
+                return jsonify({"error": CLIENT_GONE}), 499
             try:
                 resp = requests.get(
                     "https://www.googleapis.com/youtube/v3/search",
@@ -573,6 +1314,9 @@ def play_music():
                 
                 # Check each video for embedding permission
                 for item in items:
+                    if _client_gone():
+                        print("[MUSIC] client disconnected, search stopped", flush=True)
+                        return jsonify({"error": CLIENT_GONE}), 499
                     video_id = item["id"]["videoId"]
                     title = item["snippet"]["title"]
                     thumbnail = item["snippet"]["thumbnails"].get("high", {}).get("url", "")
@@ -631,18 +1375,8 @@ def create_session_token(user_id):
     return token
 
 def verify_session_token(token):
-    """Verify session token and return user if valid"""
-    session_obj = Session.query.filter_by(token=token).first()
-    
-    if not session_obj:
-        return None
-    
-    if session_obj.expires_at < datetime.utcnow():
-        db.session.delete(session_obj)
-        db.session.commit()
-        return None
-    
-    return session_obj.user
+    """Verify session token and return its user (id, email) if valid"""
+    return session_cache.lookup(token)
 
 # ═══════════════════════ LOCAL EMAIL ENDPOINTS ═══════════════════════
 
@@ -720,10 +1454,9 @@ def email_logout():
         session_token = request.headers.get('X-Session-Token')
         
         if session_token:
-            session_obj = Session.query.filter_by(token=session_token).first()
-            if session_obj:
-                db.session.delete(session_obj)
-                db.session.commit()
+            session_cache.invalidate(session_token)
+            Session.query.filter_by(token=session_token).delete()
+            db.session.commit()
 
         return jsonify({
             "success": True,
@@ -833,13 +1566,17 @@ def gmail_callback():
                 gmail_account = GmailAccount(email=email)
             
             gmail_account.access_token = result.get('token', '')
-            gmail_account.refresh_token = result.get('refresh_token', '')
+            if result.get('refresh_token'):
+                gmail_account.refresh_token = result['refresh_token']
+            gmail_account.token_expiry = result['credentials'].expiry
             
             db.session.add(gmail_account)
             db.session.commit()
             
+            gmail_registry.set_credentials(gmail_account.id, result['credentials'], email)
             session['gmail_email'] = email
             session['gmail_authenticated'] = True
+            mail_sync.worker(gmail_account.id)
             
             print(f"[CALLBACK] ✅ Данные сохранены в БД, перенаправляю...")
         
@@ -857,13 +1594,15 @@ def gmail_callback():
 def gmail_status():
     """Check Gmail authentication status"""
     try:
-        is_auth = gmail_service.is_authenticated()
+        _, gmail = _session_gmail()
+        is_auth = gmail is not None
         gmail_email = session.get('gmail_email', '')
         
         print(f"\n[STATUS] Проверка статуса авторизации")
         print(f"[STATUS] is_authenticated: {is_auth}")
         print(f"[STATUS] Email в сессии: {gmail_email}")
-        print(f"[STATUS] token.json существует: {Path('token.json').exists()}")
+        if gmail is not None:
+            print(f"[STATUS] Токен действителен ещё: {gmail.credentials.stats()['expires_in']} с")
         
         return jsonify({
             "authenticated": is_auth,
@@ -877,75 +1616,98 @@ def gmail_status():
 def get_gmail_emails():
     """Fetch emails from Gmail inbox"""
     try:
-        if not gmail_service.is_authenticated():
+        gmail_account, gmail = _session_gmail()
+        if gmail is None:
             return jsonify({"error": "Not authenticated with Gmail"}), 401
         
         max_results = request.args.get('max_results', 10, type=int)
-        result = gmail_service.get_emails(max_results=max_results)
+        # 'metadata' skips bodies: enough for a list view, much less to download
+        fmt = request.args.get('format', 'full')
+        if fmt not in ('full', 'metadata'):
+            return jsonify({"error": "format must be 'full' or 'metadata'"}), 400
+        
+        # Sync the cache incrementally and answer from it
+        if fmt == 'full':
+            sync = mail_sync.sync_now(gmail_account.id)
+            if 'error' in sync:
+                return jsonify(sync), 400
+            rows = EmailMessage.query.filter_by(account_id=gmail_account.id)\
+                .order_by(EmailMessage.received_at.desc())\
+                .limit(max_results)\
+                .all()
+            return jsonify({"emails": [email_to_dict(e, with_body=True) for e in rows], "sync": sync}), 200
+        
+        result = gmail.get_emails(max_results=max_results, format=fmt)
         
         if 'error' in result:
             return jsonify(result), 400
         
-        # Cache emails in database
-        gmail_email = session.get('gmail_email')
-        if gmail_email:
-            gmail_account = GmailAccount.query.filter_by(email=gmail_email).first()
-            if gmail_account and 'emails' in result:
-                for email_data in result['emails']:
-                    existing = EmailMessage.query.filter_by(
-                        gmail_id=email_data['id'],
-                        account_id=gmail_account.id
-                    ).first()
-                    
-                    if not existing:
-                        msg = EmailMessage(
-                            gmail_id=email_data['id'],
-                            account_id=gmail_account.id,
-                            sender=email_data.get('from', ''),
-                            subject=email_data.get('subject', ''),
-                            body=email_data.get('body', ''),
-                            received_at=datetime.utcnow()
-                        )
-                        db.session.add(msg)
-                
-                db.session.commit()
-        
         return jsonify(result), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/gmail/send', methods=['POST'])
 def send_gmail_email():
-    """Send email through Gmail"""
+    """Queue email(s) for sending through Gmail.
+    
+    Body: {to, subject, body} or {messages: [{to, subject, body}, ...]}.
+    Answers 202 with the job(s) right away; progress arrives as
+    outbox_status events on /mail and at /api/gmail/send/<job_id>.
+    """
     try:
-        if not gmail_service.is_authenticated():
+        gmail_account, gmail = _session_gmail()
+        if gmail is None:
             return jsonify({"error": "Not authenticated with Gmail"}), 401
         
-        data = request.json
-        to = data.get('to', '').strip()
-        subject = data.get('subject', '').strip()
-        body = data.get('body', '').strip()
-        
-        if not all([to, subject, body]):
-            return jsonify({"error": "Missing required fields: to, subject, body"}), 400
+        data = request.get_json(silent=True) or {}
+        messages = data.get('messages') if 'messages' in data else [data]
+        if not isinstance(messages, list) or not messages:
+            return jsonify({"error": "messages must be a non-empty list"}), 400
         
-        result = gmail_service.send_email(to, subject, body)
+        queued = []
+        for message in messages:
+            if not isinstance(message, dict):
+                message = {}
+            to = (message.get('to') or '').strip()
+            subject = (message.get('subject') or '').strip()
+            body = (message.get('body') or '').strip()
+            if not all([to, subject, body]):
+                return jsonify({"error": "Missing required fields: to, subject, body"}), 400
+            queued.append({"to": to, "subject": subject, "body": body})
         
-        if 'error' in result:
-            return jsonify(result), 400
-        
-        return jsonify(result), 200
+        jobs = mail_outbox.enqueue(gmail_account.id, queued)
+        if 'messages' in data:
+            return jsonify({"success": True, "jobs": jobs}), 202
+        return jsonify({"success": True, "job_id": jobs[0]['job_id'], **jobs[0]}), 202
     except Exception as e:
+        db.session.rollback()
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/gmail/send/<int:job_id>', methods=['GET'])
+def send_gmail_status(job_id):
+    """Delivery status of a queued email"""
+    gmail_account, _ = _session_gmail()
+    if gmail_account is None:
+        return jsonify({"error": "Not authenticated with Gmail"}), 401
+    job = mail_outbox.job(gmail_account.id, job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job), 200
+
 @app.route('/api/gmail/logout', methods=['POST'])
 def gmail_logout():
     """Logout from Gmail"""
     try:
+        gmail_account = GmailAccount.query.filter_by(email=session.get('gmail_email')).first()
+        if gmail_account:
+            mail_sync.stop(gmail_account.id)
+            # Токены этого аккаунта удаляем из БД, остальные аккаунты не трогаем
+            gmail_registry.remove(gmail_account.id, clear=True)
+        
         # 1. Полностью убиваем куку сессии Flask
         session.clear() 
         
-        # 2. Физически удаляем файл token.json (чтобы Гугл тоже нас забыл)
+        # 2. Физически удаляем старый файл token.json, если он остался
         gmail_service._clear_credentials()
         
         return jsonify({
@@ -959,10 +1721,10 @@ def gmail_logout():
 
 @app.route('/api/emails/inbox', methods=['GET'])
 def get_inbox():
-    """Get inbox emails (cached from Gmail or local)"""
+    """Get a page of cached inbox emails, without bodies (?max_results=, &cursor=)"""
     try:
         gmail_email = session.get('gmail_email', '')
-        max_results = request.args.get('max_results', 50, type=int)
+        max_results = max(1, min(request.args.get('max_results', 50, type=int), 200))
         
         if not gmail_email:
             return jsonify({"emails": [], "source": "none"}), 200
@@ -974,25 +1736,94 @@ def get_inbox():
             return jsonify({"emails": [], "source": "none"}), 200
         
         # Get cached emails from database
-        emails = EmailMessage.query.filter_by(account_id=gmail_account.id)\
-            .order_by(EmailMessage.received_at.desc())\
-            .limit(max_results)\
-            .all()
-        
-        emails_data = [{
-            'id': e.gmail_id,
-            'subject': e.subject,
-            'from': e.sender,
-            'body': e.body or '',
-            'date': e.received_at.isoformat(),
-            'is_read': e.is_read
-        } for e in emails]
+        page = inbox_page(gmail_account.id, limit=max_results, cursor=request.args.get('cursor'))
         
         return jsonify({
-            "emails": emails_data,
+            "emails": page["emails"],
+            "next_cursor": page["next_cursor"],
             "source": "cache",
-            "total": len(emails_data)
+            "total": len(page["emails"])
         }), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/emails/message/<message_id>', methods=['GET'])
+def get_email_message(message_id):
+    """Get one cached email with its body; supports If-None-Match"""
+    try:
+        gmail_email = session.get('gmail_email', '')
+        gmail_account = GmailAccount.query.filter_by(email=gmail_email).first() if gmail_email else None
+        if not gmail_account:
+            return jsonify({"error": "Not connected to Gmail"}), 401
+        
+        email = EmailMessage.query.options(db.defer(EmailMessage.body), db.defer(EmailMessage.body_text))\
+            .filter_by(account_id=gmail_account.id, gmail_id=message_id).first()
+        if not email:
+            return jsonify({"error": "Email not found"}), 404
+        
+        # Gmail messages never change apart from their labels, so the ETag
+        # can be checked before the body is even read
+        etag = hashlib.sha1(f"{email.id}:{email.gmail_id}:{email.label_ids}".encode()).hexdigest()
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = jsonify(email_to_dict(email, with_body=True))
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/emails/read', methods=['POST'])
+def mark_emails_read():
+    """Mark cached emails read or unread: {ids: [...], read: true|false}"""
+    try:
+        gmail_account, _ = _session_gmail()
+        if gmail_account is None:
+            return jsonify({"error": "Not connected to Gmail"}), 401
+        
+        data = request.get_json(silent=True) or {}
+        ids = data.get('ids')
+        is_read = data.get('read', True)
+        if not isinstance(ids, list) or not ids or not all(isinstance(i, str) for i in ids):
+            return jsonify({"error": "ids must be a non-empty list of message IDs"}), 400
+        if not isinstance(is_read, bool):
+            return jsonify({"error": "read must be true or false"}), 400
+        
+        # Gmail gets the change from the read_state queue a moment later
+        changed = read_state.mark(gmail_account.id, ids, is_read)
+        if changed:
+            mail_sync.publish(gmail_account, {"added": [], "updated": changed, "deleted": []})
+        return jsonify({"success": True, "changed": changed}), 200
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/emails/search', methods=['GET'])
+def search_emails():
+    """Full-text search over the cached inbox (?q=, &limit=, &cursor=)"""
+    try:
+        query = request.args.get('q', '').strip()
+        if not query:
+            return jsonify({"error": "Missing search query (q)"}), 400
+        
+        gmail_email = session.get('gmail_email', '')
+        gmail_account = GmailAccount.query.filter_by(email=gmail_email).first() if gmail_email else None
+        if not gmail_account:
+            return jsonify({"results": [], "next_cursor": None}), 200
+        
+        result = email_search.search(
+            gmail_account.id, query,
+            limit=request.args.get('limit', 20, type=int),
+            cursor=request.args.get('cursor'),
+        )
+        return jsonify(result), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -1000,9 +1831,6 @@ def get_inbox():
 def sync_emails():
     """Fetch fresh emails from Gmail and cache them"""
     try:
-        if not gmail_service.is_authenticated():
-            return jsonify({"error": "Not authenticated with Gmail"}), 401
-        
         gmail_email = session.get('gmail_email', '')
         if not gmail_email:
             return jsonify({"error": "No Gmail email in session"}), 400
@@ -1013,46 +1841,53 @@ def sync_emails():
             # Если база пустая, а кука осталась - стираем куку и просим войти заново!
             session.clear()
             return jsonify({"error": "Database reset detected. Please login again."}), 400
+        if gmail_registry.get(gmail_account.id) is None:
+            return jsonify({"error": "Not authenticated with Gmail"}), 401
 
-        # Fetch from Gmail API
-        result = gmail_service.get_emails(max_results=10)
+        # Only what changed since the last sync (full resync the first time).
+        # Joins the account's sync if one is already running; changes also
+        # reach the other tabs as inbox_delta events. A sync that has started
+        # runs to the end even if this client leaves: it is shared, and the
+        # history cursor only moves once the whole delta is stored
+        if _client_gone():
+            return jsonify({"error": CLIENT_GONE}), 499
+        result = mail_sync.sync_now(gmail_account.id)
         
         if 'error' in result:
             return jsonify(result), 400
-            
-        # Дальше твой код сохранения в базу (if gmail_account and 'emails' in result: ...)
-        
-        # Cache emails
-        gmail_account = GmailAccount.query.filter_by(email=gmail_email).first()
-        if gmail_account and 'emails' in result:
-            for email_data in result['emails']:
-                existing = EmailMessage.query.filter_by(
-                    gmail_id=email_data.get('id', ''),
-                    account_id=gmail_account.id
-                ).first()
-                
-                if not existing:
-                    msg = EmailMessage(
-                        gmail_id=email_data.get('id', ''),
-                        account_id=gmail_account.id,
-                        sender=email_data.get('from', 'Unknown'),
-                        subject=email_data.get('subject', 'No Subject'),
-                        body=email_data.get('body', ''),
-                        received_at=datetime.utcnow()
-                    )
-                    db.session.add(msg)
-            
-            db.session.commit()
         
         return jsonify({
             "success": True,
             "message": "Emails synced successfully",
-            "count": len(result.get('emails', []))
+            "count": len(result['added']),
+            "changed": has_changes(result),
+            **result
         }), 200
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/gmail/push', methods=['POST'])
+def gmail_push():
+    """Cloud Pub/Sub push endpoint for Gmail watch notifications.
+    
+    The subscription's push URL must carry ?token=<GMAIL_PUSH_TOKEN>; with
+    no token configured, pushes are refused and the sync timer does the work.
+    Always answers 204 for well-formed messages so Pub/Sub does not retry
+    notifications for accounts we do not know.
+    """
+    if not GMAIL_PUSH_TOKEN:
+        return jsonify({"error": "Push notifications are disabled (GMAIL_PUSH_TOKEN is not set)"}), 403
+    if not secrets.compare_digest(request.args.get('token', ''), GMAIL_PUSH_TOKEN):
+        return jsonify({"error": "Invalid push token"}), 403
+    try:
+        email, history_id = decode_pubsub_push(request.get_json(silent=True))
+    except (ValueError, TypeError, AttributeError) as e:
+        return jsonify({"error": f"Malformed push message: {e}"}), 400
+    if email:
+        mail_sync.push(email, history_id)
+    return "", 204
+
 
 # ═══════════════════════ AUDIO INTERCOM (browser <-> ESP32) ═══════════════════════
 
@@ -1116,6 +1951,17 @@ def _init_audio_bridge():
 _init_audio_bridge()
 
 
+@socketio.on("connect", namespace="/mail")
+def _on_mail_connect():
+    # Every tab of an account joins the same room and gets its inbox deltas
+    gmail_email = session.get('gmail_email')
+    gmail_account = GmailAccount.query.filter_by(email=gmail_email).first() if gmail_email else None
+    if gmail_account is None:
+        return False
+    join_room(f"account:{gmail_account.id}")
+    mail_sync.worker(gmail_account.id)
+
+
 @socketio.on("connect", namespace="/audio")
 def _on_audio_connect():
     global _audio_listeners
@@ -1156,6 +2002,7 @@ import struct as _struct
 import wave as _wave
 import math as _math
 import asyncio as _asyncio
+import queue as _queue
 import numpy as _np
 
 _whisper_models = {}
@@ -1181,7 +2028,7 @@ def _preload_whisper():
     _get_whisper("tiny")
     _get_whisper("base")
 
-_threading.Thread(target=_preload_whisper, daemon=True).start()
+_threading.Thread(target=_run_blocking, args=(_preload_whisper,), daemon=True).start()
 
 
 def _generate_beep(freq=800, duration_ms=300, sample_rate=16000):
@@ -1263,94 +2110,180 @@ _TTS_VOICE_FALLBACKS = {
 
 TTS_RATE = os.environ.get("TTS_RATE", "+18%")
 
-def _tts_stream_to_esp32(text, lang="en"):
-    """Stream Edge TTS -> ffmpeg (mp3->pcm) -> UDP to ESP32, true streaming."""
-    import edge_tts
-    import subprocess
-    import time
-
-    voices_to_try = _TTS_VOICE_FALLBACKS.get(lang, _TTS_VOICE_FALLBACKS["en"])
-    voice = voices_to_try[0]
-    send_ip = _esp32_send_ip()
+class _TTSStream:
+    """One Edge TTS -> ffmpeg (mp3->pcm) -> UDP session, fed sentence by sentence.
+
+    A single ffmpeg process and PCM sender live for the whole reply; every
+    speak() call opens an Edge TTS stream for one piece of text and appends
+    its mp3 to ffmpeg's stdin, so audio for the first sentence is already
+    playing while later ones are synthesized. speak() calls must come from
+    one thread at a time.
+    """
+
+    def __init__(self, lang="en"):
+        import time
+
+        voices_to_try = _TTS_VOICE_FALLBACKS.get(lang, _TTS_VOICE_FALLBACKS["en"])
+        self.voice = voices_to_try[0]
+        self.send_ip = _esp32_send_ip()
+        self.enabled = bool(self.send_ip and _udp_send)
+        self.t0 = time.time()
+        self.sample_rate = 16000
+        self.bytes_per_sec = self.sample_rate * 2
+        self.chunk_size = 1024
+        self.total_mp3 = 0
+        self.total_pcm = 0
+        self.chunks_sent = 0
+        self.sentences = 0
+        self.first_audio_at = None
+        self._broken = False
+        self._loop = None
+
+        if not self.enabled:
+            print("[ROBOT] TTS: no ESP32 IP or UDP socket, skipping", flush=True)
+            return
 
-    if not send_ip or not _udp_send:
-        print("[ROBOT] TTS: no ESP32 IP or UDP socket, skipping", flush=True)
-        return
+        self.ffmpeg_proc = subprocess.Popen(
+            ["ffmpeg", "-hide_banner", "-loglevel", "error",
+             "-i", "pipe:0",
+             "-f", "s16le", "-ar", str(self.sample_rate), "-ac", "1",
+             "pipe:1"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            bufsize=8192,
+        )
+        self.sender_thread = _threading.Thread(target=self._pcm_sender, daemon=True)
+        self.sender_thread.start()
 
-    t0 = time.time()
-    sample_rate = 16000
-    bytes_per_sec = sample_rate * 2
-    chunk_size = 1024
-    total_mp3 = 0
-    total_pcm = 0
-    chunks_sent = 0
-    first_audio_at = None
-
-    ffmpeg_proc = subprocess.Popen(
-        ["ffmpeg", "-hide_banner", "-loglevel", "error",
-         "-i", "pipe:0",
-         "-f", "s16le", "-ar", str(sample_rate), "-ac", "1",
-         "pipe:1"],
-        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-        bufsize=8192,
-    )
+    def _pcm_sender(self):
+        import time
 
-    def _pcm_sender():
-        nonlocal total_pcm, chunks_sent, first_audio_at
         while True:
-            pcm = ffmpeg_proc.stdout.read(chunk_size)
+            pcm = self.ffmpeg_proc.stdout.read(self.chunk_size)
             if not pcm:
                 break
-            if first_audio_at is None:
-                first_audio_at = time.time()
-            total_pcm += len(pcm)
+            if self.first_audio_at is None:
+                self.first_audio_at = time.time()
+            self.total_pcm += len(pcm)
             try:
-                _udp_send.sendto(pcm, (send_ip, AUDIO_SPK_PORT))
+                _udp_send.sendto(pcm, (self.send_ip, AUDIO_SPK_PORT))
             except Exception:
                 pass
-            chunks_sent += 1
-            time.sleep(chunk_size / bytes_per_sec * 0.85)
+            self.chunks_sent += 1
+            time.sleep(self.chunk_size / self.bytes_per_sec * 0.85)
 
-    sender_thread = _threading.Thread(target=_pcm_sender, daemon=True)
-    sender_thread.start()
+    def speak(self, text):
+        import edge_tts
+
+        if not self.enabled or self._broken or not text.strip():
+            return
+        if self._loop is None:
+            self._loop = _asyncio.new_event_loop()
 
-    loop = _asyncio.new_event_loop()
-    try:
         async def _stream():
-            nonlocal total_mp3
-            comm = edge_tts.Communicate(text, voice, rate=TTS_RATE)
+            comm = edge_tts.Communicate(text, self.voice, rate=TTS_RATE)
             async for chunk in comm.stream():
                 if chunk["type"] == "audio":
                     data = chunk["data"]
-                    total_mp3 += len(data)
+                    self.total_mp3 += len(data)
                     try:
-                        ffmpeg_proc.stdin.write(data)
-                        ffmpeg_proc.stdin.flush()
+                        self.ffmpeg_proc.stdin.write(data)
+                        self.ffmpeg_proc.stdin.flush()
                     except BrokenPipeError:
+                        self._broken = True
                         break
-        loop.run_until_complete(_stream())
-    except Exception as e:
-        print(f"[ROBOT] TTS stream error ({voice}): {e}", flush=True)
-    finally:
-        loop.close()
 
-    try:
-        ffmpeg_proc.stdin.close()
-    except Exception:
-        pass
-    sender_thread.join(timeout=30)
-    ffmpeg_proc.wait(timeout=10)
+        self.sentences += 1
+        try:
+            self._loop.run_until_complete(_stream())
+        except Exception as e:
+            print(f"[ROBOT] TTS stream error ({self.voice}): {e}", flush=True)
+
+    def close(self):
+        """Flush the remaining audio and return the time to first audio out."""
+        import time
+
+        if not self.enabled:
+            return None
+        if self._loop is not None:
+            self._loop.close()
+        try:
+            self.ffmpeg_proc.stdin.close()
+        except Exception:
+            pass
+        self.sender_thread.join(timeout=30)
+        self.ffmpeg_proc.wait(timeout=10)
 
-    t_total = time.time() - t0
-    tts_latency = (first_audio_at - t0) if first_audio_at else t_total
-    audio_secs = total_pcm / bytes_per_sec
-    playback_time = t_total - tts_latency if first_audio_at else 0
+        t_total = time.time() - self.t0
+        tts_latency = (self.first_audio_at - self.t0) if self.first_audio_at else t_total
+        audio_secs = self.total_pcm / self.bytes_per_sec
+        playback_time = t_total - tts_latency if self.first_audio_at else 0
 
-    print(f"[ROBOT] TTS: {voice} rate={TTS_RATE} | "
-          f"gen={tts_latency:.2f}s | play={playback_time:.2f}s ({audio_secs:.1f}s audio) | "
-          f"{total_mp3}B mp3 -> {total_pcm}B pcm | {chunks_sent} chunks",
-          flush=True)
-    return tts_latency
+        print(f"[ROBOT] TTS: {self.voice} rate={TTS_RATE} | "
+              f"first audio={tts_latency:.2f}s | play={playback_time:.2f}s ({audio_secs:.1f}s audio) | "
+              f"{self.sentences} sentences | {self.total_mp3}B mp3 -> {self.total_pcm}B pcm | "
+              f"{self.chunks_sent} chunks",
+              flush=True)
+        return tts_latency
+
+
+def _tts_stream_to_esp32(text, lang="en"):
+    """Stream Edge TTS -> ffmpeg (mp3->pcm) -> UDP to ESP32, true streaming."""
+    tts = _TTSStream(lang)
+    tts.speak(text)
+    return tts.close()
+
+
+class _SentenceSplitter:
+    """Cuts streamed LLM text into sentences that can be spoken on their own."""
+
+    _BOUNDARY_RE = re.compile(r"[.!?…]+[\"')\]»]*\s+")
+    MAX_CHARS = 220
+
+    def __init__(self, min_chars=12):
+        self.min_chars = min_chars
+        self.buffer = ""
+
+    def feed(self, text):
+        """Add streamed text; return the sentences completed by it."""
+        self.buffer += text
+        sentences = []
+        start = 0
+        # A boundary only counts once whitespace follows, so "3." + "5 km" stays whole
+        for m in self._BOUNDARY_RE.finditer(self.buffer):
+            candidate = self.buffer[start:m.end()].strip()
+            if len(candidate) >= self.min_chars:
+                sentences.append(candidate)
+                start = m.end()
+        self.buffer = self.buffer[start:]
+        if len(self.buffer) > self.MAX_CHARS:
+            cut = self.buffer.rfind(" ", 0, self.MAX_CHARS)
+            if cut > 0:
+                sentences.append(self.buffer[:cut].strip())
+                self.buffer = self.buffer[cut + 1:]
+        return sentences
+
+    def flush(self):
+        rest, self.buffer = self.buffer.strip(), ""
+        return [rest] if rest else []
+
+
+def _robot_reply_pieces(model, system_text, contents, debug_text=None):
+    """Yield the robot's reply text as it is generated (cache, debug or Gemini)."""
+    if debug_text is not None:
+        for word in debug_text.split(" "):
+            yield word + " "
+        return
+    cached = response_cache.get(model, system_text, contents)
+    if cached is not None:
+        yield cached
+        return
+    t0 = time.time()
+    pieces = []
+    for piece in _gemini_stream(model, system_text, contents, hedge="robot"):
+        pieces.append(piece)
+        yield piece
+    if pieces:
+        response_cache.put(model, system_text, contents, "".join(pieces), latency=time.time() - t0)
 
 
 def _robot_pipeline():
@@ -1435,7 +2368,7 @@ def _robot_pipeline():
 
         t0 = time.time()
         wav_buf = _pcm_buffer_to_wav(all_pcm)
-        user_text, detected_lang = _stt(wav_buf)
+        user_text, detected_lang = _run_blocking(_stt, wav_buf)
         t_stt = time.time() - t0
 
         if not user_text or len(user_text.strip()) < 2:
@@ -1446,61 +2379,98 @@ def _robot_pipeline():
         socketio.emit("robot_transcription", {"text": user_text}, namespace="/audio")
 
         t0 = time.time()
-        chat_history.append({"role": "user", "text": user_text})
+        conversation = conversations.append(ROBOT_CONVERSATION_ID, "user", user_text)
         model = settings.get("model", "gemini-2.0-flash")
-        personality = settings.get("personality", "default")
-        system_text = PERSONALITY_PROMPTS.get(personality, PERSONALITY_PROMPTS["default"])
-        if context_memory:
-            memory_text = "\n".join(f"- {m['text']}" for m in context_memory)
-            system_text += f"\n\nContext memory:\n{memory_text}"
-
-        system_text += "\n\nYou are responding to a voice command. Keep your answer short and conversational (1-3 sentences). Do not use markdown, bullet points, or special formatting."
-
-        contents = []
-        for msg in chat_history[-20:]:
-            role = "user" if msg["role"] == "user" else "model"
-            contents.append({"role": role, "parts": [{"text": msg["text"]}]})
+        builder = _base_prompt(ROBOT_PROMPT_TOKEN_BUDGET)
+        builder.add("voice", "\n\nYou are responding to a voice command. Keep your answer short and conversational (1-3 sentences). Do not use markdown, bullet points, or special formatting.")
+        _add_conversation(builder, conversation)
+        prompt = builder.build()
+        system_text, contents = prompt.system_text, prompt.contents
+        print(f"[PROMPT] robot: {format_report(prompt.report)}", flush=True)
 
         # ── DEBUG: set to True to skip real API call ──
         _ROBOT_DEBUG = True
         _ROBOT_DEBUG_TEXT = "Привет, это тестовое сообщение. Всё работает отлично!"
         # _ROBOT_DEBUG_TEXT = "Сәлеметсіз бе, бұл сынақ хабарлама. Бәрі жақсы жұмыс істейді!"
         # _ROBOT_DEBUG_TEXT = "Hello, this is a test message. Everything works great!"
-        if _ROBOT_DEBUG:
-            ai_text = _ROBOT_DEBUG_TEXT
-            t_llm = 0.0
-        else:
-            ai_text, err = _gemini_call(model, system_text, contents)
-            t_llm = time.time() - t0
-            if err:
-                ai_text = f"Sorry, I had a problem: {err}"
         # ── END DEBUG ──
-        chat_history.append({"role": "assistant", "text": ai_text})
 
-        print(f"[ROBOT] LLM: {t_llm:.2f}s | '{ai_text[:80]}'", flush=True)
+        # LLM -> sentences -> TTS: each finished sentence is spoken while the
+        # rest of the reply is still being generated.
+        tts = _TTSStream(detected_lang)
+        sentence_queue = _queue.Queue()
+
+        def _speaker():
+            while True:
+                sentence = sentence_queue.get()
+                if sentence is None:
+                    break
+                tts.speak(sentence)
+
+        speaker_thread = _threading.Thread(target=_speaker, daemon=True)
+        speaker_thread.start()
+
+        splitter = _SentenceSplitter()
+        pieces = []
+        t_first_token = None
+        t_first_sentence = None
+
+        def _say(sentences):
+            nonlocal t_first_sentence
+            for sentence in sentences:
+                if t_first_sentence is None:
+                    t_first_sentence = time.time() - t0
+                    socketio.emit("robot_status", {"state": "speaking"}, namespace="/audio")
+                sentence_queue.put(sentence)
+
+        try:
+            for piece in _robot_reply_pieces(model, system_text, contents,
+                                             debug_text=_ROBOT_DEBUG_TEXT if _ROBOT_DEBUG else None):
+                if t_first_token is None:
+                    t_first_token = time.time() - t0
+                pieces.append(piece)
+                _say(splitter.feed(piece))
+        except GeminiStreamError as e:
+            if not pieces:
+                pieces.append(f"Sorry, I had a problem: {e}")
+                _say(splitter.feed(pieces[0]))
+        except Exception:
+            sentence_queue.put(None)
+            speaker_thread.join(timeout=30)
+            tts.close()
+            raise
+        _say(splitter.flush())
+        sentence_queue.put(None)
+        t_llm = time.time() - t0
+
+        ai_text = "".join(pieces).strip()
+        conversations.append(ROBOT_CONVERSATION_ID, "assistant", ai_text)
+
+        print(f"[ROBOT] LLM: {t_llm:.2f}s (first token {t_first_token or 0:.2f}s) | '{ai_text[:80]}'", flush=True)
         socketio.emit("robot_response", {"text": ai_text}, namespace="/audio")
 
-        socketio.emit("robot_status", {"state": "speaking"}, namespace="/audio")
         t_tts_start = time.time()
-        tts_latency = 0
+        speaker_thread.join()
         try:
-            tts_latency = _tts_stream_to_esp32(ai_text, lang=detected_lang) or 0
-            t_speak = time.time() - t_tts_start
+            tts.close()
         except Exception as e:
-            t_speak = time.time() - t_tts_start
             print(f"[ROBOT] TTS error: {e}", flush=True)
+        t_speak = time.time() - t_tts_start
 
-        processing_time = t_stt + t_llm + tts_latency
-        first_pkt_to_reply = (silence_detected_at - first_audio_pkt_at) + processing_time if first_audio_pkt_at else 0
+        # First audio out, measured from the end of STT
+        t_first_audio = (tts.first_audio_at - t0) if tts.first_audio_at else 0
+        processing_time = t_stt + t_first_audio
 
         print(f"[ROBOT]", flush=True)
         print(f"[ROBOT] ======== PIPELINE SUMMARY ========", flush=True)
         print(f"[ROBOT]  STT          : {t_stt:.2f}s", flush=True)
-        print(f"[ROBOT]  LLM          : {t_llm:.2f}s", flush=True)
-        print(f"[ROBOT]  TTS gen      : {tts_latency:.2f}s  (time to first audio out)", flush=True)
-        print(f"[ROBOT]  TTS playback : {t_speak - tts_latency:.2f}s  (streaming to ESP32)", flush=True)
+        print(f"[ROBOT]  LLM 1st tok  : {t_first_token or 0:.2f}s", flush=True)
+        print(f"[ROBOT]  LLM 1st sent : {t_first_sentence or 0:.2f}s", flush=True)
+        print(f"[ROBOT]  LLM total    : {t_llm:.2f}s", flush=True)
+        print(f"[ROBOT]  TTS sentences: {tts.sentences}", flush=True)
+        print(f"[ROBOT]  TTS playback : {t_speak:.2f}s  (after LLM finished)", flush=True)
         print(f"[ROBOT]  --------------------------------", flush=True)
-        print(f"[ROBOT]  PROCESSING   : {processing_time:.2f}s  = STT + LLM + TTS gen", flush=True)
+        print(f"[ROBOT]  FIRST AUDIO  : {processing_time:.2f}s  = STT + time to first audio out", flush=True)
         print(f"[ROBOT]  TOTAL WALL   : {time.time() - pipeline_start:.2f}s", flush=True)
         print(f"[ROBOT] ================================", flush=True)
         socketio.emit("robot_status", {"state": "idle"}, namespace="/audio")
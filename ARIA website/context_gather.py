@@ -0,0 +1,81 @@
+"""Concurrent context gathering for ARIA prompts."""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+
+class ContextGatherer:
+    """Runs prompt enrichment sources in parallel, each under its own deadline.
+
+    A source that misses its deadline is skipped: the reply is built without
+    it and the source keeps running in the background until its own timeout,
+    its result discarded. Deadlines count from the start of gather(), so the
+    whole stage never takes longer than the largest deadline.
+
+    Every source name gets its own pool of ``max_workers_per_source``
+    threads. While that many calls of a source are still running, the source
+    is skipped (status ``busy``) instead of queued, so a hung source (say the
+    weather API) cannot hold threads the other sources need.
+    """
+
+    def __init__(self, max_workers_per_source=4, wrap=None):
+        self.max_workers_per_source = max(1, max_workers_per_source)
+        self._lock = threading.Lock()
+        self._pools = {}  # source name -> ThreadPoolExecutor
+        self._running = {}  # source name -> calls not finished yet
+        # Optional callable that wraps every source (e.g. to push an app context)
+        self._wrap = wrap
+
+    def _run(self, name, fn):
+        t0 = time.time()
+        try:
+            if self._wrap is not None:
+                result = self._wrap(fn)
+            else:
+                result = fn()
+            return result, time.time() - t0
+        finally:
+            with self._lock:
+                self._running[name] -= 1
+
+    def _submit(self, name, fn):
+        """Start ``fn`` on the source's pool; None while the pool is full."""
+        with self._lock:
+            if self._running.get(name, 0) >= self.max_workers_per_source:
+                return None
+            self._running[name] = self._running.get(name, 0) + 1
+            pool = self._pools.get(name)
+            if pool is None:
+                pool = self._pools[name] = ThreadPoolExecutor(
+                    max_workers=self.max_workers_per_source, thread_name_prefix=f"context-{name}")
+        return pool.submit(self._run, name, fn)
+
+    def gather(self, sources):
+        """Run ``{name: (fn, deadline_seconds)}``; return ``(results, timings)``.
+
+        ``results`` holds the value of every source that finished in time
+        (None otherwise); ``timings`` has the status and duration per source.
+        """
+        start = time.time()
+        futures = {name: self._submit(name, fn) for name, (fn, _d) in sources.items()}
+        results, timings = {}, {}
+        # Wait on the tightest deadlines first so a slow source never delays them
+        for name in sorted(sources, key=lambda n: sources[n][1]):
+            deadline = sources[name][1]
+            if futures[name] is None:
+                results[name] = None
+                timings[name] = {"status": "busy", "ms": 0}
+                continue
+            remaining = max(0.0, start + deadline - time.time())
+            try:
+                value, took = futures[name].result(timeout=remaining)
+                results[name] = value
+                timings[name] = {"status": "ok", "ms": round(took * 1000)}
+            except FutureTimeout:
+                results[name] = None
+                timings[name] = {"status": "timeout", "ms": round(deadline * 1000)}
+            except Exception as e:
+                results[name] = None
+                timings[name] = {"status": "error", "ms": round((time.time() - start) * 1000), "error": str(e)[:200]}
+        return results, timings
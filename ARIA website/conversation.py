@@ -0,0 +1,187 @@
+"""Conversation history with background summarization of old turns.
+
+Shared by the ARIA website (app.py) and the voice assistant package, so it
+only depends on the standard library. The voice package keeps a vendored copy
+in To_Delete_Later/aria/conversation.py; change both together.
+"""
+
+import queue
+import threading
+import time
+
+
+def format_transcript(turns, user="User", assistant="ARIA"):
+    """Render turns as ``Name: text`` lines for a summary prompt."""
+    return "\n".join(
+        f"{user if t['role'] == 'user' else assistant}: {t['text']}" for t in turns
+    )
+
+
+class ConversationBuffer:
+    """Recent turns plus a running summary of the turns compacted away.
+
+    Turns are ``{"role": ..., "text": ...}`` dicts. Once there are more than
+    ``summarize_after`` of them, ``summarizer`` folds all but the last
+    ``keep_turns`` into the summary on its own thread. The new summary and
+    the shortened turn list are swapped in together under the lock, so a
+    reader using snapshot() sees either the old or the new state, never a
+    mix. ``max_turns`` caps the buffer like a ring (oldest turns fall off),
+    which also bounds it when summarization keeps failing. ``on_summary`` is
+    called as ``on_summary(summary, folded_turns)`` after every swap.
+    """
+
+    def __init__(self, summarizer=None, summarize_after=30, keep_turns=12, max_turns=200,
+                 on_summary=None):
+        self.summarizer = summarizer
+        self.summarize_after = summarize_after
+        self.keep_turns = keep_turns
+        self.max_turns = max_turns
+        self.on_summary = on_summary
+        self._lock = threading.Lock()
+        self._turns = []
+        self._summary = ""
+        # Turns ever removed from the front; lets a late swap find its turns
+        self._offset = 0
+        self._generation = 0
+        self._pending = False
+
+    def __len__(self):
+        with self._lock:
+            return len(self._turns)
+
+    def restore(self, summary, turns):
+        """Load persisted state (oldest turn first) into an empty buffer."""
+        with self._lock:
+            self._summary = summary or ""
+            self._turns = [dict(t) for t in turns[-self.max_turns:]]
+
+    def append(self, role, text, turn_id=None):
+        """Add a turn; ``turn_id`` is kept as ``"id"`` (e.g. a database row id)."""
+        turn = {"role": role, "text": text}
+        if turn_id is not None:
+            turn["id"] = turn_id
+        with self._lock:
+            self._turns.append(turn)
+            excess = len(self._turns) - self.max_turns
+            if excess > 0:
+                del self._turns[:excess]
+                self._offset += excess
+            due = (self.summarizer is not None and not self._pending
+                   and len(self._turns) > self.summarize_after)
+            if due:
+                self._pending = True
+        if due:
+            self.summarizer.submit(self)
+
+    def recent(self, limit=None):
+        with self._lock:
+            turns = self._turns[-limit:] if limit else self._turns
+            return [dict(t) for t in turns]
+
+    @property
+    def summary(self):
+        with self._lock:
+            return self._summary
+
+    def snapshot(self, limit=None):
+        """``(summary, turns)`` read together."""
+        with self._lock:
+            turns = self._turns[-limit:] if limit else self._turns
+            return self._summary, [dict(t) for t in turns]
+
+    def clear(self):
+        with self._lock:
+            self._offset += len(self._turns)
+            self._turns = []
+            self._summary = ""
+            self._generation += 1
+
+    def _take_old(self):
+        """Pick the turns to fold into the summary, or None if there are none."""
+        with self._lock:
+            cut = len(self._turns) - self.keep_turns
+            # The turns that stay should start with a user turn
+            while 0 < cut < len(self._turns) and self._turns[cut]["role"] != "user":
+                cut += 1
+            if cut <= 0 or cut >= len(self._turns):
+                self._pending = False
+                return None
+            return (self._generation, self._offset, self._summary,
+                    [dict(t) for t in self._turns[:cut]])
+
+    @property
+    def pending(self):
+        with self._lock:
+            return self._pending
+
+    def _swap(self, generation, offset, turns, summary):
+        with self._lock:
+            self._pending = False
+            if generation != self._generation or not summary:
+                return False
+            # Only appends happened meanwhile, but the cap may have dropped some
+            remove = max(0, offset + len(turns) - self._offset)
+            del self._turns[:remove]
+            self._offset += remove
+            self._summary = summary = summary.strip()
+        if self.on_summary is not None:
+            self.on_summary(summary, turns)
+        return True
+
+
+class Summarizer:
+    """Background worker that compacts ConversationBuffers.
+
+    ``summarize(previous_summary, turns)`` must return the new summary text
+    covering both; it runs on the worker thread, never on the thread that
+    appended the turn. An exception (or an empty result) leaves the buffer
+    as it was and the next append tries again.
+    """
+
+    def __init__(self, summarize, name="summarizer"):
+        self.summarize = summarize
+        self.name = name
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stats = {"runs": 0, "failures": 0, "turns_compacted": 0, "last_seconds": 0.0}
+
+    def submit(self, buffer):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._worker, name=self.name, daemon=True)
+                self._thread.start()
+        self._queue.put(buffer)
+
+    def _worker(self):
+        while True:
+            buffer = self._queue.get()
+            job = buffer._take_old()
+            if job is None:
+                continue
+            generation, offset, previous, turns = job
+            t0 = time.time()
+            try:
+                summary = self.summarize(previous, turns)
+            except Exception as e:
+                print(f"[SUMMARY] {self.name}: could not summarize: {e}", flush=True)
+                summary = None
+            try:
+                swapped = buffer._swap(generation, offset, turns, summary)
+            except Exception as e:
+                # The swap itself happened; only on_summary failed
+                print(f"[SUMMARY] {self.name}: could not save summary: {e}", flush=True)
+                swapped = True
+            with self._lock:
+                self._stats["runs"] += 1
+                self._stats["last_seconds"] = round(time.time() - t0, 2)
+                if swapped:
+                    self._stats["turns_compacted"] += len(turns)
+                elif not summary:
+                    self._stats["failures"] += 1
+            if swapped:
+                print(f"[SUMMARY] {self.name}: folded {len(turns)} turns in {time.time() - t0:.1f}s", flush=True)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
@@ -0,0 +1,140 @@
+"""Per-user conversations: hot turns in memory, full log in SQLite."""
+
+import threading
+import time
+from collections import OrderedDict
+
+from conversation import ConversationBuffer
+
+
+class ConversationStore:
+    """Maps a conversation id to a ConversationBuffer backed by the database.
+
+    Every turn is appended to ``turn_model`` as it happens; the running
+    summary and the id of the last turn it covers live in ``state_model``.
+    A conversation is loaded lazily on first use (summary plus the turns
+    after it, at most ``ring_size``) and dropped from memory after
+    ``idle_seconds`` without use or when more than ``max_loaded`` are in
+    memory (least recently used first). Each buffer has its own lock, so
+    conversations never wait on each other; the store lock only guards the
+    id -> buffer map.
+    """
+
+    def __init__(self, app, db, turn_model, state_model, summarizer=None,
+                 ring_size=60, summarize_after=30, keep_turns=12,
+                 max_loaded=256, idle_seconds=1800.0):
+        self.app = app
+        self.db = db
+        self.turn_model = turn_model
+        self.state_model = state_model
+        self.summarizer = summarizer
+        self.ring_size = ring_size
+        self.summarize_after = summarize_after
+        self.keep_turns = keep_turns
+        self.max_loaded = max_loaded
+        self.idle_seconds = idle_seconds
+        self._lock = threading.Lock()
+        self._loaded = OrderedDict()  # id -> [buffer, last_used]
+        self._stats = {"loads": 0, "evictions": 0, "appends": 0}
+
+    def get(self, conversation_id):
+        """The conversation's buffer, loading it from the database if needed."""
+        now = time.time()
+        with self._lock:
+            slot = self._loaded.get(conversation_id)
+            if slot is not None:
+                slot[1] = now
+                self._loaded.move_to_end(conversation_id)
+                return slot[0]
+        buffer = self._load(conversation_id)
+        with self._lock:
+            # Another request may have loaded it meanwhile; keep the first one
+            slot = self._loaded.setdefault(conversation_id, [buffer, now])
+            self._loaded.move_to_end(conversation_id)
+            self._stats["loads"] += 1
+            self._evict(now)
+            return slot[0]
+
+    def append(self, conversation_id, role, text):
+        """Persist a turn, then add it to the in-memory buffer."""
+        buffer = self.get(conversation_id)
+        turn_id = None
+        try:
+            with self.app.app_context():
+                row = self.turn_model(conversation_id=conversation_id, role=role, text=text)
+                self.db.session.add(row)
+                self.db.session.commit()
+                turn_id = row.id
+        except Exception as e:
+            print(f"[CONVERSATION] Could not persist turn: {e}", flush=True)
+        buffer.append(role, text, turn_id=turn_id)
+        with self._lock:
+            self._stats["appends"] += 1
+        return buffer
+
+    def history(self, conversation_id, before_id=None, limit=50):
+        """Older turns straight from the database, newest first."""
+        with self.app.app_context():
+            query = self.turn_model.query.filter_by(conversation_id=conversation_id)
+            if before_id:
+                query = query.filter(self.turn_model.id < before_id)
+            rows = query.order_by(self.turn_model.id.desc()).limit(limit).all()
+            return [
+                {"id": r.id, "role": r.role, "text": r.text,
+                 "created_at": r.created_at.isoformat() if r.created_at else None}
+                for r in rows
+            ]
+
+    def _load(self, conversation_id):
+        with self.app.app_context():
+            state = self.db.session.get(self.state_model, conversation_id)
+            summary = state.summary if state else ""
+            upto = state.summarized_upto if state else 0
+            rows = (
+                self.turn_model.query
+                .filter(self.turn_model.conversation_id == conversation_id,
+                        self.turn_model.id > upto)
+                .order_by(self.turn_model.id.desc())
+                .limit(self.ring_size)
+                .all()
+            )
+            turns = [{"role": r.role, "text": r.text, "id": r.id} for r in reversed(rows)]
+
+        buffer = ConversationBuffer(
+            self.summarizer, summarize_after=self.summarize_after,
+            keep_turns=self.keep_turns, max_turns=self.ring_size,
+            on_summary=lambda summary, folded: self._save_summary(conversation_id, summary, folded),
+        )
+        buffer.restore(summary, turns)
+        return buffer
+
+    def _save_summary(self, conversation_id, summary, folded):
+        upto = max((t["id"] for t in folded if t.get("id") is not None), default=None)
+        with self.app.app_context():
+            state = self.db.session.get(self.state_model, conversation_id)
+            if state is None:
+                state = self.state_model(conversation_id=conversation_id)
+                self.db.session.add(state)
+            state.summary = summary
+            if upto is not None:
+                state.summarized_upto = max(state.summarized_upto or 0, upto)
+            self.db.session.commit()
+
+    def _evict(self, now):
+        # Called with the lock held. A buffer waiting for its summary stays
+        # loaded so the swap lands on the copy that is still in use.
+        for conversation_id, (buffer, last_used) in list(self._loaded.items()):
+            over = len(self._loaded) > self.max_loaded
+            if not over and now - last_used < self.idle_seconds:
+                continue
+            if buffer.pending:
+                continue
+            del self._loaded[conversation_id]
+            self._stats["evictions"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["loaded"] = len(self._loaded)
+            stats["turns_in_memory"] = sum(len(b) for b, _t in self._loaded.values())
+        return stats
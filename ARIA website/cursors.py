@@ -0,0 +1,21 @@
+"""Opaque cursors for keyset pagination."""
+
+import base64
+import json
+
+
+def encode_cursor(*values):
+    """URL-safe token for the sort key of the last row on a page."""
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor, size):
+    """The ``size`` values of an encode_cursor() token; ValueError if malformed."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError("Invalid cursor")
+    return values
@@ -0,0 +1,310 @@
+"""Vector index over cached emails, for picking the ones a chat question is about.
+
+Every EmailMessage is embedded once, when refresh() first sees it, into a
+float16 row of a memory-mapped matrix on disk (``<path>.f16``, with the
+message id, account id and Gmail ID fingerprint in ``<path>.ids``). A
+query is one vectorized matrix-vector product over that matrix and an
+argpartition for the top k.
+
+The default HashingEmbedder is local and offline: signed feature hashing of
+words and word stems, so similar wording gives similar vectors. Any object
+with ``name``, ``dim`` and ``embed(texts) -> float32 array`` of unit rows
+can replace it.
+"""
+
+import json
+import math
+import os
+import re
+import threading
+import zlib
+from functools import lru_cache
+
+import numpy as np
+
+from models import db, EmailMessage
+
+# Characters of the body that are embedded
+EMBED_BODY_CHARS = 2000
+# The subject says most about what an email is about: its share of the vector
+SUBJECT_WEIGHT = 2.0
+# Rows converted to float32 at a time when scoring (stays in CPU cache)
+_SEARCH_BLOCK = 2048
+
+_STOPWORDS = frozenset("""
+a an and are as at be been but by can could did do does for from had has have he her his how i if in
+into is it its me my no not of on or our she so than that the their them then there these they this
+to up us was we were what when where which who why will with would you your about any all also am
+just more some tell show give find please know get got let like need want
+и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только ее мне было
+вот от меня еще нет о из ему теперь когда даже ну вдруг ли если уже или ни быть был него до вас
+нибудь опять уж вам ведь там потом себя ничего ей может они тут где есть надо ней для мы тебя их
+чем была сам чтоб без будто чего раз тоже себе под будет ж тогда кто этот того потому этого какой
+совсем ним здесь этом один почти мой тем чтобы нее сейчас были куда зачем всех никогда можно при
+наконец два об другой хоть после над больше тот через эти нас про всего них какая много разве
+три эту моя впрочем хорошо свою этой перед иногда лучше чуть том нельзя такой им более всегда
+конечно всю между покажи скажи расскажи
+""".split())
+
+# Questions that are about the mailbox even when no single email matches
+_MAIL_INTENT = re.compile(
+    r'\b(e-?mails?|mail(box)?|inbox|unread|messages?|letters?|wrote|sent me|'
+    r'письм\w*|почт\w*|сообщени\w*|входящ\w*|написал\w*)\b', re.I)
+
+
+def wants_mail(question):
+    """True if the question talks about the mailbox itself."""
+    return bool(_MAIL_INTENT.search(question or ''))
+
+
+class HashingEmbedder:
+    """Offline text embedder: signed hashing of words and 5-letter stems.
+
+    Stems let inflected forms (invoice/invoices, счёт/счёта) meet. Term
+    weights are sublinear (1 + log tf) and vectors are L2-normalized, so a
+    dot product is the cosine similarity.
+    """
+
+    name = 'hashing-v1'
+
+    def __init__(self, dim=512):
+        self.dim = dim
+
+    @lru_cache(maxsize=65536)
+    def _feature(self, token):
+        h = zlib.crc32(token.encode('utf-8'))
+        return h % self.dim, 1.0 if h & 0x80000000 else -1.0
+
+    def _features(self, text):
+        counts = {}
+        for word in re.findall(r'\w+', (text or '').lower()):
+            if len(word) < 2 or word in _STOPWORDS or word.isdigit() and len(word) < 3:
+                continue
+            counts[word] = counts.get(word, 0.0) + 1.0
+            if len(word) > 5:
+                stem = '~' + word[:5]
+                counts[stem] = counts.get(stem, 0.0) + 0.5
+        return counts
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for token, count in self._features(text).items():
+                index, sign = self._feature(token)
+                vectors[row, index] += sign * (1.0 + math.log(count) if count >= 1 else count)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.divide(vectors, norms, out=vectors, where=norms > 0)
+        return vectors
+
+
+def embed_emails(embedder, rows):
+    """Unit vectors for rows with subject, sender and text; the subject and
+    sender are embedded apart from the body and weighted SUBJECT_WEIGHT."""
+    heads = embedder.embed([f"{r.subject or ''}\n{re.sub(r'<[^>]*>', ' ', r.sender or '')}" for r in rows])
+    bodies = embedder.embed([r.text or '' for r in rows])
+    vectors = SUBJECT_WEIGHT * heads + bodies
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    np.divide(vectors, norms, out=vectors, where=norms > 0)
+    return vectors
+
+
+def gmail_key(gmail_id):
+    """Fingerprint of a Gmail message ID, stored next to its vector."""
+    return zlib.crc32((gmail_id or '').encode('utf-8'))
+
+
+class EmailVectorIndex:
+    """Append-only float16 embedding matrix of cached emails, memory-mapped.
+
+    Each row carries the message id, account id and gmail_key() of the email
+    it was made from. refresh() reconciles the index with the cache: rows
+    whose message is gone, or whose id SQLite has reused for another email,
+    are marked dead (account -1, never matched), and every cached message
+    without a live row is embedded. Dead rows are compacted away once they
+    make up half the matrix. A different embedder (name or dim) than the
+    one on disk starts a fresh index.
+    """
+
+    FORMAT = 2
+    _DEAD = -1
+
+    def __init__(self, path, embedder):
+        self.path = path
+        self.embedder = embedder
+        self._lock = threading.Lock()
+        self._vectors = None
+        self._ids = None  # (capacity, 3) int64: message id, account id, gmail_key
+        self._live = {}  # message id -> row
+        self.count = 0
+        self.capacity = 0
+
+    # ── storage ──
+
+    def _files(self):
+        return self.path + '.f16', self.path + '.ids', self.path + '.json'
+
+    def _open(self, capacity):
+        vec_file, ids_file, _ = self._files()
+        for name, row_bytes in ((vec_file, self.embedder.dim * 2), (ids_file, 24)):
+            with open(name, 'ab') as f:
+                f.truncate(capacity * row_bytes)
+        self._vectors = np.memmap(vec_file, dtype=np.float16, mode='r+', shape=(capacity, self.embedder.dim))
+        self._ids = np.memmap(ids_file, dtype=np.int64, mode='r+', shape=(capacity, 3))
+        self.capacity = capacity
+
+    def _write_meta(self):
+        _, _, meta_file = self._files()
+        self._vectors.flush()
+        self._ids.flush()
+        tmp = meta_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'embedder': self.embedder.name, 'dim': self.embedder.dim,
+                       'format': self.FORMAT, 'count': self.count}, f)
+        os.replace(tmp, meta_file)
+
+    def load(self):
+        """Open the index on disk (or an empty one)."""
+        _, _, meta_file = self._files()
+        meta = {}
+        if os.path.exists(meta_file):
+            with open(meta_file) as f:
+                meta = json.load(f)
+        with self._lock:
+            if (meta.get('embedder'), meta.get('dim'), meta.get('format')) == \
+                    (self.embedder.name, self.embedder.dim, self.FORMAT):
+                self.count = meta['count']
+            else:
+                self.count = 0
+                for name in self._files()[:2]:
+                    if os.path.exists(name):
+                        os.remove(name)
+            self._open(max(1024, self.count))
+            ids = np.array(self._ids[:self.count])
+            self._live = {int(ids[row, 0]): row for row in np.flatnonzero(ids[:, 1] != self._DEAD)}
+
+    def _append(self, rows, vectors):
+        n = len(rows)
+        if self.count + n > self.capacity:
+            self._vectors.flush()
+            self._ids.flush()
+            self._open(max(self.capacity * 2, self.count + n))
+        self._vectors[self.count:self.count + n] = vectors
+        self._ids[self.count:self.count + n] = [(r.id, r.account_id, gmail_key(r.gmail_id)) for r in rows]
+        for offset, r in enumerate(rows):
+            self._live[r.id] = self.count + offset
+        self.count += n
+
+    def _kill(self, row):
+        self._ids[row, 1] = self._DEAD
+
+    def _compact(self):
+        # Move the live rows to the front, keeping their order
+        keep = np.flatnonzero(np.array(self._ids[:self.count, 1]) != self._DEAD)
+        for start in range(0, len(keep), _SEARCH_BLOCK):
+            rows = keep[start:start + _SEARCH_BLOCK]
+            self._vectors[start:start + len(rows)] = self._vectors[rows]
+            self._ids[start:start + len(rows)] = self._ids[rows]
+        self.count = len(keep)
+        ids = np.array(self._ids[:self.count, 0])
+        self._live = {int(message_id): row for row, message_id in enumerate(ids)}
+
+    def discard(self, account_id, gmail_ids):
+        """Mark the rows of deleted messages dead; returns how many."""
+        keys = {gmail_key(gmail_id) for gmail_id in gmail_ids}
+        if not keys:
+            return 0
+        with self._lock:
+            ids = np.array(self._ids[:self.count])
+            rows = np.flatnonzero((ids[:, 1] == account_id) & np.isin(ids[:, 2], list(keys)))
+            for row in rows:
+                self._kill(row)
+                self._live.pop(int(ids[row, 0]), None)
+            if len(rows):
+                self._write_meta()
+        return len(rows)
+
+    def refresh(self, batch=500):
+        """Bring the index in line with the cache; returns how many emails were embedded.
+
+        Needs an app context.
+        """
+        cached = db.session.query(EmailMessage.id, EmailMessage.account_id, EmailMessage.gmail_id).all()
+        added = 0
+        with self._lock:
+            current = {r.id: (r.account_id, gmail_key(r.gmail_id)) for r in cached}
+            ids = np.array(self._ids[:self.count]).tolist()
+            changed = False
+            for message_id, row in list(self._live.items()):
+                if current.get(message_id) != (ids[row][1], ids[row][2]):
+                    # Deleted, or the id now belongs to another email
+                    self._kill(row)
+                    del self._live[message_id]
+                    changed = True
+            missing = sorted(message_id for message_id in current if message_id not in self._live)
+            for i in range(0, len(missing), batch):
+                rows = db.session.query(
+                    EmailMessage.id, EmailMessage.account_id, EmailMessage.gmail_id,
+                    EmailMessage.subject, EmailMessage.sender,
+                    db.func.substr(EmailMessage.body_text, 1, EMBED_BODY_CHARS).label('text'),
+                ).filter(EmailMessage.id.in_(missing[i:i + batch])).order_by(EmailMessage.id).all()
+                if rows:
+                    self._append(rows, embed_emails(self.embedder, rows))
+                    added += len(rows)
+            if self.count - len(self._live) > max(1024, self.count // 2):
+                self._compact()
+                changed = True
+            if added or changed:
+                self._write_meta()
+        return added
+
+    def rebuild(self):
+        """Drop every row and embed the cache again."""
+        with self._lock:
+            self.count = 0
+            self._live = {}
+            self._write_meta()
+        return self.refresh()
+
+    # ── queries ──
+
+    def search(self, query, account_id, k=5):
+        """``[(message_id, cosine)]`` of the account's ``k`` rows closest to ``query``, best first."""
+        q = self.embedder.embed([query])[0]
+        if not q.any():
+            return []
+        with self._lock:
+            n = self.count
+            if n == 0:
+                return []
+            scores = np.empty(n, dtype=np.float32)
+            block = np.empty((min(n, _SEARCH_BLOCK), self.embedder.dim), dtype=np.float32)
+            for start in range(0, n, _SEARCH_BLOCK):
+                stop = min(n, start + _SEARCH_BLOCK)
+                block[:stop - start] = self._vectors[start:stop]
+                np.dot(block[:stop - start], q, out=scores[start:stop])
+            ids = np.array(self._ids[:n])
+        scores[ids[:, 1] != account_id] = -np.inf
+        k = min(k, n)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(ids[i, 0]), int(ids[i, 2]), float(scores[i])) for i in top if np.isfinite(scores[i])]
+
+    def select(self, question, account_id, k=3, min_score=0.2, ratio=0.6):
+        """Relevance gate: ids of the emails worth putting in a prompt, maybe none.
+
+        A hit must reach ``min_score`` and ``ratio`` times the best score, so
+        one strong match does not drag weak ones along. Hits whose message
+        is gone, or whose id now belongs to another email, are skipped.
+        """
+        hits = self.search(question, account_id, k=k)
+        if not hits or hits[0][2] < min_score:
+            return []
+        floor = max(min_score, hits[0][2] * ratio)
+        wanted = {message_id: key for message_id, key, score in hits if score >= floor}
+        existing = {row.id: gmail_key(row.gmail_id) for row in db.session.query(EmailMessage.id, EmailMessage.gmail_id)
+                    .filter(EmailMessage.id.in_(list(wanted)))}
+        return [message_id for message_id, key in wanted.items() if existing.get(message_id) == key]
+
+    def stats(self):
+        return {"embedder": self.embedder.name, "dim": self.embedder.dim, "vectors": len(self._live),
+                "dead": self.count - len(self._live), "bytes": self.count * self.embedder.dim * 2}
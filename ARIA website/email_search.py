@@ -0,0 +1,170 @@
+"""Full-text search over cached emails with SQLite FTS5.
+
+``email_fts`` holds subject, sender and the plain-text body of every
+EmailMessage, keyed by its row id. mail_sync.ingest_messages() indexes new
+messages in the same transaction that stores them, and a trigger drops
+index rows together with their messages, so the index never scans or
+re-reads message bodies at query time.
+"""
+
+import re
+from html import escape
+
+from cursors import decode_cursor, encode_cursor
+from models import db, EmailMessage
+
+FTS_TABLE = 'email_fts'
+# bm25() column weights: subject, sender, body
+BM25_WEIGHTS = (4.0, 2.0, 1.0)
+MAX_LIMIT = 100
+_CHUNK = 500
+# Snippet highlight markers; replaced by <mark> after HTML-escaping
+_HL_START, _HL_END = '\x02', '\x03'
+
+available = False
+
+
+def ensure_index():
+    """Create the FTS table and delete trigger, and index unindexed messages.
+
+    Call inside an app context after db.create_all(). Returns False (and
+    search stays disabled) when this SQLite build has no FTS5.
+    """
+    global available
+    try:
+        db.session.execute(db.text(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+            "subject, sender, body, tokenize='unicode61 remove_diacritics 2')"
+        ))
+        db.session.execute(db.text(
+            f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete AFTER DELETE ON email_messages "
+            f"BEGIN DELETE FROM {FTS_TABLE} WHERE rowid = old.id; END"
+        ))
+        missing = [row_id for (row_id,) in db.session.execute(db.text(
+            f"SELECT id FROM email_messages WHERE id NOT IN (SELECT rowid FROM {FTS_TABLE})"
+        ))]
+        for i in range(0, len(missing), _CHUNK):
+            _index_rows(EmailMessage.id.in_(missing[i:i + _CHUNK]))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"[SEARCH] Full-text search disabled: {e}", flush=True)
+        available = False
+        return False
+    if missing:
+        print(f"[SEARCH] Indexed {len(missing)} cached emails", flush=True)
+    available = True
+    return True
+
+
+def _index_rows(condition):
+    rows = db.session.query(
+        EmailMessage.id, EmailMessage.subject, EmailMessage.sender, EmailMessage.body_text
+    ).filter(condition).all()
+    if not rows:
+        return 0
+    db.session.execute(
+        db.text(f"INSERT INTO {FTS_TABLE}(rowid, subject, sender, body) VALUES (:id, :subject, :sender, :body)"),
+        [{"id": r.id, "subject": r.subject or '', "sender": r.sender or '', "body": r.body_text or ''}
+         for r in rows],
+    )
+    return len(rows)
+
+
+def index_messages(account_id, gmail_ids):
+    """Add newly stored messages to the index (in the caller's transaction)."""
+    if not available or not gmail_ids:
+        return 0
+    indexed = 0
+    for i in range(0, len(gmail_ids), _CHUNK):
+        indexed += _index_rows(db.and_(
+            EmailMessage.account_id == account_id,
+            EmailMessage.gmail_id.in_(gmail_ids[i:i + _CHUNK]),
+        ))
+    return indexed
+
+
+def match_query(text):
+    """FTS5 query for free text: every word must match, the last as a prefix.
+
+    Words are quoted, so FTS operators and punctuation in user input are
+    matched literally instead of raising syntax errors. None if no words.
+    """
+    terms = re.findall(r'\w+', text or '')
+    if not terms:
+        return None
+    return ' '.join(f'"{t}"' for t in terms) + '*'
+
+
+def _highlight(snippet):
+    return escape(snippet or '').replace(_HL_START, '<mark>').replace(_HL_END, '</mark>')
+
+
+def search(account_id, text, limit=20, cursor=None):
+    """BM25-ranked matches for ``text`` in one account's cached emails.
+
+    Results are ordered by score (best first), then row id; ``cursor`` is
+    the ``next_cursor`` of the previous page and resumes right after its
+    last result (keyset pagination, no OFFSET). Snippets are HTML-escaped
+    with the matches wrapped in ``<mark>``. Raises ValueError for a bad
+    cursor and RuntimeError when FTS5 is unavailable.
+    """
+    if not available:
+        raise RuntimeError("Full-text search is not available")
+    match = match_query(text)
+    if match is None:
+        return {"results": [], "next_cursor": None}
+    limit = max(1, min(limit, MAX_LIMIT))
+    after_score, after_id = None, None
+    if cursor:
+        after_score, after_id = decode_cursor(cursor, 2)
+        try:
+            after_score, after_id = float(after_score), int(after_id)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid cursor")
+
+    weights = ', '.join(str(w) for w in BM25_WEIGHTS)
+    page = db.session.execute(db.text(
+        f"SELECT id, score FROM ("
+        f"  SELECT m.id AS id, bm25({FTS_TABLE}, {weights}) AS score"
+        f"  FROM {FTS_TABLE} JOIN email_messages m ON m.id = {FTS_TABLE}.rowid"
+        f"  WHERE {FTS_TABLE} MATCH :match AND m.account_id = :account_id"
+        f") WHERE :after_score IS NULL OR score > :after_score"
+        f"   OR (score = :after_score AND id > :after_id)"
+        f" ORDER BY score, id LIMIT :limit"
+    ), {"match": match, "account_id": account_id, "after_score": after_score,
+        "after_id": after_id, "limit": limit + 1}).all()
+
+    has_more = len(page) > limit
+    page = page[:limit]
+    if not page:
+        return {"results": [], "next_cursor": None}
+
+    # Snippets only for the rows on this page
+    ids = [row.id for row in page]
+    params = {f"id{i}": row_id for i, row_id in enumerate(ids)}
+    snippets = dict(db.session.execute(db.text(
+        f"SELECT rowid, snippet({FTS_TABLE}, -1, :hl_start, :hl_end, '…', 16) FROM {FTS_TABLE}"
+        f" WHERE {FTS_TABLE} MATCH :match AND rowid IN ({', '.join(':' + k for k in params)})"
+    ), {"match": match, "hl_start": _HL_START, "hl_end": _HL_END, **params}).all())
+    rows = {row.id: row for row in EmailMessage.query.filter(EmailMessage.id.in_(ids))}
+
+    results = []
+    for hit in page:
+        row = rows.get(hit.id)
+        if row is None:
+            continue
+        results.append({
+            'id': row.gmail_id,
+            'subject': row.subject,
+            'from': row.sender,
+            'date': row.received_at.isoformat(),
+            'is_read': row.is_read,
+            'snippet': _highlight(snippets.get(hit.id)),
+            'score': round(-hit.score, 6),
+        })
+    last = page[-1]
+    return {
+        "results": results,
+        "next_cursor": encode_cursor(last.score, last.id) if has_more else None,
+    }
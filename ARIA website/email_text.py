@@ -0,0 +1,92 @@
+"""Plain text, previews and compressed storage for Gmail message bodies.
+
+Gmail bodies are usually HTML; what prompts, search and the inbox list need
+is derived once at ingest time.
+"""
+
+import re
+import zlib
+from html import unescape
+from html.parser import HTMLParser
+
+# Tags whose content is never shown
+_SKIP_TAGS = {'script', 'style', 'head', 'title', 'noscript', 'template'}
+# Tags that start a new line in the rendered text
+_BLOCK_TAGS = {
+    'p', 'div', 'br', 'tr', 'li', 'ul', 'ol', 'table', 'h1', 'h2', 'h3', 'h4',
+    'h5', 'h6', 'blockquote', 'pre', 'hr', 'section', 'article', 'header', 'footer',
+}
+# A common tag, or any closing tag (plain text rarely has "</x>")
+_LOOKS_LIKE_HTML = re.compile(
+    r'<\s*(html|body|div|p|br|hr|table|span|a|td|img|b|i|u|strong|em|font|center|meta)\b'
+    r'|</\s*[a-z][a-z0-9]*\s*>', re.I)
+
+PREVIEW_CHARS = 160
+COMPRESSION_LEVEL = 6
+
+
+class _TextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _SKIP_TAGS:
+            self._skip += 1
+        elif tag in _BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in _SKIP_TAGS:
+            self._skip = max(0, self._skip - 1)
+        elif tag in _BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.parts.append(data)
+
+
+def html_to_text(body):
+    """Readable plain text of an email body; plain-text bodies pass through.
+
+    Drops scripts, styles and markup, decodes entities and collapses runs of
+    whitespace (keeping single line breaks between blocks).
+    """
+    if not body:
+        return ''
+    if is_html(body):
+        parser = _TextExtractor()
+        try:
+            parser.feed(body)
+            parser.close()
+            text = ''.join(parser.parts)
+        except Exception:
+            text = unescape(re.sub(r'<[^>]+>', ' ', body))
+    else:
+        text = body
+    text = re.sub(r'[ \t\r\f\v\u00a0\u200b\u200c]+', ' ', text)
+    text = re.sub(r' *\n[ \n]*', '\n', text)
+    return text.strip()
+
+
+def is_html(body):
+    return bool(body) and bool(_LOOKS_LIKE_HTML.search(body))
+
+
+def derive_text(body):
+    """``(text, preview, word_count)`` for a raw email body."""
+    text = html_to_text(body)
+    return text, text.replace('\n', ' ')[:PREVIEW_CHARS], len(text.split())
+
+
+def compress_body(body):
+    """``(encoding, data)`` for storing a raw body."""
+    return 'zlib', zlib.compress(body.encode('utf-8'), COMPRESSION_LEVEL)
+
+
+def decompress_body(data, encoding='zlib'):
+    if encoding != 'zlib':
+        raise ValueError(f"Unknown body encoding: {encoding}")
+    return zlib.decompress(data).decode('utf-8')
@@ -0,0 +1,262 @@
+"""Gemini API key pool with per-key rate budgets and health tracking.
+
+Shared by the ARIA website (app.py) and the voice assistant package, so it
+only depends on the standard library. The voice package keeps a vendored copy
+in To_Delete_Later/aria/gemini_keys.py; change both together.
+"""
+
+import re
+import threading
+import time
+from collections import deque
+
+RATE_LIMIT_STATUSES = ("RESOURCE_EXHAUSTED", "RATE_LIMIT_EXCEEDED")
+
+# Per-key budgets (free tier), used when GEMINI_KEY_RPM / GEMINI_KEY_TPM are unset
+DEFAULT_RPM = 10
+DEFAULT_TPM = 250000
+
+# Used when a 429 does not say how long to back off
+DEFAULT_COOLDOWN = 60.0
+# Daily quotas do not come back within a minute, no point retrying soon
+DAILY_QUOTA_COOLDOWN = 3600.0
+
+_RETRY_IN_RE = re.compile(r"retry in ([\d.]+)\s*(ms|s)", re.IGNORECASE)
+_DURATION_RE = re.compile(r"^([\d.]+)s$")
+
+
+def parse_retry_delay(error):
+    """Return the back-off in seconds requested by a rate-limit error, or None.
+
+    ``error`` is either the ``error`` object of a Gemini REST response or the
+    text of an SDK exception.
+    """
+    if isinstance(error, dict):
+        for detail in error.get("details", []) or []:
+            if detail.get("@type", "").endswith("google.rpc.RetryInfo"):
+                m = _DURATION_RE.match(str(detail.get("retryDelay", "")))
+                if m:
+                    return float(m.group(1))
+        for detail in error.get("details", []) or []:
+            for violation in detail.get("violations", []) or []:
+                if "PerDay" in violation.get("quotaId", ""):
+                    return DAILY_QUOTA_COOLDOWN
+        text = error.get("message", "")
+    else:
+        text = str(error)
+
+    m = _RETRY_IN_RE.search(text)
+    if m:
+        value = float(m.group(1))
+        return value / 1000.0 if m.group(2).lower() == "ms" else value
+    if "PerDay" in text or "per day" in text.lower():
+        return DAILY_QUOTA_COOLDOWN
+    return None
+
+
+def is_rate_limit_error(error):
+    """Heuristic used for SDK exceptions that only carry a message."""
+    text = str(error).lower()
+    return "429" in text or "rate" in text or "quota" in text or "resource_exhausted" in text
+
+
+class _TokenBucket:
+    """Classic token bucket refilled continuously over one minute."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount, now):
+        self._refill(now)
+        self.tokens -= amount
+
+
+class _KeyState:
+    def __init__(self, index, key, rpm, tpm):
+        self.index = index
+        self.key = key
+        self.requests = _TokenBucket(rpm) if rpm else None
+        self.tokens = _TokenBucket(tpm) if tpm else None
+        self.cooldown_until = 0.0
+        self.in_flight = 0
+        self.last_used = 0.0
+        self.successes = 0
+        self.failures = 0
+        self.rate_limits = 0
+        self.last_error = ""
+        # Rolling windows: outcome of the last calls and latency of successes
+        self.outcomes = deque(maxlen=20)
+        self.latencies = deque(maxlen=50)
+
+    def wait_time(self, tokens, now):
+        wait = max(0.0, self.cooldown_until - now)
+        if self.requests:
+            wait = max(wait, self.requests.wait_time(1, now))
+        if self.tokens and tokens:
+            wait = max(wait, self.tokens.wait_time(tokens, now))
+        return wait
+
+    def success_rate(self):
+        # Laplace prior so an unused key is neither perfect nor hopeless
+        ok = sum(self.outcomes)
+        return (ok + 1.0) / (len(self.outcomes) + 2.0)
+
+    def mean_latency(self):
+        if not self.latencies:
+            return 0.0
+        return sum(self.latencies) / len(self.latencies)
+
+
+class GeminiKeyPool:
+    """Thread-safe scheduler that picks the key most likely to succeed.
+
+    Every key gets requests-per-minute and tokens-per-minute budgets, a
+    cooldown deadline taken from RESOURCE_EXHAUSTED errors and rolling
+    error/latency stats. ``acquire`` returns the best ready key; callers must
+    report the outcome with ``record_success``, ``record_rate_limit``,
+    ``record_failure`` or ``release``.
+    """
+
+    def __init__(self, keys, rpm=None, tpm=None, default_cooldown=DEFAULT_COOLDOWN):
+        self._lock = threading.Condition()
+        self._keys = [_KeyState(i, k, rpm, tpm) for i, k in enumerate(keys)]
+        self.default_cooldown = default_cooldown
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _pick(self, tokens, exclude, now):
+        ready = []
+        soonest = None
+        for state in self._keys:
+            if state.index in exclude:
+                continue
+            wait = state.wait_time(tokens, now)
+            if wait <= 0:
+                ready.append(state)
+            elif soonest is None or wait < soonest:
+                soonest = wait
+        if not ready:
+            return None, soonest
+        best = min(ready, key=lambda s: (
+            -s.success_rate(), s.in_flight, s.mean_latency(), s.last_used,
+        ))
+        return best, 0.0
+
+    def acquire(self, tokens=0, exclude=(), wait=0.0):
+        """Reserve the best available key and return ``(index, key)``.
+
+        Blocks for up to ``wait`` seconds when every candidate key is out of
+        budget; returns None if nothing frees up in time (or if all keys are
+        cooling down for longer than that).
+        """
+        deadline = time.monotonic() + wait
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                state, soonest = self._pick(tokens, set(exclude), now)
+                if state is not None:
+                    if state.requests:
+                        state.requests.take(1, now)
+                    if state.tokens and tokens:
+                        state.tokens.take(tokens, now)
+                    state.in_flight += 1
+                    state.last_used = now
+                    return state.index, state.key
+                if soonest is None or now + soonest > deadline:
+                    return None
+                self._lock.wait(timeout=soonest)
+
+    def best(self, tokens=0, exclude=()):
+        """Index of the key acquire() would pick right now, without reserving it."""
+        with self._lock:
+            state, _soonest = self._pick(tokens, set(exclude), time.monotonic())
+        return state.index if state is not None else None
+
+    def next_available_in(self, tokens=0):
+        """Seconds until some key could be acquired (0 if one is ready now)."""
+        with self._lock:
+            now = time.monotonic()
+            waits = [s.wait_time(tokens, now) for s in self._keys]
+        return min(waits) if waits else None
+
+    def record_success(self, index, latency, tokens=None, reserved=0):
+        """Report a successful call; ``tokens`` is the real usage if known."""
+        with self._lock:
+            state = self._keys[index]
+            state.in_flight = max(0, state.in_flight - 1)
+            state.successes += 1
+            state.outcomes.append(True)
+            state.latencies.append(latency)
+            if state.tokens and tokens is not None:
+                # Correct the reservation made in acquire() with the real usage
+                state.tokens.take(tokens - reserved, time.monotonic())
+            self._lock.notify_all()
+
+    def record_rate_limit(self, index, error=None):
+        """Put a key on cooldown for as long as the 429 asked for."""
+        delay = parse_retry_delay(error) if error is not None else None
+        with self._lock:
+            state = self._keys[index]
+            state.in_flight = max(0, state.in_flight - 1)
+            state.rate_limits += 1
+            state.outcomes.append(False)
+            state.last_error = (error.get("message", "") if isinstance(error, dict) else str(error or ""))[:200]
+            state.cooldown_until = time.monotonic() + (delay if delay is not None else self.default_cooldown)
+            self._lock.notify_all()
+
+    def record_failure(self, index, error=None):
+        """Report a timeout / transport error that counts against the key."""
+        with self._lock:
+            state = self._keys[index]
+            state.in_flight = max(0, state.in_flight - 1)
+            state.failures += 1
+            state.outcomes.append(False)
+            state.last_error = str(error or "")[:200]
+            self._lock.notify_all()
+
+    def release(self, index):
+        """Give a key back without judging it (e.g. a 400 caused by the prompt)."""
+        with self._lock:
+            state = self._keys[index]
+            state.in_flight = max(0, state.in_flight - 1)
+            self._lock.notify_all()
+
+    def snapshot(self):
+        """JSON-friendly view of every key, without the secrets."""
+        with self._lock:
+            now = time.monotonic()
+            keys = []
+            for s in self._keys:
+                if s.tokens:
+                    s.tokens.wait_time(0, now)
+                keys.append({
+                    "index": s.index,
+                    "key": f"...{s.key[-4:]}" if len(s.key) > 4 else "...",
+                    "ready": s.wait_time(0, now) <= 0,
+                    "cooldown_remaining": round(max(0.0, s.cooldown_until - now), 1),
+                    "rpm_left": int(s.requests.tokens) if s.requests else None,
+                    "tpm_left": int(s.tokens.tokens) if s.tokens else None,
+                    "in_flight": s.in_flight,
+                    "successes": s.successes,
+                    "failures": s.failures,
+                    "rate_limits": s.rate_limits,
+                    "success_rate": round(s.success_rate(), 3),
+                    "mean_latency": round(s.mean_latency(), 3),
+                    "last_error": s.last_error,
+                })
+        return keys
@@ -0,0 +1,243 @@
+"""In-memory Gmail OAuth credentials with background token refresh."""
+
+import json
+import threading
+from datetime import datetime, timedelta
+
+import google_auth_httplib2
+import httplib2
+from google.auth.exceptions import RefreshError
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build
+from googleapiclient.http import HttpRequest
+
+
+class TokenFileStore:
+    """Token data in a JSON file (the single-account ``token.json``)."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if not self.path.exists():
+            return None
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    def save(self, token_data):
+        tmp = self.path.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(token_data, f)
+        tmp.replace(self.path)
+
+    def clear(self):
+        if self.path.exists():
+            self.path.unlink()
+
+
+class CredentialManager:
+    """Credentials, the Gmail service and the profile email for one account.
+
+    ``store`` persists the token data (``load()`` -> dict or None,
+    ``save(dict)``, ``clear()``); it is read once, after that every check
+    is an attribute read. A daemon thread refreshes the access token
+    ``refresh_margin`` seconds before it expires (more than google-auth's
+    own 3m45s threshold, so requests never find the token stale and refresh
+    it themselves) and saves only after a refresh. Refreshes are serialized
+    by a lock. The service is built once and makes every request on its own
+    AuthorizedHttp, so one instance is safe to share between threads.
+    """
+
+    def __init__(self, store, scopes, refresh_margin=300, retry_delay=30):
+        self.store = store
+        self.scopes = scopes
+        self.refresh_margin = refresh_margin
+        self.retry_delay = retry_delay
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._loaded = False
+        self._credentials = None
+        self._service = None
+        self._email = None
+        self._wake = threading.Event()
+        self._thread = None
+        self._closed = False
+        self._stats = {"refreshes": 0, "refresh_failures": 0, "last_refresh": None}
+
+    # ── state ──
+
+    def get(self):
+        """The current credentials, or None when not logged in."""
+        if not self._loaded:
+            self._load()
+        return self._credentials
+
+    def is_authenticated(self):
+        credentials = self.get()
+        return credentials is not None and (credentials.valid or bool(credentials.refresh_token))
+
+    @property
+    def email(self):
+        """Address of the account (fetched from the profile once)."""
+        if self._email is None and self.get() is not None:
+            try:
+                profile = self.service().users().getProfile(userId='me').execute()
+                self._email = profile.get('emailAddress')
+            except Exception as e:
+                print(f"[Gmail] Could not read profile: {e}", flush=True)
+        return self._email
+
+    def service(self):
+        """Gmail API service for the current credentials, built once."""
+        credentials = self.get()
+        if credentials is None:
+            return None
+        with self._lock:
+            if self._service is None:
+                def request_builder(http, *args, **kwargs):
+                    # httplib2.Http is not thread-safe: one per request
+                    return HttpRequest(
+                        google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http()),
+                        *args, **kwargs
+                    )
+                self._service = build(
+                    'gmail', 'v1', requestBuilder=request_builder,
+                    http=google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http()),
+                    cache_discovery=False,
+                )
+                print("[Gmail] Service initialized successfully")
+            return self._service
+
+    def set(self, credentials, email=None):
+        """Use freshly obtained credentials (after OAuth) and save them."""
+        with self._lock:
+            self._credentials = credentials
+            self._service = None
+            self._email = email
+            self._loaded = True
+        self._save(credentials)
+        self._schedule()
+
+    def clear(self):
+        """Forget the credentials and delete the stored token."""
+        with self._lock:
+            self._credentials = None
+            self._service = None
+            self._email = None
+            self._loaded = True
+        self.store.clear()
+        self._wake.set()
+
+    def close(self):
+        """Stop the refresh thread (the stored token is kept)."""
+        self._closed = True
+        self._wake.set()
+
+    # ── token storage ──
+
+    def _load(self):
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+            try:
+                token_data = self.store.load()
+                if not token_data:
+                    return
+                credentials = Credentials(
+                    token=token_data.get('token'),
+                    refresh_token=token_data.get('refresh_token'),
+                    token_uri=token_data.get('token_uri'),
+                    client_id=token_data.get('client_id'),
+                    client_secret=token_data.get('client_secret'),
+                    scopes=token_data.get('scopes') or self.scopes
+                )
+                if token_data.get('expiry'):
+                    credentials.expiry = datetime.fromisoformat(token_data['expiry'])
+                self._credentials = credentials
+            except Exception as e:
+                print(f"Error loading credentials: {e}")
+                return
+        self._schedule()
+
+    def _save(self, credentials):
+        token_data = {
+            'token': credentials.token,
+            'refresh_token': credentials.refresh_token,
+            'token_uri': credentials.token_uri,
+            'client_id': credentials.client_id,
+            'client_secret': credentials.client_secret,
+            'scopes': credentials.scopes,
+            # naive UTC, as google-auth keeps it
+            'expiry': credentials.expiry.isoformat() if credentials.expiry else None,
+        }
+        self.store.save(token_data)
+
+    # ── refresh ──
+
+    def refresh(self):
+        """Refresh the access token now; True on success.
+
+        A concurrent caller waits for the running refresh instead of
+        starting a second one.
+        """
+        credentials = self.get()
+        if credentials is None or not credentials.refresh_token:
+            return False
+        with self._refresh_lock:
+            if credentials is not self._credentials:
+                return self._credentials is not None
+            if credentials.expiry and credentials.expiry - datetime.utcnow() > timedelta(seconds=self.refresh_margin):
+                return True  # refreshed while we waited for the lock
+            try:
+                credentials.refresh(Request())
+            except RefreshError as e:
+                # Revoked or expired refresh token: only a new login helps
+                print(f"[Gmail] Token refresh rejected: {e}", flush=True)
+                self._stats["refresh_failures"] += 1
+                self.clear()
+                return False
+            except Exception as e:
+                print(f"[Gmail] Token refresh failed, will retry: {e}", flush=True)
+                self._stats["refresh_failures"] += 1
+                return False
+            self._stats["refreshes"] += 1
+            self._stats["last_refresh"] = datetime.utcnow().isoformat()
+            self._save(credentials)
+            return True
+
+    def _seconds_until_refresh(self):
+        credentials = self._credentials
+        if credentials is None or credentials.expiry is None:
+            # Unknown expiry (older token file): refresh to learn it
+            return 0.0
+        return (credentials.expiry - datetime.utcnow()).total_seconds() - self.refresh_margin
+
+    def _schedule(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._refresher, name="gmail-token-refresh", daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def _refresher(self):
+        while not self._closed:
+            self._wake.clear()
+            if self._credentials is None or not self._credentials.refresh_token:
+                self._wake.wait()
+                continue
+            delay = self._seconds_until_refresh()
+            if delay > 0:
+                # Woken early when credentials are replaced or cleared
+                self._wake.wait(timeout=delay)
+                continue
+            if not self.refresh():
+                self._wake.wait(timeout=self.retry_delay)
+
+    def stats(self):
+        credentials = self._credentials
+        expires_in = None
+        if credentials is not None and credentials.expiry is not None:
+            expires_in = round((credentials.expiry - datetime.utcnow()).total_seconds())
+        return {"authenticated": credentials is not None, "expires_in": expires_in, **self._stats}
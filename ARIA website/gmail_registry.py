@@ -0,0 +1,193 @@
+"""One Gmail client per connected GmailAccount.
+
+Tokens live on the GmailAccount rows instead of a single ``token.json``, so
+any number of mailboxes can be connected and synced side by side. Clients
+are built on first use and dropped after ``idle_seconds`` without use; all
+accounts share one bounded pool of fetcher threads.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from gmail_credentials import CredentialManager
+from gmail_service import GmailService
+from models import db, GmailAccount
+
+DEFAULT_TOKEN_URI = 'https://oauth2.googleapis.com/token'
+
+
+def load_client_config(credentials_file):
+    """``(client_id, client_secret, token_uri)`` from an OAuth client secrets file."""
+    with open(credentials_file, 'r') as f:
+        config = json.load(f)
+    client = config.get('web') or config.get('installed') or {}
+    return client.get('client_id'), client.get('client_secret'), client.get('token_uri', DEFAULT_TOKEN_URI)
+
+
+class AccountTokenStore:
+    """Token data kept on a GmailAccount row (CredentialManager store)."""
+
+    def __init__(self, app, account_id, client_config):
+        self.app = app
+        self.account_id = account_id
+        self.client_id, self.client_secret, self.token_uri = client_config
+
+    def load(self):
+        with self.app.app_context():
+            account = db.session.get(GmailAccount, self.account_id)
+            if account is None or not (account.access_token or account.refresh_token):
+                return None
+            return {
+                'token': account.access_token or None,
+                'refresh_token': account.refresh_token,
+                'token_uri': self.token_uri,
+                'client_id': self.client_id,
+                'client_secret': self.client_secret,
+                'expiry': account.token_expiry.isoformat() if account.token_expiry else None,
+            }
+
+    def save(self, token_data):
+        with self.app.app_context():
+            account = db.session.get(GmailAccount, self.account_id)
+            if account is None:
+                return
+            account.access_token = token_data.get('token') or ''
+            if token_data.get('refresh_token'):
+                account.refresh_token = token_data['refresh_token']
+            expiry = token_data.get('expiry')
+            account.token_expiry = datetime.fromisoformat(expiry) if expiry else None
+            db.session.commit()
+
+    def clear(self):
+        with self.app.app_context():
+            account = db.session.get(GmailAccount, self.account_id)
+            if account is None:
+                return
+            account.access_token = ''
+            account.refresh_token = None
+            account.token_expiry = None
+            db.session.commit()
+
+
+class GmailServiceRegistry:
+    """Lazily built, idle-evicted GmailService per account id.
+
+    get() returns the account's client (building it from the tokens on its
+    GmailAccount row) or None if the account has no usable tokens. ``pool``
+    is the executor every account's fetches run on; its size bounds how
+    many Gmail syncs run at once across all accounts.
+    """
+
+    def __init__(self, app, credentials_file, scopes, batch_size=50,
+                 idle_seconds=1800, max_fetchers=4, refresh_margin=300):
+        self.app = app
+        self.credentials_file = credentials_file
+        self.scopes = scopes
+        self.batch_size = batch_size
+        self.idle_seconds = idle_seconds
+        self.refresh_margin = refresh_margin
+        self.pool = ThreadPoolExecutor(max_workers=max(1, max_fetchers), thread_name_prefix='gmail-fetch')
+        self.max_fetchers = max(1, max_fetchers)
+        self._lock = threading.Lock()
+        self._services = OrderedDict()  # account id -> [GmailService, last used]
+        self._client_config = None
+        self.created = 0
+        self.evicted = 0
+
+    def _client(self):
+        if self._client_config is None:
+            self._client_config = load_client_config(self.credentials_file)
+        return self._client_config
+
+    def _build(self, account_id):
+        credentials = CredentialManager(
+            AccountTokenStore(self.app, account_id, self._client()), self.scopes,
+            refresh_margin=self.refresh_margin,
+        )
+        return GmailService(batch_size=self.batch_size, credentials=credentials, name=f'gmail:{account_id}')
+
+    def get(self, account_id):
+        """The account's GmailService, or None when it is not authenticated."""
+        now = time.time()
+        with self._lock:
+            idle = self._evict_idle(now)
+            entry = self._services.get(account_id)
+            if entry is None:
+                try:
+                    entry = [self._build(account_id), now]
+                except Exception as e:
+                    print(f"[Gmail] Cannot create client for account {account_id}: {e}", flush=True)
+                    entry = None
+                else:
+                    self._services[account_id] = entry
+                    self.created += 1
+            if entry is not None:
+                entry[1] = now
+                self._services.move_to_end(account_id)
+        for service in idle:
+            service.close()
+        if entry is None:
+            return None
+        service = entry[0]
+        return service if service.is_authenticated() else None
+
+    def _evict_idle(self, now):
+        # Least recently used first; stop at the first one still in use
+        idle = []
+        while self._services:
+            account_id, (service, last_used) = next(iter(self._services.items()))
+            if now - last_used < self.idle_seconds:
+                break
+            del self._services[account_id]
+            idle.append(service)
+        self.evicted += len(idle)
+        return idle
+
+    def set_credentials(self, account_id, credentials, email=None):
+        """Use freshly obtained OAuth credentials for the account (saves them)."""
+        with self._lock:
+            entry = self._services.get(account_id)
+            if entry is None:
+                entry = [self._build(account_id), time.time()]
+                self._services[account_id] = entry
+                self.created += 1
+        entry[0].credentials.set(credentials, email)
+
+    def remove(self, account_id, clear=False):
+        """Drop the account's client; ``clear`` also deletes its stored tokens."""
+        with self._lock:
+            entry = self._services.pop(account_id, None)
+        if entry is not None:
+            if clear:
+                entry[0].credentials.clear()
+            entry[0].close()
+        elif clear:
+            AccountTokenStore(self.app, account_id, (None, None, None)).clear()
+
+    def stats(self):
+        with self._lock:
+            services = dict(self._services)
+        return {
+            "clients": len(services),
+            "created": self.created,
+            "evicted": self.evicted,
+            "max_fetchers": self.max_fetchers,
+            "accounts": {str(account_id): service.credentials.stats()
+                         for account_id, (service, _) in services.items()},
+        }
+
+
+def create_registry(app, gmail):
+    """Registry configured from the environment, sharing ``gmail``'s client secrets and scopes."""
+    return GmailServiceRegistry(
+        app, gmail.credentials_file, gmail.scopes,
+        batch_size=gmail.batch_size,
+        idle_seconds=int(os.environ.get("GMAIL_CLIENT_IDLE_SECONDS", "1800")),
+        max_fetchers=int(os.environ.get("GMAIL_FETCH_WORKERS", "4")),
+        refresh_margin=int(os.environ.get("GMAIL_TOKEN_REFRESH_MARGIN", "300")),
+    )
@@ -2,19 +2,44 @@
 
 import os
 import base64
-import json
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
+import random
+import time
 from google.auth.exceptions import RefreshError
 from google_auth_oauthlib.flow import Flow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from pathlib import Path
+from gmail_credentials import CredentialManager, TokenFileStore
+from singleflight import SingleFlight
+
+
+# Headers requested in 'metadata' mode (list views do not need bodies)
+METADATA_HEADERS = ['Subject', 'From', 'Date']
+# Gmail reasons behind a 403 that go away if we wait
+_RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'dailyLimitExceeded')
+
+
+def is_retryable(error):
+    """False for Gmail errors another attempt cannot fix (bad address, forbidden, ...)."""
+    if isinstance(error, HttpError):
+        status = error.resp.status
+        if status == 429 or status >= 500:
+            return True
+        if status == 403:
+            return any(reason in str(error) for reason in _RATE_LIMIT_REASONS)
+        return False
+    # Network errors, expired tokens being refreshed, ...
+    return True
 
 
 class GmailService:
-    """Handle Gmail authentication and operations."""
+    """Handle Gmail authentication and operations.
+    
+    Without ``credentials`` the instance uses the single-account
+    ``token.json``; gmail_registry passes a CredentialManager per account.
+    """
     
-    def __init__(self):
+    def __init__(self, batch_size=50, credentials=None, name='gmail'):
         self.credentials_file = Path(__file__).resolve().parent / 'credentials.json'
         self.token_file = Path(__file__).resolve().parent / 'token.json'
         self.scopes = [
@@ -22,7 +47,18 @@ class GmailService:
             'https://www.googleapis.com/auth/gmail.send',
             'https://www.googleapis.com/auth/gmail.modify'
         ]
+        # Set to use a prebuilt service instead of the credential manager's
         self.service = None
+        # Credentials, service and profile email stay in memory and are
+        # refreshed in the background before they expire
+        self.credentials = credentials or CredentialManager(
+            TokenFileStore(self.token_file), self.scopes,
+            refresh_margin=int(os.environ.get("GMAIL_TOKEN_REFRESH_MARGIN", "300")),
+        )
+        # Messages per batch HTTP request (Gmail allows up to 100, advises 50)
+        self.batch_size = max(1, min(100, batch_size))
+        # Concurrent identical calls (several tabs polling) share one round trip
+        self._flights = SingleFlight(name)
     
     def get_auth_url(self):
         """Get the authorization URL for Gmail OAuth."""
@@ -72,18 +108,16 @@ class GmailService:
             credentials = flow.credentials
             print(f"[Gmail] ✅ Токен получен успешно")
             
-            # Save token for later use
-            self._save_credentials(credentials)
-            print(f"[Gmail] ✅ Токен сохранён в token.json")
-            
             email = self._get_email_from_credentials(credentials)
             print(f"[Gmail] ✅ Email из профиля: {email}")
             
+            # The caller stores them with the account (see gmail_registry)
             return {
                 "success": True,
                 "email": email,
                 "token": credentials.token,
-                "refresh_token": credentials.refresh_token
+                "refresh_token": credentials.refresh_token,
+                "credentials": credentials
             }
         except Exception as e:
             print(f"[Gmail] ❌ Ошибка обмена кода: {e}")
@@ -91,68 +125,38 @@ class GmailService:
             traceback.print_exc()
             return {"error": str(e)}
     
-    def _save_credentials(self, credentials):
+    def _save_credentials(self, credentials, email=None):
         """Save credentials to file for later use."""
-        token_data = {
-            'token': credentials.token,
-            'refresh_token': credentials.refresh_token,
-            'token_uri': credentials.token_uri,
-            'client_id': credentials.client_id,
-            'client_secret': credentials.client_secret,
-            'scopes': credentials.scopes
-        }
-        
-        with open(self.token_file, 'w') as f:
-            json.dump(token_data, f)
+        self.credentials.set(credentials, email)
     
     def _load_credentials(self):
-        """Load saved credentials from file."""
-        if not self.token_file.exists():
-            return None
-        
-        try:
-            with open(self.token_file, 'r') as f:
-                token_data = json.load(f)
-            
-            credentials = Credentials(
-                token=token_data.get('token'),
-                refresh_token=token_data.get('refresh_token'),
-                token_uri=token_data.get('token_uri'),
-                client_id=token_data.get('client_id'),
-                client_secret=token_data.get('client_secret'),
-                scopes=token_data.get('scopes')
-            )
-            
-            # Refresh if needed
-            if credentials.expired and credentials.refresh_token:
-                credentials.refresh(Request())
-                self._save_credentials(credentials)
-            
-            return credentials
-        except Exception as e:
-            print(f"Error loading credentials: {e}")
-            return None
+        """Saved credentials (kept in memory after the first read)."""
+        return self.credentials.get()
     
     def get_service(self):
         """Get Gmail service instance."""
         if self.service is not None:
             return self.service
         
-        credentials = self._load_credentials()
-        if credentials is None:
+        if self.credentials.get() is None:
             print("[Gmail] No valid credentials found")
             return None
         
         try:
-            self.service = build('gmail', 'v1', credentials=credentials)
-            print("[Gmail] Service initialized successfully")
-            return self.service
+            return self.credentials.service()
         except Exception as e:
             print(f"[Gmail] Error building service: {e}")
             return None
     
-    def get_emails(self, max_results=10):
-        """Fetch emails from Gmail inbox."""
+    def get_emails(self, max_results=10, format='full'):
+        """Fetch emails from Gmail inbox.
+        
+        ``format`` is 'full' (with bodies) or 'metadata' (subject, sender,
+        date and snippet only, for list views).
+        """
+        return self._flights.do(('get_emails', max_results, format), self._get_emails, max_results, format)
+    
+    def _get_emails(self, max_results, format):
         service = self.get_service()
         if service is None:
             return {"error": "Not authenticated with Gmail"}
@@ -164,15 +168,10 @@ class GmailService:
                 q='in:inbox'
             ).execute()
             
-            messages = results.get('messages', [])
-            emails = []
+            message_ids = [m['id'] for m in results.get('messages', [])]
+            emails = self.fetch_messages(service, message_ids, format=format)
             
-            for message in messages:
-                email_data = self._get_message_details(service, message['id'])
-                if email_data:
-                    emails.append(email_data)
-            
-            print(f"[Gmail] Fetched {len(emails)} emails from inbox")
+            print(f"[Gmail] Fetched {len(emails)} emails from inbox ({format})")
             return {"emails": emails}
         except RefreshError as e:
             # Token expired and couldn't refresh
@@ -185,15 +184,178 @@ class GmailService:
             traceback.print_exc()
             return {"error": str(e)}
     
-    def _get_message_details(self, service, message_id):
-        """Get details of a specific email message."""
-        try:
-            message = service.users().messages().get(
+    def list_message_ids(self, max_results=50, query='in:inbox'):
+        """IDs of the newest messages matching ``query``, newest first."""
+        service = self.get_service()
+        if service is None:
+            return None
+        ids = []
+        page_token = None
+        while len(ids) < max_results:
+            results = service.users().messages().list(
                 userId='me',
-                id=message_id,
-                format='full'
+                maxResults=min(500, max_results - len(ids)),
+                q=query,
+                pageToken=page_token
             ).execute()
-            
+            ids.extend(m['id'] for m in results.get('messages', []))
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+        return ids
+    
+    def get_history_id(self):
+        """Current mailbox historyId (starting point for get_history)."""
+        service = self.get_service()
+        if service is None:
+            return None
+        return service.users().getProfile(userId='me').execute().get('historyId')
+    
+    def get_history(self, start_history_id):
+        """Changes since ``start_history_id`` via users.history.list.
+        
+        Returns ``{"history_id", "added", "deleted", "labels"}``: ``added``
+        and ``labels`` map message IDs to their current labelIds, ``deleted``
+        is a set of IDs. Returns None when the start ID is too old for Gmail
+        to answer (HTTP 404) and a full resync is needed.
+        """
+        service = self.get_service()
+        if service is None:
+            return None
+        changes = {"history_id": start_history_id, "added": {}, "deleted": set(), "labels": {}}
+        page_token = None
+        while True:
+            try:
+                results = service.users().history().list(
+                    userId='me',
+                    startHistoryId=start_history_id,
+                    historyTypes=['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved'],
+                    pageToken=page_token
+                ).execute()
+            except HttpError as e:
+                if e.resp.status == 404:
+                    return None
+                raise
+            for record in results.get('history', []):
+                for item in record.get('messagesAdded', []):
+                    msg = item['message']
+                    changes["added"][msg['id']] = msg.get('labelIds', [])
+                for item in record.get('messagesDeleted', []):
+                    changes["deleted"].add(item['message']['id'])
+                for key in ('labelsAdded', 'labelsRemoved'):
+                    for item in record.get(key, []):
+                        msg = item['message']
+                        changes["labels"][msg['id']] = msg.get('labelIds', [])
+            changes["history_id"] = results.get('historyId', changes["history_id"])
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return changes
+    
+    def watch(self, topic_name, label_ids=('INBOX',)):
+        """Ask Gmail to publish mailbox changes to a Cloud Pub/Sub topic.
+        
+        Returns the users.watch response (``historyId`` and ``expiration`` in
+        ms); the watch lasts 7 days and has to be renewed.
+        """
+        service = self.get_service()
+        if service is None:
+            raise RuntimeError("Not authenticated with Gmail")
+        return service.users().watch(
+            userId='me',
+            body={'topicName': topic_name, 'labelIds': list(label_ids)}
+        ).execute()
+    
+    def batch_modify(self, message_ids, add_label_ids=(), remove_label_ids=()):
+        """Add/remove labels on up to 1000 messages in one users.messages.batchModify call."""
+        service = self.get_service()
+        if service is None:
+            raise RuntimeError("Not authenticated with Gmail")
+        service.users().messages().batchModify(userId='me', body={
+            'ids': list(message_ids),
+            'addLabelIds': list(add_label_ids),
+            'removeLabelIds': list(remove_label_ids),
+        }).execute()
+    
+    def _message_request(self, service, message_id, format):
+        if format == 'metadata':
+            return service.users().messages().get(
+                userId='me', id=message_id, format='metadata', metadataHeaders=METADATA_HEADERS
+            )
+        return service.users().messages().get(userId='me', id=message_id, format='full')
+    
+    def fetch_messages(self, service, message_ids, format='full', max_attempts=4,
+                       base_delay=1.0, max_delay=8.0):
+        """Fetch many messages in batch HTTP requests, keeping the input order.
+        
+        Each chunk of ``batch_size`` messages is one round trip, so the time
+        follows the slowest message in a chunk instead of the sum of all of
+        them. Items the batch could not return for a retryable reason (rate
+        limits, server errors) and chunks whose batch call failed are
+        retried together, in batches half the previous size, after a
+        jittered exponential backoff (``base_delay`` doubling up to
+        ``max_delay``), for up to ``max_attempts`` rounds. Messages that
+        fail for good are left out.
+        """
+        fetched = {}
+        failed = []
+        
+        def on_response(request_id, response, exception):
+            if exception is None:
+                fetched[request_id] = response
+            elif is_retryable(exception):
+                failed.append(request_id)
+            else:
+                print(f"[Gmail] Cannot fetch message {request_id}: {exception}")
+        
+        pending = list(message_ids)
+        batch_size = self.batch_size
+        for attempt in range(1, max_attempts + 1):
+            failed.clear()
+            for start in range(0, len(pending), batch_size):
+                chunk = pending[start:start + batch_size]
+                batch = service.new_batch_http_request(callback=on_response)
+                for message_id in chunk:
+                    batch.add(self._message_request(service, message_id, format), request_id=message_id)
+                try:
+                    batch.execute()
+                except Exception as e:
+                    if not is_retryable(e):
+                        print(f"[Gmail] Batch request failed: {e}")
+                        continue
+                    failed.extend(m for m in chunk if m not in fetched and m not in failed)
+            if not failed:
+                break
+            if attempt == max_attempts:
+                print(f"[Gmail] Gave up on {len(failed)} messages after {attempt} attempts")
+                break
+            pending = list(failed)
+            batch_size = max(1, batch_size // 2)
+            delay = min(max_delay, base_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+            print(f"[Gmail] {len(pending)} messages not fetched, retrying in {delay:.1f}s "
+                  f"(batches of {batch_size})")
+            time.sleep(delay)
+        
+        emails = []
+        for message_id in message_ids:
+            if message_id in fetched:
+                email_data = self._parse_message(fetched[message_id])
+                if email_data:
+                    emails.append(email_data)
+        return emails
+    
+    def _get_message_details(self, service, message_id, format='full'):
+        """Get details of a specific email message (one round trip)."""
+        try:
+            message = self._message_request(service, message_id, format).execute()
+            return self._parse_message(message)
+        except Exception as e:
+            print(f"Error getting message details: {e}")
+            return None
+    
+    def _parse_message(self, message):
+        """Turn a messages.get response into the dict the app uses."""
+        try:
+            message_id = message['id']
             headers = message['payload'].get('headers', [])
             subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
             from_addr = next((h['value'] for h in headers if h['name'] == 'From'), 'Unknown')
@@ -234,39 +396,41 @@ class GmailService:
                 'subject': subject,
                 'from': from_addr,
                 'date': date,
+                'snippet': message.get('snippet', ''),
+                'internal_date': int(message.get('internalDate', 0) or 0),  # ms since epoch
+                'label_ids': message.get('labelIds', []),
                 'body': final_body  # <--- Больше никакой обрезки в 200 символов!
             }
         except Exception as e:
-            print(f"Error getting message details: {e}")
+            print(f"Error parsing message: {e}")
             return None
     
-    def send_email(self, to, subject, body):
+    def send_email(self, to, subject, body, sender=None):
         """Send an email through Gmail."""
-        service = self.get_service()
-        if service is None:
-            return {"error": "Not authenticated with Gmail"}
-        
         try:
-            message = self._create_message('me', to, subject, body)
-            
-            send_message = service.users().messages().send(
-                userId='me',
-                body=message
-            ).execute()
-            
             return {
                 "success": True,
-                "message_id": send_message['id']
+                "message_id": self.send_message(to, subject, body, sender)
             }
         except Exception as e:
             return {"error": str(e)}
     
+    def send_message(self, to, subject, body, sender=None):
+        """Send an email and return its Gmail message ID; raises on failure.
+        
+        ``sender`` is the From address; without it the profile is asked for it.
+        """
+        service = self.get_service()
+        if service is None:
+            raise RuntimeError("Not authenticated with Gmail")
+        message = self._create_message(sender or 'me', to, subject, body)
+        return service.users().messages().send(userId='me', body=message).execute()['id']
+    
     def _create_message(self, sender, to, subject, message_text):
         """Create a message for sending."""
         from email.mime.text import MIMEText
         
-        credentials = self._load_credentials()
-        user_email = self._get_email_from_credentials(credentials)
+        user_email = sender if '@' in sender else (self.credentials.email or 'unknown@gmail.com')
         
         message = MIMEText(message_text)
         message['to'] = to
@@ -287,10 +451,14 @@ class GmailService:
     
     def _clear_credentials(self):
         """Clear saved credentials."""
-        if self.token_file.exists():
-            self.token_file.unlink()
+        self.credentials.clear()
         self.service = None
     
     def is_authenticated(self):
-        """Check if user is authenticated with Gmail."""
-        return self._load_credentials() is not None
+        """Check if user is authenticated with Gmail (in memory, no I/O)."""
+        return self.credentials.is_authenticated()
+
+    def close(self):
+        """Stop background token refresh and unregister the single-flight group."""
+        self.credentials.close()
+        self._flights.close()
@@ -0,0 +1,102 @@
+"""Hedged-request policies and latency tracking for Gemini calls."""
+
+import threading
+from collections import deque
+
+
+class LatencyTracker:
+    """Rolling latency samples per key (e.g. per model and call kind)."""
+
+    def __init__(self, window=100, min_samples=5):
+        self.window = window
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._samples = {}
+
+    def observe(self, key, seconds):
+        with self._lock:
+            self._samples.setdefault(key, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, key, p):
+        """``p`` in 0..1; None until there are ``min_samples`` samples."""
+        with self._lock:
+            samples = sorted(self._samples.get(key, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+    def stats(self):
+        with self._lock:
+            windows = {key: sorted(samples) for key, samples in self._samples.items()}
+        return {
+            key: {"samples": len(samples),
+                  "p50": round(samples[len(samples) // 2], 3),
+                  "p90": round(samples[min(len(samples) - 1, int(0.9 * len(samples)))], 3)}
+            for key, samples in windows.items() if samples
+        }
+
+
+class HedgePolicy:
+    """When a caller may send a duplicate request, and how many it may send.
+
+    The hedge delay is the ``percentile`` latency seen so far for the call,
+    clamped to ``min_delay``..``max_delay`` (``min_delay`` alone until enough
+    samples exist). The budget is a credit that grows by ``budget_pct`` / 100
+    with every request and is capped at ``burst``; each hedge spends one
+    credit, so hedges stay below ``budget_pct`` % of requests over time.
+    """
+
+    def __init__(self, name, percentile=0.9, budget_pct=10.0, min_delay=1.0,
+                 max_delay=30.0, burst=1.0):
+        self.name = name
+        self.percentile = percentile
+        self.budget_pct = budget_pct
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._credit = burst
+        self.requests = 0
+        self.hedges = 0
+        self.wins = 0
+
+    def delay(self, tracker, key):
+        value = tracker.percentile(key, self.percentile)
+        if value is None:
+            return self.min_delay
+        return min(self.max_delay, max(self.min_delay, value))
+
+    def note_request(self):
+        with self._lock:
+            self.requests += 1
+            self._credit = min(self.burst, self._credit + self.budget_pct / 100.0)
+
+    def try_spend(self):
+        """Take one hedge credit; False when the budget is used up."""
+        with self._lock:
+            if self._credit < 1.0:
+                return False
+            self._credit -= 1.0
+            self.hedges += 1
+            return True
+
+    def refund(self):
+        """Give back a credit taken by try_spend() for a hedge that was not sent."""
+        with self._lock:
+            self._credit = min(self.burst, self._credit + 1.0)
+            self.hedges -= 1
+
+    def note_win(self):
+        with self._lock:
+            self.wins += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "hedges": self.hedges,
+                "hedge_wins": self.wins,
+                "hedge_rate": round(self.hedges / self.requests, 3) if self.requests else 0.0,
+                "budget_pct": self.budget_pct,
+                "percentile": self.percentile,
+            }
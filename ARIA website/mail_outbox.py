@@ -0,0 +1,173 @@
+"""Persistent outgoing mail queue with a bounded pool of background senders."""
+
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from gmail_service import is_retryable
+from models import db, GmailAccount, OutboundEmail
+
+
+def job_to_dict(row):
+    return {
+        'job_id': row.id,
+        'status': row.status,
+        'to': row.to_addr,
+        'subject': row.subject,
+        'attempts': row.attempts,
+        'next_attempt_at': row.next_attempt_at.isoformat() if row.status == 'queued' else None,
+        'error': row.last_error,
+        'message_id': row.gmail_id,
+        'created_at': row.created_at.isoformat() if row.created_at else None,
+        'sent_at': row.sent_at.isoformat() if row.sent_at else None,
+    }
+
+
+class MailOutbox:
+    """Sends queued OutboundEmail rows in the background.
+
+    enqueue() stores the messages and returns at once; a dispatcher thread
+    hands due jobs to at most ``max_concurrent`` sender threads. A failed
+    send is retried with exponential backoff (``base_delay`` doubling up to
+    ``max_delay``, jittered) until ``max_attempts``; errors Gmail will keep
+    returning (invalid recipient, ...) fail the job at once. Every outcome
+    is reported through ``on_status(account_id, job)``. Jobs survive a
+    restart: whatever was being sent when the process stopped is queued
+    again by start().
+    """
+
+    def __init__(self, app, registry, on_status, max_concurrent=4, max_attempts=6,
+                 base_delay=5.0, max_delay=600.0, idle_poll=60.0):
+        self.app = app
+        self.registry = registry
+        self.on_status = on_status
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.idle_poll = idle_poll
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrent, thread_name_prefix='mail-send')
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._loop, name="mail-outbox", daemon=True)
+        self._stats = {"enqueued": 0, "sent": 0, "failed": 0, "retries": 0}
+
+    def start(self):
+        with self.app.app_context():
+            stuck = OutboundEmail.query.filter_by(status='sending').update({'status': 'queued'})
+            db.session.commit()
+        if stuck:
+            print(f"[OUTBOX] Re-queued {stuck} interrupted sends", flush=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+
+    def enqueue(self, account_id, messages):
+        """Queue ``messages`` (dicts with to, subject, body); returns their jobs.
+
+        Uses the caller's session and commits it.
+        """
+        rows = [OutboundEmail(account_id=account_id, to_addr=m['to'], subject=m['subject'], body=m['body'])
+                for m in messages]
+        db.session.add_all(rows)
+        db.session.commit()
+        self._stats["enqueued"] += len(rows)
+        self._wake.set()
+        return [job_to_dict(row) for row in rows]
+
+    def job(self, account_id, job_id):
+        row = OutboundEmail.query.filter_by(id=job_id, account_id=account_id).first()
+        return job_to_dict(row) if row else None
+
+    # ── dispatcher ──
+
+    def _loop(self):
+        while not self._stopped:
+            self._wake.clear()
+            timeout = self.idle_poll
+            with self._lock:
+                free = self.max_concurrent - self._in_flight
+            if free > 0:
+                try:
+                    job_ids, next_due = self._claim(free)
+                except Exception as e:
+                    print(f"[OUTBOX] Could not read the queue: {e}", flush=True)
+                    job_ids, next_due = [], None
+                for job_id in job_ids:
+                    with self._lock:
+                        self._in_flight += 1
+                    self._executor.submit(self._send, job_id)
+                if next_due is not None:
+                    timeout = min(timeout, max(0.0, (next_due - datetime.utcnow()).total_seconds()))
+            # Woken early by enqueue() and by every finished send
+            self._wake.wait(timeout=timeout)
+
+    def _claim(self, limit):
+        """Mark up to ``limit`` due jobs as sending; also returns when the next one is due."""
+        with self.app.app_context():
+            now = datetime.utcnow()
+            rows = OutboundEmail.query.filter(
+                OutboundEmail.status == 'queued', OutboundEmail.next_attempt_at <= now
+            ).order_by(OutboundEmail.next_attempt_at, OutboundEmail.id).limit(limit).all()
+            for row in rows:
+                row.status = 'sending'
+            db.session.commit()
+            next_due = db.session.query(db.func.min(OutboundEmail.next_attempt_at))\
+                .filter(OutboundEmail.status == 'queued').scalar()
+            return [row.id for row in rows], next_due
+
+    def _backoff(self, attempts):
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    def _send(self, job_id):
+        try:
+            with self.app.app_context():
+                row = db.session.get(OutboundEmail, job_id)
+                if row is None:
+                    return
+                account_id = row.account_id
+                account = db.session.get(GmailAccount, row.account_id)
+                gmail = self.registry.get(row.account_id) if account else None
+                row.attempts += 1
+                try:
+                    if gmail is None:
+                        raise RuntimeError("Not authenticated with Gmail")
+                    row.gmail_id = gmail.send_message(row.to_addr, row.subject, row.body, sender=account.email)
+                except Exception as e:
+                    row.last_error = str(e)
+                    if account is not None and is_retryable(e) and row.attempts < self.max_attempts:
+                        row.status = 'queued'
+                        row.next_attempt_at = datetime.utcnow() + timedelta(seconds=self._backoff(row.attempts))
+                        self._stats["retries"] += 1
+                    else:
+                        row.status = 'failed'
+                        self._stats["failed"] += 1
+                    print(f"[OUTBOX] Job {job_id} attempt {row.attempts}: {e} -> {row.status}", flush=True)
+                else:
+                    row.status = 'sent'
+                    row.sent_at = datetime.utcnow()
+                    row.last_error = None
+                    self._stats["sent"] += 1
+                db.session.commit()
+                job = job_to_dict(row)
+            try:
+                self.on_status(account_id, job)
+            except Exception as e:
+                print(f"[OUTBOX] Could not publish job status: {e}", flush=True)
+        except Exception as e:
+            print(f"[OUTBOX] Job {job_id} crashed: {e}", flush=True)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            self._wake.set()
+
+    def stats(self):
+        with self._lock:
+            in_flight = self._in_flight
+        return {"in_flight": in_flight, "max_concurrent": self.max_concurrent, **self._stats}
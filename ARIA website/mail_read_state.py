@@ -0,0 +1,162 @@
+"""Mark cached emails read/unread now, write the change to Gmail later."""
+
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from gmail_service import is_retryable
+from models import db, EmailMessage, ReadStateChange
+
+# users.messages.batchModify accepts at most 1000 IDs
+BATCH_MODIFY_LIMIT = 1000
+_CHUNK = 500
+
+
+class ReadStateQueue:
+    """Write-behind queue of read/unread changes.
+
+    mark() updates the cached rows and records one ReadStateChange per
+    message (a later change to the same message replaces the earlier one)
+    in the same transaction, so the change survives a restart. A flusher
+    thread waits ``flush_delay`` seconds after the first change to let a
+    burst of clicks accumulate, then writes everything due with one
+    ``batchModify`` per account, direction and 1000 IDs. A failed call is
+    retried with exponential backoff up to ``max_attempts``.
+    """
+
+    def __init__(self, app, registry, flush_delay=2.0, max_attempts=8,
+                 base_delay=5.0, max_delay=600.0, idle_poll=300.0):
+        self.app = app
+        self.registry = registry
+        self.flush_delay = flush_delay
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.idle_poll = idle_poll
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._loop, name="read-state-flush", daemon=True)
+        self._stats = {"marked": 0, "flushed": 0, "calls": 0, "retries": 0, "dropped": 0}
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+
+    def mark(self, account_id, gmail_ids, is_read):
+        """Set the read state of cached messages; returns the IDs that changed.
+
+        Uses the caller's session and commits it.
+        """
+        gmail_ids = list(dict.fromkeys(gmail_ids))
+        changed = []
+        for i in range(0, len(gmail_ids), _CHUNK):
+            rows = EmailMessage.query.filter(
+                EmailMessage.account_id == account_id,
+                EmailMessage.gmail_id.in_(gmail_ids[i:i + _CHUNK]),
+                EmailMessage.is_read != is_read,
+            ).all()
+            for row in rows:
+                labels = [label for label in (row.label_ids or '').split(',') if label and label != 'UNREAD']
+                if not is_read:
+                    labels.append('UNREAD')
+                row.label_ids = ','.join(labels)
+                row.is_read = is_read
+                changed.append(row.gmail_id)
+        if changed:
+            now = datetime.utcnow()
+            stmt = sqlite_insert(ReadStateChange)
+            db.session.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=['account_id', 'gmail_id'],
+                    set_={'is_read': stmt.excluded.is_read, 'attempts': 0,
+                          'next_attempt_at': stmt.excluded.next_attempt_at},
+                ),
+                [{'account_id': account_id, 'gmail_id': gmail_id, 'is_read': is_read,
+                  'attempts': 0, 'next_attempt_at': now} for gmail_id in changed],
+            )
+        db.session.commit()
+        if changed:
+            self._stats["marked"] += len(changed)
+            self._wake.set()
+        return changed
+
+    # ── flusher ──
+
+    def _loop(self):
+        timeout = 0.0  # changes left from the last run go out right away
+        while not self._stopped:
+            if self._wake.wait(timeout=timeout):
+                # Let the rest of a burst of clicks arrive
+                time.sleep(self.flush_delay)
+            self._wake.clear()
+            if self._stopped:
+                break
+            try:
+                next_due = self.flush()
+            except Exception as e:
+                print(f"[READ] Flush failed: {e}", flush=True)
+                next_due = None
+            timeout = self.idle_poll
+            if next_due is not None:
+                timeout = min(timeout, max(0.0, (next_due - datetime.utcnow()).total_seconds()))
+
+    def flush(self):
+        """Write every due change to Gmail; returns when the next retry is due."""
+        with self.app.app_context():
+            now = datetime.utcnow()
+            rows = db.session.query(ReadStateChange.account_id, ReadStateChange.is_read,
+                                    ReadStateChange.gmail_id, ReadStateChange.attempts)\
+                .filter(ReadStateChange.next_attempt_at <= now)\
+                .order_by(ReadStateChange.account_id, ReadStateChange.is_read, ReadStateChange.id).all()
+            groups = {}
+            for row in rows:
+                groups.setdefault((row.account_id, row.is_read), []).append(row)
+            for (account_id, is_read), group in groups.items():
+                gmail = self.registry.get(account_id)
+                for i in range(0, len(group), BATCH_MODIFY_LIMIT):
+                    self._write(gmail, account_id, is_read, group[i:i + BATCH_MODIFY_LIMIT])
+            return db.session.query(db.func.min(ReadStateChange.next_attempt_at)).scalar()
+
+    def _write(self, gmail, account_id, is_read, rows):
+        gmail_ids = [row.gmail_id for row in rows]
+        # Only rows still holding the state we sent; a newer click stays queued
+        same = db.and_(
+            ReadStateChange.account_id == account_id,
+            ReadStateChange.gmail_id.in_(gmail_ids),
+            ReadStateChange.is_read == is_read,
+        )
+        try:
+            if gmail is None:
+                raise RuntimeError("Not authenticated with Gmail")
+            self._stats["calls"] += 1
+            if is_read:
+                gmail.batch_modify(gmail_ids, remove_label_ids=['UNREAD'])
+            else:
+                gmail.batch_modify(gmail_ids, add_label_ids=['UNREAD'])
+        except Exception as e:
+            attempts = max(row.attempts for row in rows) + 1
+            if is_retryable(e) and attempts < self.max_attempts:
+                delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+                ReadStateChange.query.filter(same).update({
+                    'attempts': attempts,
+                    'next_attempt_at': datetime.utcnow() + timedelta(seconds=delay),
+                }, synchronize_session=False)
+                self._stats["retries"] += 1
+                print(f"[READ] batchModify of {len(rows)} messages failed, retry {attempts}: {e}", flush=True)
+            else:
+                ReadStateChange.query.filter(same).delete(synchronize_session=False)
+                self._stats["dropped"] += len(rows)
+                print(f"[READ] Dropped {len(rows)} read-state changes: {e}", flush=True)
+        else:
+            ReadStateChange.query.filter(same).delete(synchronize_session=False)
+            self._stats["flushed"] += len(rows)
+        db.session.commit()
+
+    def stats(self):
+        return dict(self._stats)
@@ -0,0 +1,589 @@
+"""Incremental Gmail -> SQLite inbox sync based on Gmail history IDs."""
+
+import base64
+import json
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from cursors import decode_cursor, encode_cursor
+from email_search import index_messages
+from email_text import compress_body, decompress_body, derive_text
+from models import db, GmailAccount, EmailMessage, EmailBody, ReadStateChange
+from singleflight import SingleFlight
+
+# Messages fetched on a full resync (first sync or expired history ID)
+FULL_SYNC_LIMIT = 50
+# IDs per IN (...) lookup; stays far below SQLite's bound-variable limit
+INGEST_CHUNK = 500
+
+
+def _received_at(email_data):
+    ms = email_data.get('internal_date') or 0
+    return datetime.utcfromtimestamp(ms / 1000.0) if ms else datetime.utcnow()
+
+
+def _apply_labels(row, label_ids):
+    row.label_ids = ','.join(label_ids)
+    row.is_read = 'UNREAD' not in label_ids
+
+
+def _with_pending_reads(account_id, labels):
+    """``labels`` (gmail_id -> label_ids from Gmail) with queued read/unread
+    clicks applied: until mail_read_state has written a click to Gmail, a
+    sync must not revert it in the cache."""
+    gmail_ids = list(labels)
+    pending = {}
+    for i in range(0, len(gmail_ids), INGEST_CHUNK):
+        pending.update(db.session.query(ReadStateChange.gmail_id, ReadStateChange.is_read).filter(
+            ReadStateChange.account_id == account_id,
+            ReadStateChange.gmail_id.in_(gmail_ids[i:i + INGEST_CHUNK]),
+        ))
+    if not pending:
+        return labels
+    labels = dict(labels)
+    for gmail_id, is_read in pending.items():
+        label_ids = [label for label in labels[gmail_id] if label != 'UNREAD']
+        labels[gmail_id] = label_ids if is_read else label_ids + ['UNREAD']
+    return labels
+
+
+def _known_labels(account_id, gmail_ids):
+    """gmail_id -> label_ids for the cached ones among ``gmail_ids``."""
+    known = {}
+    for i in range(0, len(gmail_ids), INGEST_CHUNK):
+        known.update(db.session.query(EmailMessage.gmail_id, EmailMessage.label_ids).filter(
+            EmailMessage.account_id == account_id,
+            EmailMessage.gmail_id.in_(gmail_ids[i:i + INGEST_CHUNK]),
+        ))
+    return known
+
+
+def ingest_messages(account_id, emails):
+    """Insert or update parsed Gmail messages (GmailService format) in bulk.
+
+    One IN lookup per INGEST_CHUNK IDs finds the cached messages, then a
+    single executemany of ``INSERT ... ON CONFLICT DO UPDATE`` writes the new
+    ones and those whose labels changed; unchanged messages are skipped.
+    Gmail messages are immutable apart from their labels, so a conflict only
+    updates ``label_ids``/``is_read``. The plain text, preview and word count
+    are derived here; the raw body itself goes compressed into EmailBody.
+    Read/unread clicks still queued for Gmail win over Gmail's labels.
+    New messages are added to the search index in the same transaction.
+    Does not commit. Returns the Gmail IDs that were ``inserted`` and
+    ``updated`` and the ``unchanged`` count.
+    """
+    emails = list({e['id']: e for e in emails}.values())
+    result = {"inserted": [], "updated": [], "unchanged": 0}
+    if not emails:
+        return result
+    known = _known_labels(account_id, [e['id'] for e in emails])
+    gmail_labels = _with_pending_reads(account_id, {e['id']: e.get('label_ids', []) for e in emails})
+    now = datetime.utcnow()
+    rows = []
+    raw_bodies = {}
+    for email_data in emails:
+        label_ids = ','.join(gmail_labels[email_data['id']])
+        if email_data['id'] not in known:
+            result["inserted"].append(email_data['id'])
+        elif known[email_data['id']] != label_ids:
+            result["updated"].append(email_data['id'])
+        else:
+            result["unchanged"] += 1
+            continue
+        body = email_data.get('body', '')
+        text, preview, word_count = derive_text(body)
+        if email_data['id'] not in known and body:
+            raw_bodies[email_data['id']] = body
+        rows.append({
+            'gmail_id': email_data['id'],
+            'account_id': account_id,
+            'sender': email_data.get('from', 'Unknown'),
+            'subject': email_data.get('subject', 'No Subject'),
+            'body_text': text,
+            'preview': preview,
+            'word_count': word_count,
+            'received_at': _received_at(email_data),
+            'fetched_at': now,
+            'label_ids': label_ids,
+            'is_read': 'UNREAD' not in gmail_labels[email_data['id']],
+        })
+    if rows:
+        stmt = sqlite_insert(EmailMessage.__table__)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['gmail_id', 'account_id'],
+            set_={
+                'label_ids': stmt.excluded.label_ids,
+                'is_read': stmt.excluded.is_read,
+                'fetched_at': stmt.excluded.fetched_at,
+            },
+        )
+        db.session.execute(stmt, rows)
+        _store_raw_bodies(account_id, raw_bodies)
+        index_messages(account_id, result["inserted"])
+    return result
+
+
+def _store_raw_bodies(account_id, bodies):
+    """Compress and store raw bodies (gmail_id -> body) of just-inserted messages."""
+    gmail_ids = list(bodies)
+    for i in range(0, len(gmail_ids), INGEST_CHUNK):
+        row_ids = db.session.query(EmailMessage.gmail_id, EmailMessage.id).filter(
+            EmailMessage.account_id == account_id,
+            EmailMessage.gmail_id.in_(gmail_ids[i:i + INGEST_CHUNK]),
+        ).all()
+        values = []
+        for gmail_id, row_id in row_ids:
+            encoding, data = compress_body(bodies[gmail_id])
+            values.append({'message_id': row_id, 'encoding': encoding, 'data': data,
+                           'size': len(bodies[gmail_id].encode('utf-8'))})
+        if values:
+            db.session.execute(sqlite_insert(EmailBody.__table__).prefix_with('OR REPLACE'), values)
+
+
+def load_body(row):
+    """Original body of a cached message, decompressed (plain text for rows without one)."""
+    raw = db.session.get(EmailBody, row.id)
+    if raw is not None:
+        return decompress_body(raw.data, raw.encoding)
+    return row.body or row.body_text or ''
+
+
+def ensure_body_storage(batch=200):
+    """Set up EmailBody cleanup and move legacy inline bodies into it.
+
+    Rows cached before bodies were split out still carry the raw body in
+    ``email_messages.body``; derive their text columns, store the body
+    compressed and clear the inline copy. Call inside an app context after
+    the tables exist.
+    """
+    db.session.execute(db.text(
+        "CREATE TRIGGER IF NOT EXISTS email_bodies_delete AFTER DELETE ON email_messages "
+        "BEGIN DELETE FROM email_bodies WHERE message_id = old.id; END"
+    ))
+    db.session.commit()
+    moved = 0
+    table = EmailMessage.__table__
+    clear = table.update().where(table.c.id == db.bindparam('row_id')).values(
+        body=None,
+        body_text=db.bindparam('text'),
+        preview=db.bindparam('short'),
+        word_count=db.bindparam('words'),
+    )
+    while True:
+        rows = db.session.query(EmailMessage.id, EmailMessage.body)\
+            .filter(EmailMessage.body.isnot(None)).limit(batch).all()
+        if not rows:
+            break
+        updates, raws = [], []
+        for row_id, body in rows:
+            text, preview, word_count = derive_text(body)
+            updates.append({'row_id': row_id, 'text': text, 'short': preview, 'words': word_count})
+            if body:
+                encoding, data = compress_body(body)
+                raws.append({'message_id': row_id, 'encoding': encoding, 'data': data,
+                             'size': len(body.encode('utf-8'))})
+        db.session.execute(clear, updates)
+        if raws:
+            db.session.execute(sqlite_insert(EmailBody.__table__).prefix_with('OR REPLACE'), raws)
+        db.session.commit()
+        moved += len(rows)
+    if moved:
+        print(f"[DB] Moved {moved} email bodies to compressed storage", flush=True)
+    return moved
+
+
+def _store_new(gmail, account, message_ids):
+    """Fetch full messages for IDs not cached yet and store them.
+
+    Returns the IDs ingest_messages() inserted and those it updated (cached
+    by someone else in the meantime, with other labels).
+    """
+    if not message_ids:
+        return [], []
+    known = _known_labels(account.id, message_ids)
+    missing = [m for m in message_ids if m not in known]
+    if not missing:
+        return [], []
+    emails = gmail.fetch_messages(gmail.get_service(), missing, format='full')
+    result = ingest_messages(account.id, emails)
+    return result["inserted"], result["updated"]
+
+
+def _full_sync(gmail, account, limit):
+    """Make the cache the newest ``limit`` inbox messages.
+
+    New ones are fetched, cached ones get their labels refreshed (one
+    metadata batch) and every other cached row, which left the inbox or the
+    window while no history was available, is deleted.
+    """
+    # Take the history ID first: anything that arrives while we list is
+    # picked up by the next incremental sync instead of being missed
+    history_id = gmail.get_history_id()
+    message_ids = gmail.list_message_ids(max_results=limit)
+    if message_ids is None:
+        return {"error": "Not authenticated with Gmail"}
+    added, updated = _store_new(gmail, account, message_ids)
+
+    listed = set(message_ids)
+    fresh = set(added) | set(updated)
+    cached = dict(db.session.query(EmailMessage.gmail_id, EmailMessage.label_ids)
+                  .filter(EmailMessage.account_id == account.id))
+    gone = {gmail_id for gmail_id in cached if gmail_id not in listed}
+    known = [gmail_id for gmail_id in message_ids if gmail_id in cached and gmail_id not in fresh]
+    labels = {}
+    if known:
+        for email_data in gmail.fetch_messages(gmail.get_service(), known, format='metadata'):
+            labels[email_data['id']] = email_data.get('label_ids', [])
+        labels = _with_pending_reads(account.id, labels)
+
+    changed = [gmail_id for gmail_id, label_ids in labels.items() if ','.join(label_ids) != cached[gmail_id]]
+    for i in range(0, len(changed), INGEST_CHUNK):
+        rows = EmailMessage.query.filter(
+            EmailMessage.account_id == account.id,
+            EmailMessage.gmail_id.in_(changed[i:i + INGEST_CHUNK]),
+        ).all()
+        for row in rows:
+            if 'INBOX' not in labels[row.gmail_id]:
+                gone.add(row.gmail_id)
+                continue
+            _apply_labels(row, labels[row.gmail_id])
+            updated.append(row.gmail_id)
+
+    deleted = sorted(gone)
+    for i in range(0, len(deleted), INGEST_CHUNK):
+        EmailMessage.query.filter(
+            EmailMessage.account_id == account.id,
+            EmailMessage.gmail_id.in_(deleted[i:i + INGEST_CHUNK]),
+        ).delete(synchronize_session=False)
+
+    account.history_id = history_id
+    return {"mode": "full", "added": added, "updated": updated, "deleted": deleted}
+
+
+def _incremental_sync(gmail, account, changes):
+    # New inbox messages, and messages that came back to the inbox through a
+    # label change (e.g. moved back from the archive) and are not cached yet
+    inbox_ids = [m for m, labels in list(changes["added"].items()) + list(changes["labels"].items())
+                 if 'INBOX' in labels and m not in changes["deleted"]]
+    added, updated = _store_new(gmail, account, list(dict.fromkeys(inbox_ids)))
+
+    gone = set(changes["deleted"])
+    fresh = set(added) | set(updated)
+    relabeled = [m for m in changes["labels"] if m not in fresh]
+    labels_by_id = _with_pending_reads(account.id, {m: changes["labels"][m] for m in relabeled})
+    if relabeled:
+        rows = EmailMessage.query.filter(
+            EmailMessage.account_id == account.id,
+            EmailMessage.gmail_id.in_(relabeled),
+        ).all()
+        for row in rows:
+            labels = labels_by_id[row.gmail_id]
+            if 'INBOX' not in labels:
+                # Archived or moved out of the inbox
+                gone.add(row.gmail_id)
+                continue
+            _apply_labels(row, labels)
+            updated.append(row.gmail_id)
+
+    deleted = []
+    if gone:
+        query = EmailMessage.query.filter(
+            EmailMessage.account_id == account.id,
+            EmailMessage.gmail_id.in_(list(gone)),
+        )
+        deleted = [gmail_id for (gmail_id,) in query.with_entities(EmailMessage.gmail_id)]
+        query.delete(synchronize_session=False)
+
+    account.history_id = changes["history_id"]
+    return {"mode": "incremental", "added": added, "updated": updated, "deleted": deleted}
+
+
+def sync_account(gmail, account, full_limit=FULL_SYNC_LIMIT):
+    """Bring the cached inbox of ``account`` up to date with Gmail.
+
+    Uses users.history.list from the stored history ID, so a sync only costs
+    as much as the mail that changed; falls back to a full resync of the
+    newest ``full_limit`` inbox messages on the first run or when Gmail no
+    longer knows the stored history ID. Commits the session and returns the
+    ``mode`` and the Gmail IDs that were ``added``, ``updated`` and
+    ``deleted``, or ``{"error"}``.
+    """
+    try:
+        changes = gmail.get_history(account.history_id) if account.history_id else None
+        if changes is None:
+            if account.history_id:
+                print(f"[SYNC] {account.email}: history ID expired, full resync")
+            result = _full_sync(gmail, account, full_limit)
+        else:
+            result = _incremental_sync(gmail, account, changes)
+        if "error" in result:
+            db.session.rollback()
+            return result
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    if has_changes(result):
+        print(f"[SYNC] {account.email}: {result['mode']} +{len(result['added'])} "
+              f"~{len(result['updated'])} -{len(result['deleted'])}", flush=True)
+    return result
+
+
+def has_changes(result):
+    return bool(result.get("added") or result.get("updated") or result.get("deleted"))
+
+
+def email_to_dict(row, with_body=False):
+    """Inbox JSON for one cached message, as listed by /api/emails/inbox.
+
+    The list never carries bodies; /api/emails/message/<id> serves them.
+    """
+    data = {
+        'id': row.gmail_id,
+        'subject': row.subject,
+        'from': row.sender,
+        'date': row.received_at.isoformat(),
+        'preview': row.preview or '',
+        'is_read': row.is_read,
+    }
+    if with_body:
+        data['body'] = load_body(row)
+    return data
+
+
+def inbox_page(account_id, limit=50, cursor=None):
+    """One page of the cached inbox, newest first, without bodies.
+
+    Keyset pagination on ``(received_at, id)`` over the composite index:
+    ``cursor`` is the ``next_cursor`` of the previous page, so every page
+    costs the same however deep it is. Raises ValueError for a bad cursor.
+    """
+    query = db.session.query(
+        EmailMessage.id, EmailMessage.gmail_id, EmailMessage.subject, EmailMessage.sender,
+        EmailMessage.received_at, EmailMessage.is_read, EmailMessage.preview,
+    ).filter(EmailMessage.account_id == account_id)
+    if cursor:
+        received_at, row_id = decode_cursor(cursor, 2)
+        try:
+            received_at, row_id = datetime.fromisoformat(received_at), int(row_id)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid cursor")
+        query = query.filter(
+            db.tuple_(EmailMessage.received_at, EmailMessage.id) < db.tuple_(received_at, row_id)
+        )
+    rows = query.order_by(EmailMessage.received_at.desc(), EmailMessage.id.desc()).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    emails = [{
+        'id': r.gmail_id,
+        'subject': r.subject,
+        'from': r.sender,
+        'date': r.received_at.isoformat(),
+        'preview': r.preview or '',
+        'is_read': r.is_read,
+    } for r in rows]
+    next_cursor = None
+    if has_more:
+        next_cursor = encode_cursor(rows[-1].received_at.isoformat(), rows[-1].id)
+    return {"emails": emails, "next_cursor": next_cursor}
+
+
+class MailSyncWorker:
+    """Background sync loop for one GmailAccount.
+
+    Syncs are single-flight: a push, the timer and any number of HTTP
+    requests asking at once share one sync. The interval adapts: it drops
+    to ``min_interval`` after a sync that found changes and doubles up to
+    ``max_interval`` while the inbox is quiet. trigger() wakes the loop early
+    (used by push notifications).
+    """
+
+    def __init__(self, manager, account_id, min_interval, max_interval):
+        self.manager = manager
+        self.account_id = account_id
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._flight = SingleFlight(f"mail_sync:{account_id}")
+        self.last_sync = 0.0
+        self.last_result = None
+        self.syncs = 0
+        self.errors = 0
+        self.watch_expires = 0.0
+        self._thread = threading.Thread(target=self._loop, name=f"mail-sync-{account_id}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        self._flight.close()
+
+    def trigger(self):
+        self._wake.set()
+
+    def sync(self):
+        """Sync now, or join the sync already running; returns its result.
+
+        The sync itself runs on the registry's shared fetcher pool, which
+        bounds how many accounts talk to Gmail at once.
+        """
+        return self._flight.do("sync", lambda: self.manager.registry.pool.submit(self._sync).result())
+
+    def _sync(self):
+        with self.manager.app.app_context():
+            account = db.session.get(GmailAccount, self.account_id)
+            if account is None:
+                self.stop()
+                return {"error": "Gmail account no longer exists"}
+            gmail = self.manager.registry.get(account.id)
+            if gmail is None:
+                return {"error": "Not authenticated with Gmail"}
+            self.manager.ensure_watch(self, account, gmail)
+            try:
+                result = sync_account(gmail, account)
+            except Exception as e:
+                self.errors += 1
+                print(f"[SYNC] {account.email}: sync failed: {e}", flush=True)
+                return {"error": str(e)}
+            self.syncs += 1
+            self.last_sync = time.time()
+            self.last_result = result
+            if has_changes(result):
+                self.interval = self.min_interval
+                self.manager.publish(account, result)
+            elif "error" not in result:
+                self.interval = min(self.max_interval, self.interval * 2)
+            return result
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self._wake.wait(timeout=self.interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            self.sync()
+
+    def stats(self):
+        return {
+            "interval": self.interval,
+            "last_sync": datetime.utcfromtimestamp(self.last_sync).isoformat() if self.last_sync else None,
+            "syncs": self.syncs,
+            "errors": self.errors,
+            "push": self.watch_expires > time.time(),
+            **self._flight.stats(),
+        }
+
+
+class MailSyncManager:
+    """One MailSyncWorker per GmailAccount, plus the push entry point.
+
+    Each account syncs with its own client from ``registry`` (a
+    gmail_registry.GmailServiceRegistry).
+
+    ``on_delta(account, delta)`` is called after every sync that changed the
+    cache, with the new and updated rows as inbox JSON and the deleted IDs.
+    With ``push_topic`` set, workers register a Gmail watch on that Pub/Sub
+    topic and the topic's push subscription should POST to the app's
+    webhook, which calls push(); without it they simply poll.
+    """
+
+    # Gmail watches expire after 7 days; renew a day early
+    WATCH_RENEW_BEFORE = 24 * 3600
+
+    def __init__(self, app, registry, on_delta, min_interval=30.0, max_interval=300.0, push_topic=None):
+        self.app = app
+        self.registry = registry
+        self.on_delta = on_delta
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.push_topic = push_topic
+        self._lock = threading.Lock()
+        self._workers = {}
+        self.pushes = 0
+
+    def worker(self, account_id):
+        """The account's worker, started on first use."""
+        with self._lock:
+            worker = self._workers.get(account_id)
+            if worker is None:
+                worker = MailSyncWorker(self, account_id, self.min_interval, self.max_interval)
+                self._workers[account_id] = worker
+                worker.start()
+            return worker
+
+    def sync_now(self, account_id):
+        return self.worker(account_id).sync()
+
+    def stop(self, account_id):
+        with self._lock:
+            worker = self._workers.pop(account_id, None)
+        if worker is not None:
+            worker.stop()
+
+    def push(self, email_address, history_id=None):
+        """A push notification for ``email_address`` arrived; wake its worker."""
+        with self.app.app_context():
+            account = GmailAccount.query.filter_by(email=email_address).first()
+            if account is None:
+                return False
+            if history_id and account.history_id and int(history_id) <= int(account.history_id):
+                return True  # already synced past this point
+            account_id = account.id
+        self.pushes += 1
+        self.worker(account_id).trigger()
+        return True
+
+    def ensure_watch(self, worker, account, gmail):
+        if not self.push_topic or worker.watch_expires - time.time() > self.WATCH_RENEW_BEFORE:
+            return
+        try:
+            response = gmail.watch(self.push_topic)
+            worker.watch_expires = int(response.get('expiration', 0)) / 1000.0
+            print(f"[SYNC] {account.email}: Gmail push watch active until "
+                  f"{datetime.utcfromtimestamp(worker.watch_expires):%Y-%m-%d %H:%M}", flush=True)
+        except Exception as e:
+            # Polling keeps working; try again on the next sync
+            print(f"[SYNC] {account.email}: could not register Gmail watch: {e}", flush=True)
+
+    def publish(self, account, result):
+        changed = result["added"] + result["updated"]
+        rows = []
+        if changed:
+            rows = EmailMessage.query.filter(
+                EmailMessage.account_id == account.id,
+                EmailMessage.gmail_id.in_(changed),
+            ).all()
+        by_id = {row.gmail_id: email_to_dict(row) for row in rows}
+        delta = {
+            "account": account.email,
+            "added": [by_id[m] for m in result["added"] if m in by_id],
+            "updated": [by_id[m] for m in result["updated"] if m in by_id],
+            "deleted": result["deleted"],
+        }
+        try:
+            self.on_delta(account, delta)
+        except Exception as e:
+            print(f"[SYNC] Could not publish inbox delta: {e}", flush=True)
+
+    def stats(self):
+        with self._lock:
+            workers = dict(self._workers)
+        return {
+            "pushes": self.pushes,
+            "push_topic": bool(self.push_topic),
+            "accounts": {str(account_id): w.stats() for account_id, w in workers.items()},
+        }
+
+
+def decode_pubsub_push(envelope):
+    """``(emailAddress, historyId)`` from a Pub/Sub push request body."""
+    data = (envelope or {}).get("message", {}).get("data", "")
+    payload = json.loads(base64.b64decode(data + "=" * (-len(data) % 4)).decode("utf-8"))
+    return payload.get("emailAddress"), payload.get("historyId")
@@ -0,0 +1,102 @@
+"""Versioned schema migrations for the SQLite database.
+
+The schema version is SQLite's ``PRAGMA user_version``. migrate() runs, in
+order and each in its own transaction, every migration newer than it and
+bumps the version after each one. db.create_all() still creates missing
+tables at their current shape, so a migration only has to change tables
+that may already exist. Migrations must be safe on a freshly created
+database too (it starts at version 0 and runs them all).
+
+To change the schema, append a function decorated with @migration(N, ...)
+using add_column() / create_index() or plain SQL.
+"""
+
+from mail_sync import ensure_body_storage
+from models import db
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    def register(fn):
+        MIGRATIONS.append((version, description, fn))
+        return fn
+    return register
+
+
+def schema_version():
+    return db.session.execute(db.text("PRAGMA user_version")).scalar()
+
+
+def _set_version(version):
+    # PRAGMA does not take bound parameters
+    db.session.execute(db.text(f"PRAGMA user_version = {int(version)}"))
+
+
+def _columns(table):
+    return {row[1] for row in db.session.execute(db.text(f"PRAGMA table_info({table})"))}
+
+
+def add_column(table, name, ddl):
+    """ALTER TABLE ... ADD COLUMN unless the column exists (fresh databases have it)."""
+    if name not in _columns(table):
+        db.session.execute(db.text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+        print(f"[DB] Added column {table}.{name}", flush=True)
+
+
+def create_index(name):
+    """Create the model-declared index ``name`` if it is missing."""
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name == name:
+                index.create(db.session.connection(), checkfirst=True)
+                return
+    raise KeyError(f"No index named {name} in the models")
+
+
+def migrate():
+    """Bring the database up to the latest migration; returns how many ran.
+
+    Call inside an app context after db.create_all().
+    """
+    current = schema_version()
+    ran = 0
+    for version, description, fn in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if version <= current:
+            continue
+        try:
+            fn()
+            _set_version(version)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            print(f"[DB] Migration {version} ({description}) failed", flush=True)
+            raise
+        print(f"[DB] Migrated to schema {version}: {description}", flush=True)
+        ran += 1
+    return ran
+
+
+# ── migrations ──
+
+@migration(1, "columns added before versioned migrations")
+def _legacy_columns():
+    # Databases created by older versions, which added these on startup
+    for name, ddl in (('history_id', 'VARCHAR(32)'),):
+        add_column('gmail_accounts', name, ddl)
+    for name, ddl in (('label_ids', 'VARCHAR(500)'), ('body_text', 'TEXT'),
+                      ('preview', 'VARCHAR(200)'), ('word_count', 'INTEGER')):
+        add_column('email_messages', name, ddl)
+
+
+@migration(2, "move inline email bodies to compressed storage")
+def _body_storage():
+    ensure_body_storage()
+
+
+@migration(3, "composite indexes for inbox, session, cache and read-state queries")
+def _access_path_indexes():
+    for name in ('ix_email_messages_account_received', 'ix_sessions_expires_at',
+                 'ix_cached_responses_created_at', 'ix_read_state_changes_due',
+                 'ix_outbound_emails_status_due'):
+        create_index(name)
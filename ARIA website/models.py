@@ -1,10 +1,45 @@
 """Database models for ARIA email service."""
 
+import sqlite3
+
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from datetime import datetime
 
 db = SQLAlchemy()
 
+
+def sqlite_pragmas(cache_mb=64, mmap_mb=256, busy_timeout_ms=5000):
+    """PRAGMA statements run on every new SQLite connection.
+    
+    WAL lets readers run while the sync thread writes (and writers no longer
+    wait for readers); with WAL, synchronous=NORMAL only fsyncs at
+    checkpoints and stays crash-safe. The page cache is per connection.
+    """
+    return [
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        f"PRAGMA cache_size=-{int(cache_mb * 1024)}",  # negative: KiB
+        f"PRAGMA mmap_size={int(mmap_mb * 1024 * 1024)}",
+        "PRAGMA temp_store=MEMORY",
+        f"PRAGMA busy_timeout={int(busy_timeout_ms)}",
+    ]
+
+
+def enable_sqlite_tuning(**options):
+    """Apply sqlite_pragmas(**options) to every SQLite connection opened from now on."""
+    statements = sqlite_pragmas(**options)
+
+    @event.listens_for(Engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
+
 class User(db.Model):
     """User account model for local email authentication."""
     __tablename__ = 'users'
@@ -31,6 +66,11 @@ class Session(db.Model):
     
     user = db.relationship('User', backref=db.backref('sessions', lazy='dynamic'))
     
+    __table_args__ = (
+        # Expired-session cleanup
+        db.Index('ix_sessions_expires_at', 'expires_at'),
+    )
+    
     def __repr__(self):
         return f'<Session {self.token[:10]}...>'
 
@@ -44,6 +84,7 @@ class GmailAccount(db.Model):
     access_token = db.Column(db.Text, nullable=False)
     refresh_token = db.Column(db.Text, nullable=True)
     token_expiry = db.Column(db.DateTime, nullable=True)
+    history_id = db.Column(db.String(32), nullable=True)  # last synced Gmail historyId
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -60,14 +101,131 @@ class EmailMessage(db.Model):
     account_id = db.Column(db.Integer, db.ForeignKey('gmail_accounts.id'), nullable=False)
     sender = db.Column(db.String(255), nullable=False)
     subject = db.Column(db.String(500), nullable=False)
-    body = db.Column(db.Text, nullable=True)
+    body = db.Column(db.Text, nullable=True)  # legacy inline raw body; moved to EmailBody at startup
+    body_text = db.Column(db.Text, nullable=True)  # plain text derived from the body
+    preview = db.Column(db.String(200), nullable=True)  # first line(s) of body_text for the inbox list
+    word_count = db.Column(db.Integer, nullable=True)
     received_at = db.Column(db.DateTime, nullable=False)
     fetched_at = db.Column(db.DateTime, default=datetime.utcnow)
     is_read = db.Column(db.Boolean, default=False)
+    label_ids = db.Column(db.String(500), nullable=True)  # comma-separated Gmail labelIds
     
     account = db.relationship('GmailAccount', backref=db.backref('emails', lazy='dynamic', cascade='all, delete-orphan'))
     
-    __table_args__ = (db.UniqueConstraint('gmail_id', 'account_id', name='_gmail_id_account_uc'),)
+    __table_args__ = (
+        db.UniqueConstraint('gmail_id', 'account_id', name='_gmail_id_account_uc'),
+        # Inbox listing: newest first per account, keyset on (received_at, id)
+        db.Index('ix_email_messages_account_received', 'account_id', 'received_at', 'id'),
+    )
     
     def __repr__(self):
         return f'<EmailMessage {self.subject[:30]}>'
+
+
+class EmailBody(db.Model):
+    """Original raw body of an EmailMessage, compressed; read only when the message is opened."""
+    __tablename__ = 'email_bodies'
+    
+    message_id = db.Column(db.Integer, db.ForeignKey('email_messages.id'), primary_key=True)
+    encoding = db.Column(db.String(16), nullable=False, default='zlib')
+    data = db.Column(db.LargeBinary, nullable=False)
+    size = db.Column(db.Integer, nullable=False)  # uncompressed length in bytes
+    
+    def __repr__(self):
+        return f'<EmailBody {self.message_id} {self.size}B>'
+
+
+class OutboundEmail(db.Model):
+    """Queued outgoing email; mail_outbox sends it and records the outcome."""
+    __tablename__ = 'outbound_emails'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    account_id = db.Column(db.Integer, db.ForeignKey('gmail_accounts.id'), nullable=False)
+    to_addr = db.Column(db.String(500), nullable=False)
+    subject = db.Column(db.String(500), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(16), nullable=False, default='queued')  # queued / sending / sent / failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.Text, nullable=True)
+    gmail_id = db.Column(db.String(255), nullable=True)  # Gmail message ID once sent
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+    
+    __table_args__ = (
+        # The sender's "what is due" scan
+        db.Index('ix_outbound_emails_status_due', 'status', 'next_attempt_at'),
+    )
+    
+    def __repr__(self):
+        return f'<OutboundEmail {self.id} {self.status}>'
+
+
+class ReadStateChange(db.Model):
+    """Read/unread change made locally and not yet written to Gmail (one row per message)."""
+    __tablename__ = 'read_state_changes'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    account_id = db.Column(db.Integer, db.ForeignKey('gmail_accounts.id'), nullable=False)
+    gmail_id = db.Column(db.String(255), nullable=False)
+    is_read = db.Column(db.Boolean, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.UniqueConstraint('account_id', 'gmail_id', name='_read_state_account_gmail_uc'),
+        # The flusher's "what is due" scan
+        db.Index('ix_read_state_changes_due', 'next_attempt_at'),
+    )
+    
+    def __repr__(self):
+        return f'<ReadStateChange {self.gmail_id} read={self.is_read}>'
+
+
+class CachedResponse(db.Model):
+    """Persisted LLM reply from the response cache."""
+    __tablename__ = 'cached_responses'
+    
+    key = db.Column(db.String(64), primary_key=True)  # sha256 of model + prompt
+    context = db.Column(db.String(64), nullable=False, index=True)
+    tokens = db.Column(db.Text, nullable=False, default='')  # words of the last user turn
+    text = db.Column(db.Text, nullable=False)
+    tags = db.Column(db.String(255), nullable=False, default='')
+    latency = db.Column(db.Float, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    
+    # Startup load of the newest entries
+    __table_args__ = (db.Index('ix_cached_responses_created_at', 'created_at'),)
+    
+    def __repr__(self):
+        return f'<CachedResponse {self.key[:10]}...>'
+
+
+class ConversationTurn(db.Model):
+    """One chat message; append-only log of every conversation."""
+    __tablename__ = 'conversation_turns'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    conversation_id = db.Column(db.String(100), nullable=False)  # "user:<id>", "session:<uuid>", "robot"
+    role = db.Column(db.String(20), nullable=False)  # user / assistant
+    text = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (db.Index('ix_conversation_turns_conv_id', 'conversation_id', 'id'),)
+    
+    def __repr__(self):
+        return f'<ConversationTurn {self.conversation_id} #{self.id}>'
+
+
+class ConversationState(db.Model):
+    """Running summary of a conversation and the last turn it covers."""
+    __tablename__ = 'conversation_states'
+    
+    conversation_id = db.Column(db.String(100), primary_key=True)
+    summary = db.Column(db.Text, nullable=False, default='')
+    summarized_upto = db.Column(db.Integer, nullable=False, default=0)  # ConversationTurn.id
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<ConversationState {self.conversation_id}>'
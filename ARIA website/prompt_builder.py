@@ -0,0 +1,158 @@
+"""Token-budgeted prompt assembly for ARIA's Gemini calls."""
+
+
+def estimate_tokens(text):
+    """Rough token count: ~4 chars per token for ASCII, ~2 for other scripts."""
+    if not text:
+        return 0
+    non_ascii = sum(1 for ch in text if ord(ch) > 127)
+    return (len(text) - non_ascii) // 4 + non_ascii // 2 + 1
+
+
+def _turn_text(turn):
+    return "".join(p.get("text", "") for p in turn.get("parts", []))
+
+
+class _Section:
+    def __init__(self, name, priority, text="", items=None, header="", footer="", min_tokens=0):
+        self.name = name
+        self.priority = priority
+        self.text = text
+        self.items = list(items) if items is not None else None
+        self.header = header
+        self.footer = footer
+        self.min_tokens = min_tokens
+        self.dropped = 0
+        self.trimmed = ""
+
+    def render(self):
+        if self.items is not None:
+            if not self.items:
+                return ""
+            return self.header + "".join(self.items) + self.footer
+        return self.text
+
+    def tokens(self):
+        return estimate_tokens(self.render())
+
+
+class BuiltPrompt:
+    """Result of PromptBuilder.build()."""
+
+    def __init__(self, system_text, contents, report):
+        self.system_text = system_text
+        self.contents = contents
+        self.report = report
+
+
+class PromptBuilder:
+    """Collects prompt sections and trims them to fit an input-token budget.
+
+    Sections are rendered into the system prompt in the order they were
+    added. Each has a priority; ``priority=None`` marks a section that is
+    never trimmed. When the estimated total exceeds the budget the lowest
+    priority part is trimmed first: item sections lose their last item,
+    text sections are truncated down to ``min_tokens`` (and dropped if that
+    is 0), and the conversation history loses its oldest turns (the latest
+    ``min_history_turns`` always stay).
+    """
+
+    TRUNCATED = "\n...[truncated]"
+
+    def __init__(self, budget, history_priority=40, min_history_turns=1):
+        self.budget = budget
+        self.history_priority = history_priority
+        self.min_history_turns = min_history_turns
+        self._sections = []
+        self._history = []
+        self._history_dropped = 0
+
+    def add(self, name, text="", priority=None, items=None, header="", footer="", min_tokens=0):
+        """Add a section; pass ``items`` (plus header/footer) for droppable lists."""
+        if not text and not items:
+            return self
+        self._sections.append(_Section(name, priority, text, items, header, footer, min_tokens))
+        return self
+
+    def set_history(self, contents):
+        """Gemini ``contents`` turns, oldest first; the last one is the new message."""
+        self._history = list(contents)
+        return self
+
+    def _history_tokens(self):
+        return sum(estimate_tokens(_turn_text(t)) for t in self._history)
+
+    def _total(self):
+        return sum(s.tokens() for s in self._sections) + self._history_tokens()
+
+    def _candidates(self):
+        parts = []
+        for s in self._sections:
+            if s.priority is None or not s.render():
+                continue
+            if s.items is None and s.min_tokens and s.tokens() <= s.min_tokens:
+                continue
+            parts.append((s.priority, s))
+        if len(self._history) > self.min_history_turns:
+            parts.append((self.history_priority, "history"))
+        return sorted(parts, key=lambda p: p[0])
+
+    def _trim_section(self, section, excess):
+        if section.items is not None:
+            section.items.pop()
+            section.dropped += 1
+            section.trimmed = f"-{section.dropped} items"
+            return
+        keep_tokens = max(section.min_tokens, section.tokens() - excess)
+        if keep_tokens <= 0 or not section.min_tokens and keep_tokens < 16:
+            section.text = ""
+            section.trimmed = "dropped"
+            return
+        # Cut proportionally in characters, then mark the cut
+        ratio = keep_tokens / max(1, section.tokens())
+        cut = max(0, int(len(section.text) * ratio) - len(self.TRUNCATED))
+        section.text = section.text[:cut] + self.TRUNCATED
+        section.trimmed = "truncated"
+
+    def _trim_history(self):
+        # Drop the oldest turn; keep user/model alternation starting with a user turn
+        self._history.pop(0)
+        self._history_dropped += 1
+        while len(self._history) > self.min_history_turns and self._history[0].get("role") != "user":
+            self._history.pop(0)
+            self._history_dropped += 1
+
+    def build(self):
+        total = self._total()
+        while total > self.budget:
+            candidates = self._candidates()
+            if not candidates:
+                break
+            _priority, part = candidates[0]
+            if part == "history":
+                self._trim_history()
+            else:
+                self._trim_section(part, total - self.budget)
+            total = self._total()
+
+        system_text = "".join(s.render() for s in self._sections)
+        report = {
+            "budget": self.budget,
+            "total": total,
+            "sections": {s.name: s.tokens() for s in self._sections if s.render()},
+            "history": {"turns": len(self._history), "tokens": self._history_tokens()},
+            "trimmed": {s.name: s.trimmed for s in self._sections if s.trimmed},
+        }
+        if self._history_dropped:
+            report["trimmed"]["history"] = f"-{self._history_dropped} turns"
+        return BuiltPrompt(system_text, self._history, report)
+
+
+def format_report(report):
+    """One-line summary of a build() report for the server log."""
+    sections = " ".join(f"{name}={tokens}" for name, tokens in report["sections"].items())
+    line = (f"{report['total']}/{report['budget']} tokens | {sections} "
+            f"history={report['history']['tokens']} ({report['history']['turns']} turns)")
+    if report["trimmed"]:
+        line += " | trimmed: " + ", ".join(f"{k}({v})" for k, v in report["trimmed"].items())
+    return line
@@ -0,0 +1,254 @@
+"""LLM response cache for ARIA (exact and near-duplicate lookup)."""
+
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+_PUNCT_RE = re.compile(r"[^\w\s]", re.UNICODE)
+_SPACE_RE = re.compile(r"\s+")
+
+# Words that may differ between two questions with the same answer
+# ("what is the time" / "what time is it please"); anything else, numbers
+# and pronouns included, can change the answer
+_FILLER_WORDS = frozenset("""
+a an the is are am was be do does did it its this that these those there here to of in on at for
+please pls plz can could would will just so now then hey hi hello ok okay well um uh oh tell say
+show give let lets kindly aria
+а и но же ли бы вот ну то это этот эта эти там тут пожалуйста плиз скажи покажи подскажи расскажи
+дай можешь можно ария привет слушай просто сейчас
+""".split())
+
+
+def normalize_text(text):
+    """Lowercase, drop punctuation and collapse whitespace."""
+    text = text.lower().replace("'", "").replace("’", "")
+    text = _PUNCT_RE.sub(" ", text)
+    return _SPACE_RE.sub(" ", text).strip()
+
+
+def _turn_text(turn):
+    return "".join(p.get("text", "") for p in turn.get("parts", []))
+
+
+def _sha(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+
+class _Entry:
+    __slots__ = ("key", "context", "tokens", "text", "tags", "expires_at", "latency", "hits")
+
+    def __init__(self, key, context, tokens, text, tags, expires_at, latency, hits=0):
+        self.key = key
+        self.context = context
+        self.tokens = tokens
+        self.text = text
+        self.tags = tags
+        self.expires_at = expires_at
+        self.latency = latency
+        self.hits = hits
+
+
+class ResponseCache:
+    """In-memory LRU + TTL cache of Gemini replies.
+
+    Entries are keyed on the model, a hash of the system prompt and the
+    normalized last ``history_turns`` turns. A near-duplicate lookup reuses an
+    entry whose context (model, system prompt, earlier turns) is identical and
+    whose final user message has nearly the same words, differing only in
+    filler words (articles, "please", ...): "remind me at 5 pm" never
+    answers "remind me at 7 pm". Entries can carry
+    tags (e.g. ``"emails"``) so live-data answers can be dropped when that data
+    changes. ``store`` optionally persists entries (see DatabaseCacheStore).
+    """
+
+    def __init__(self, max_entries=256, ttl=3600.0, history_turns=3,
+                 near_threshold=0.8, store=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.history_turns = history_turns
+        self.near_threshold = near_threshold
+        self.store = store
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._by_context = {}
+        self._stats = {
+            "hits": 0, "near_hits": 0, "misses": 0, "stores": 0,
+            "evictions": 0, "expired": 0, "invalidated": 0,
+            "saved_seconds": 0.0,
+        }
+        if store is not None:
+            for entry in store.load(self.max_entries):
+                self._insert(entry)
+
+    def _keys_for(self, model, system_text, contents):
+        turns = [normalize_text(_turn_text(t)) for t in contents[-self.history_turns:]]
+        roles = [t.get("role", "") for t in contents[-self.history_turns:]]
+        system_hash = _sha(system_text)
+        context = _sha(model, system_hash, *[f"{r}:{t}" for r, t in zip(roles[:-1], turns[:-1])])
+        last = turns[-1] if turns else ""
+        key = _sha(context, last)
+        return key, context, frozenset(last.split())
+
+    def _insert(self, entry):
+        self._entries[entry.key] = entry
+        self._entries.move_to_end(entry.key)
+        self._by_context.setdefault(entry.context, set()).add(entry.key)
+        while len(self._entries) > self.max_entries:
+            old_key, _old = next(iter(self._entries.items()))
+            self._remove(old_key)
+            self._stats["evictions"] += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        keys = self._by_context.get(entry.context)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_context[entry.context]
+
+    def _live(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= now:
+            self._remove(key)
+            self._stats["expired"] += 1
+            return None
+        return entry
+
+    def _near(self, context, tokens, now):
+        if not tokens:
+            return None
+        best, best_score = None, self.near_threshold
+        for key in list(self._by_context.get(context, ())):
+            entry = self._live(key, now)
+            if entry is None:
+                continue
+            if not (tokens ^ entry.tokens) <= _FILLER_WORDS:
+                continue
+            union = len(tokens | entry.tokens)
+            score = len(tokens & entry.tokens) / union if union else 0.0
+            if score >= best_score:
+                best, best_score = entry, score
+        return best
+
+    def get(self, model, system_text, contents):
+        """Return a cached reply for this prompt, or None."""
+        key, context, tokens = self._keys_for(model, system_text, contents)
+        now = time.time()
+        with self._lock:
+            entry = self._live(key, now)
+            kind = "hits"
+            if entry is None:
+                entry = self._near(context, tokens, now)
+                kind = "near_hits"
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(entry.key)
+            entry.hits += 1
+            self._stats[kind] += 1
+            self._stats["saved_seconds"] += entry.latency
+            return entry.text
+
+    def put(self, model, system_text, contents, text, tags=(), ttl=None, latency=0.0):
+        """Store a successful reply."""
+        key, context, tokens = self._keys_for(model, system_text, contents)
+        expires_at = time.time() + (ttl if ttl is not None else self.ttl)
+        entry = _Entry(key, context, tokens, text, frozenset(tags), expires_at, latency)
+        with self._lock:
+            self._remove(key)
+            self._insert(entry)
+            self._stats["stores"] += 1
+        if self.store is not None:
+            self.store.save(entry)
+
+    def invalidate(self, tag):
+        """Drop every entry carrying ``tag``; returns how many were removed."""
+        with self._lock:
+            keys = [k for k, e in self._entries.items() if tag in e.tags]
+            for key in keys:
+                self._remove(key)
+            self._stats["invalidated"] += len(keys)
+        if self.store is not None:
+            self.store.delete_tag(tag)
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_context.clear()
+        if self.store is not None:
+            self.store.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        lookups = stats["hits"] + stats["near_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["hits"] + stats["near_hits"]) / lookups, 3) if lookups else 0.0
+        stats["saved_calls"] = stats["hits"] + stats["near_hits"]
+        stats["saved_seconds"] = round(stats["saved_seconds"], 2)
+        return stats
+
+
+class DatabaseCacheStore:
+    """Persists ResponseCache entries in the app's SQLite database."""
+
+    def __init__(self, app, db, model):
+        self.app = app
+        self.db = db
+        self.model = model
+
+    def load(self, limit):
+        with self.app.app_context():
+            now = datetime.utcnow()
+            self.model.query.filter(self.model.expires_at <= now).delete()
+            self.db.session.commit()
+            rows = self.model.query.order_by(self.model.created_at.desc()).limit(limit).all()
+            entries = []
+            for row in reversed(rows):
+                entries.append(_Entry(
+                    row.key, row.context, frozenset(row.tokens.split()), row.text,
+                    frozenset(t for t in row.tags.split(",") if t),
+                    time.time() + (row.expires_at - now).total_seconds(),
+                    row.latency or 0.0,
+                ))
+            return entries
+
+    def save(self, entry):
+        try:
+            with self.app.app_context():
+                row = self.db.session.get(self.model, entry.key) or self.model(key=entry.key)
+                row.context = entry.context
+                row.tokens = " ".join(sorted(entry.tokens))
+                row.text = entry.text
+                row.tags = ",".join(sorted(entry.tags))
+                row.latency = entry.latency
+                row.created_at = datetime.utcnow()
+                row.expires_at = datetime.utcfromtimestamp(entry.expires_at)
+                self.db.session.add(row)
+                self.db.session.commit()
+        except Exception as e:
+            print(f"[CACHE] Could not persist entry: {e}", flush=True)
+
+    def delete_tag(self, tag):
+        with self.app.app_context():
+            self.model.query.filter(
+                ("," + self.model.tags + ",").contains(f",{tag},")
+            ).delete(synchronize_session=False)
+            self.db.session.commit()
+
+    def clear(self):
+        with self.app.app_context():
+            self.model.query.delete()
+            self.db.session.commit()
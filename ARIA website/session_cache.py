@@ -0,0 +1,113 @@
+"""Session token verification cache and expired-session cleanup."""
+
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+
+from models import db, Session, User
+
+# What callers of verify_session_token() use of the user
+SessionUser = namedtuple("SessionUser", "id email")
+
+
+class SessionCache:
+    """Bounded LRU + TTL cache of session token -> (user id, email, expiry).
+
+    A hit answers without touching the database as long as the session has
+    not expired and the entry is younger than ``ttl`` seconds (after that
+    the row is read again, so a deleted user or session is noticed within
+    ``ttl``). Unknown tokens are never cached. invalidate() drops a token at
+    logout. A background sweeper bulk-deletes expired sessions every
+    ``sweep_interval`` seconds.
+    """
+
+    def __init__(self, app, ttl=300.0, max_entries=10000, sweep_interval=3600.0):
+        self.app = app
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # token -> (SessionUser, expires_at, cached_until)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sweep_loop, name="session-sweeper", daemon=True)
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0, "swept": 0}
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def lookup(self, token):
+        """The SessionUser of a valid token, else None. Needs an app context on a miss."""
+        if not token:
+            return None
+        now = datetime.utcnow()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None:
+                user, expires_at, cached_until = entry
+                if expires_at >= now and cached_until > time.time():
+                    self._entries.move_to_end(token)
+                    self._stats["hits"] += 1
+                    return user
+                del self._entries[token]
+            self._stats["misses"] += 1
+
+        row = db.session.query(Session.user_id, Session.expires_at, User.email)\
+            .join(User, User.id == Session.user_id)\
+            .filter(Session.token == token).first()
+        if row is None:
+            return None
+        if row.expires_at < now:
+            Session.query.filter_by(token=token).delete()
+            db.session.commit()
+            return None
+
+        user = SessionUser(row.user_id, row.email)
+        with self._lock:
+            self._entries[token] = (user, row.expires_at, time.time() + self.ttl)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+        return user
+
+    def invalidate(self, token):
+        with self._lock:
+            if self._entries.pop(token, None) is not None:
+                self._stats["invalidations"] += 1
+
+    def sweep(self):
+        """Delete expired sessions from the database and the cache; returns rows deleted."""
+        now = datetime.utcnow()
+        with self._lock:
+            for token in [t for t, (_, expires_at, _) in self._entries.items() if expires_at < now]:
+                del self._entries[token]
+        with self.app.app_context():
+            deleted = Session.query.filter(Session.expires_at < now).delete(synchronize_session=False)
+            db.session.commit()
+        self._stats["swept"] += deleted
+        if deleted:
+            print(f"[SESSION] Deleted {deleted} expired sessions", flush=True)
+        return deleted
+
+    def _sweep_loop(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"[SESSION] Sweep failed: {e}", flush=True)
+            if self._stop.wait(self.sweep_interval):
+                return
+
+    def stats(self):
+        with self._lock:
+            size = len(self._entries)
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {
+            "size": size,
+            "hit_rate": round(self._stats["hits"] / lookups, 3) if lookups else None,
+            **self._stats,
+        }
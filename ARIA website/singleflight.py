@@ -0,0 +1,102 @@
+"""Single-flight coalescing of identical concurrent calls."""
+
+import functools
+import threading
+
+# Every open group, so /api/metrics can report all of them
+_groups = []
+_groups_lock = threading.Lock()
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Lets concurrent callers with the same key share one in-flight call.
+
+    The first caller (the leader) runs the function; callers arriving while it
+    is still running wait and get the same result or exception. Nothing is
+    cached once the call returns. Callers share the result object, so they
+    must not mutate it. Groups created for something short-lived (one
+    client, one worker) must be close()d when it goes away.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self.calls = 0
+        self.executions = 0
+        self.shared = 0
+        with _groups_lock:
+            _groups.append(self)
+
+    def close(self):
+        """Stop reporting this group in all_stats(); do() keeps working."""
+        with _groups_lock:
+            if self in _groups:
+                _groups.remove(self)
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            self.calls += 1
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._inflight[key] = call
+                self.executions += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "executions": self.executions,
+                "collapsed": self.shared,
+                "in_flight": len(self._inflight),
+            }
+
+
+def single_flight(name, key=None):
+    """Decorator form; ``key(*args, **kwargs)`` defaults to the arguments."""
+    group = SingleFlight(name)
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            k = key(*args, **kwargs) if key else (args, tuple(sorted(kwargs.items())))
+            return group.do(k, fn, *args, **kwargs)
+        wrapper.flight = group
+        return wrapper
+    return decorator
+
+
+def all_stats():
+    with _groups_lock:
+        groups = list(_groups)
+    return {g.name: g.stats() for g in groups}
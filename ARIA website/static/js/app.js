@@ -519,6 +519,56 @@ document.addEventListener("DOMContentLoaded", () => {
         bubble.innerHTML = `<span class="chat-bubble-label">${label}</span>${escapeHtml(text)}`;
         chatMessages.appendChild(bubble);
         chatMessages.scrollTop = chatMessages.scrollHeight;
+        return bubble;
+    }
+
+    function setChatBubbleText(bubble, text) {
+        const label = bubble.querySelector(".chat-bubble-label");
+        bubble.innerHTML = "";
+        if (label) bubble.appendChild(label);
+        bubble.appendChild(document.createTextNode(text));
+        chatMessages.scrollTop = chatMessages.scrollHeight;
+    }
+
+    // Reads the SSE reply of /api/chat/stream and renders it as it arrives.
+    async function streamChatReply(payload) {
+        const headers = { "Content-Type": "application/json" };
+        // Signed-in users get their own conversation (user:<id>), not the cookie session's
+        const sessionToken = localStorage.getItem(SESSION_TOKEN_KEY);
+        if (sessionToken) headers["X-Session-Token"] = sessionToken;
+        const resp = await fetch("/api/chat/stream", { method: "POST", headers, body: JSON.stringify(payload) });
+        if (!resp.ok || !resp.body) {
+            removeTyping();
+            addChatBubble("assistant", t("chat_error"));
+            return;
+        }
+        const reader = resp.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = "", reply = "", bubble = null;
+        const render = (text) => {
+            if (!bubble) { removeTyping(); bubble = addChatBubble("assistant", text); }
+            else setChatBubbleText(bubble, text);
+        };
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            let sep;
+            while ((sep = buffer.indexOf("\n\n")) !== -1) {
+                const raw = buffer.slice(0, sep);
+                buffer = buffer.slice(sep + 2);
+                let event = "message", data = "";
+                raw.split("\n").forEach(line => {
+                    if (line.startsWith("event:")) event = line.slice(6).trim();
+                    else if (line.startsWith("data:")) data += line.slice(5).trim();
+                });
+                if (!data) continue;
+                const msg = JSON.parse(data);
+                if (event === "delta") { reply += msg.text; render(reply); }
+                else if (event === "done" || event === "error") { reply = msg.reply || reply; render(reply); }
+            }
+        }
+        if (!bubble) { removeTyping(); addChatBubble("assistant", t("chat_error")); }
     }
 
     function showTyping() {
@@ -577,10 +627,7 @@ document.addEventListener("DOMContentLoaded", () => {
                 payload.email = emailContent;
             }
 
-            const resp = await fetch("/api/chat", { method: "POST", headers: { "Content-Type": "application/json" }, body: JSON.stringify(payload) });
-            removeTyping();
-            if (resp.ok) { const data = await resp.json(); addChatBubble("assistant", data.reply); }
-            else addChatBubble("assistant", t("chat_error"));
+            await streamChatReply(payload);
         } catch { removeTyping(); addChatBubble("assistant", t("chat_no_server")); }
     }
 
@@ -1337,21 +1384,116 @@ document.addEventListener("DOMContentLoaded", () => {
         }
     }
 
-    // Load and display emails
-    async function loadEmails() {
+    // Inbox as last sent by the server; inbox_delta events patch it in place
+    const INBOX_SIZE = 50;
+    let inboxEmails = null;
+    // Keyset cursor for the next (older) page of the server-side inbox
+    let inboxNextCursor = null;
+    let inboxRenderPending = false;
+    let mailSocket = null;
+
+    // The server syncs Gmail in the background and pushes what changed to
+    // every open tab, so tabs no longer poll on their own
+    function connectMailSocket() {
+        if (mailSocket || typeof io === 'undefined') return;
+        mailSocket = io('/mail');
+        let connectedBefore = false;
+        mailSocket.on('connect', () => {
+            // Deltas sent while we were disconnected are lost: reload once
+            if (connectedBefore) loadEmails();
+            connectedBefore = true;
+        });
+        mailSocket.on('inbox_delta', applyInboxDelta);
+    }
+
+    function disconnectMailSocket() {
+        if (mailSocket) {
+            mailSocket.disconnect();
+            mailSocket = null;
+        }
+        inboxEmails = null;
+        inboxNextCursor = null;
+    }
+
+    // Append the next page of older emails; true if any arrived
+    async function loadOlderEmails() {
+        if (!inboxNextCursor || !inboxEmails) return false;
+        const resp = await fetch(`/api/emails/inbox?max_results=${INBOX_SIZE}&cursor=${encodeURIComponent(inboxNextCursor)}`);
+        const data = await resp.json();
+        if (!resp.ok) {
+            console.warn('Loading older emails failed:', data);
+            return false;
+        }
+        const known = new Set(inboxEmails.map(e => e.id));
+        inboxEmails.push(...(data.emails || []).filter(e => !known.has(e.id)));
+        inboxNextCursor = data.next_cursor || null;
+        return (data.emails || []).length > 0;
+    }
+
+    function applyInboxDelta(delta) {
+        if (!inboxEmails) return;
+        const added = delta.added || [];
+        const updated = new Map((delta.updated || []).map(e => [e.id, e]));
+        const drop = new Set([...(delta.deleted || []), ...added.map(e => e.id)]);
+        inboxEmails = [
+            ...added,
+            ...inboxEmails.filter(e => !drop.has(e.id)).map(e => updated.get(e.id) || e),
+        ].sort((a, b) => (b.date || '').localeCompare(a.date || ''));
+
+        // Don't pull an open email out from under the reader; re-render on "back"
+        if (document.getElementById('emailDetailBackBtn')) {
+            inboxRenderPending = true;
+            return;
+        }
+        loadEmails({ emails: inboxEmails, page: inboxPageIndex });
+    }
+
+    // Mark emails read/unread. The server updates its cache at once and
+    // writes to Gmail in batches; other tabs hear about it via inbox_delta
+    function markEmailsRead(ids, read = true) {
+        if (!ids.length) return;
+        if (inboxEmails) {
+            const set = new Set(ids);
+            inboxEmails.forEach(e => { if (set.has(e.id)) e.is_read = read; });
+        }
+        fetch('/api/emails/read', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ ids, read })
+        }).then(r => {
+            if (!r.ok) r.json().then(data => console.warn('Marking emails failed:', data));
+        }).catch(err => console.warn('Marking emails failed:', err));
+    }
+
+    // Page of the list the user is on, kept across re-renders
+    let inboxPageIndex = 0;
+
+    // Load and display emails; with options.emails only re-render that list
+    // (at options.page)
+    async function loadEmails(options = {}) {
         try {
-            // First sync emails from Gmail
-            const syncResp = await fetch('/api/emails/sync', {
-                method: 'POST'
-            });
+            let data;
+            if (options.emails) {
+                data = { emails: options.emails };
+            } else {
+                // First sync emails from Gmail
+                const syncResp = await fetch('/api/emails/sync', {
+                    method: 'POST'
+                });
 
-            if (!syncResp.ok) {
-                console.warn('Email sync failed:', await syncResp.json());
-            }
+                if (!syncResp.ok) {
+                    console.warn('Email sync failed:', await syncResp.json());
+                }
 
-            // Then fetch cached emails
-            const resp = await fetch('/api/emails/inbox?max_results=50');
-            const data = await resp.json();
+                // Then fetch cached emails
+                const resp = await fetch(`/api/emails/inbox?max_results=${INBOX_SIZE}`);
+                data = await resp.json();
+                if (data.source === 'cache') {
+                    inboxEmails = data.emails || [];
+                    inboxNextCursor = data.next_cursor || null;
+                    connectMailSocket();
+                }
+            }
 
             // Ищем правильный контейнер из твоего HTML!
             const emailsList = document.getElementById('emails-list');
@@ -1400,7 +1542,8 @@ document.addEventListener("DOMContentLoaded", () => {
             function classifyEmail(email) {
                 const from = (email.from || '').toLowerCase();
                 const subject = (email.subject || '').toLowerCase();
-                const body = (email.body || '').toLowerCase();
+                // The inbox list only carries a preview, not the whole body
+                const body = (email.body || email.preview || '').toLowerCase();
 
                 // Extract sender domain
                 const domainMatch = from.match(/@([\w.\-]+)/);
@@ -1484,10 +1627,15 @@ document.addEventListener("DOMContentLoaded", () => {
 
                 // Apply pagination
                 const emailsPerPage = 10;
+                const totalPages = Math.ceil(filtered.length / emailsPerPage);
+                // A re-render may start on a page that no longer exists
+                currentPageIndex = Math.min(currentPageIndex, totalPages - 1);
+                inboxPageIndex = currentPageIndex;
                 const start = currentPageIndex * emailsPerPage;
                 const end = start + emailsPerPage;
                 const pagedEmails = filtered.slice(start, end);
-                const totalPages = Math.ceil(filtered.length / emailsPerPage);
+                // Older emails may still be on the server
+                const atOldest = currentPageIndex >= totalPages - 1 && !inboxNextCursor;
 
                 // Update pagination info
                 const pageInfo = document.getElementById('emailPageInfo');
@@ -1495,9 +1643,9 @@ document.addEventListener("DOMContentLoaded", () => {
                     pageInfo.textContent = `${currentPageIndex + 1} / ${totalPages}`;
                 }
                 document.getElementById('emailNewerBtn').disabled = currentPageIndex === 0;
-                document.getElementById('emailOlderBtn').disabled = currentPageIndex >= totalPages - 1;
+                document.getElementById('emailOlderBtn').disabled = atOldest;
                 document.getElementById('emailNewerBtn').style.opacity = currentPageIndex === 0 ? '0.5' : '1';
-                document.getElementById('emailOlderBtn').style.opacity = currentPageIndex >= totalPages - 1 ? '0.5' : '1';
+                document.getElementById('emailOlderBtn').style.opacity = atOldest ? '0.5' : '1';
 
                 listEl.innerHTML = pagedEmails.map((email) => {
                     const date = new Date(email.date);
@@ -1515,7 +1663,7 @@ document.addEventListener("DOMContentLoaded", () => {
 
                     const safeFrom = escapeHtml(email.from || '');
                     const safeSubject = escapeHtml(email.subject || '(No subject)');
-                    const rawBodyForPreview = (email.body || '')
+                    const rawBodyForPreview = (email.preview || email.body || '')
                         .replace(/<head[\s\S]*?<\/head>/gi, '')
                         .replace(/<style[\s\S]*?<\/style>/gi, '')
                         .replace(/<script[\s\S]*?<\/script>/gi, '')
@@ -1617,6 +1765,11 @@ document.addEventListener("DOMContentLoaded", () => {
                 if (paginationContainer) {
                     paginationContainer.style.display = 'flex';
                 }
+                if (inboxRenderPending) {
+                    inboxRenderPending = false;
+                    loadEmails({ emails: inboxEmails, page: currentPageIndex });
+                    return;
+                }
                 // Re-render the email list
                 renderEmailList(window._ariaActiveFilter);
             }
@@ -1678,6 +1831,11 @@ document.addEventListener("DOMContentLoaded", () => {
                 // Attach back button listener
                 document.getElementById('emailDetailBackBtn').addEventListener('click', backToEmailList);
 
+                if (email.id && email.is_read === false) {
+                    email.is_read = true;
+                    markEmailsRead([email.id], true);
+                }
+
                 // Render email body
                 const bodyEl = document.getElementById('emailDetailBody');
                 const rawBody = email.body || email.html || email.text || email.content || email.snippet || email.message || '';
@@ -1795,7 +1953,7 @@ document.addEventListener("DOMContentLoaded", () => {
             }
 
             // Initialize pagination and render
-            let currentPageIndex = 0;
+            let currentPageIndex = options.page || 0;
             const emailsPerPage = 10;
 
 
@@ -1808,7 +1966,7 @@ document.addEventListener("DOMContentLoaded", () => {
                     }
                 };
 
-                document.getElementById('emailOlderBtn').onclick = () => {
+                document.getElementById('emailOlderBtn').onclick = async () => {
                     const filtered = window._ariaActiveFilter === 'all'
                         ? visibleEmails
                         : visibleEmails.filter(e => e._category === window._ariaActiveFilter);
@@ -1816,6 +1974,9 @@ document.addEventListener("DOMContentLoaded", () => {
                     if (currentPageIndex < maxPages - 1) {
                         currentPageIndex++;
                         renderEmailList(window._ariaActiveFilter);
+                    } else if (await loadOlderEmails()) {
+                        // Past the last loaded page: older emails came from the server
+                        loadEmails({ emails: inboxEmails, page: currentPageIndex + 1 });
                     }
                 };
             }
@@ -2073,6 +2234,7 @@ document.addEventListener("DOMContentLoaded", () => {
         gmailDisconnectBtn.addEventListener('click', async () => {
             try {
                 await fetch('/api/gmail/logout', { method: 'POST' });
+                disconnectMailSocket();
                 localStorage.removeItem(GMAIL_AUTH_KEY);
                 if (gmailSection) {
                     gmailSection.style.display = 'none';
@@ -2143,14 +2305,6 @@ document.addEventListener("DOMContentLoaded", () => {
     // Initialize on page load
     initEmailService();
 
-    // Auto-refresh emails every 3 minutes
-    setInterval(() => {
-        const gmailAuth = localStorage.getItem(GMAIL_AUTH_KEY);
-        if (gmailAuth) {
-            loadEmails().catch(e => console.error('Auto-refresh error:', e));
-        }
-    }, 180000); // 3 minutes
-
     // ─── Helpers ───
     function escapeHtml(text) { const d = document.createElement("div"); d.textContent = text; return d.innerHTML; }
 });
\ No newline at end of file
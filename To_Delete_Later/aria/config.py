@@ -3,6 +3,7 @@ ARIA Configuration
 """
 import os
 from dotenv import load_dotenv
+from gemini_keys import DEFAULT_RPM, DEFAULT_TPM
 
 load_dotenv()
 
@@ -31,6 +32,10 @@ def get_api_keys():
 GEMINI_API_KEYS = get_api_keys()
 GEMINI_MODEL = "gemini-2.5-flash-lite"
 
+# Per-key budgets for the key pool; same defaults as the website
+GEMINI_KEY_RPM = int(os.getenv('GEMINI_KEY_RPM', DEFAULT_RPM))
+GEMINI_KEY_TPM = int(os.getenv('GEMINI_KEY_TPM', DEFAULT_TPM))
+
 # =============================================================================
 # ESP32-CAM
 # =============================================================================
@@ -5,7 +5,10 @@ Handles Gemini API calls with automatic key rotation on rate limits
 import time
 from google import genai
 from google.genai import types
-from config import GEMINI_API_KEYS, GEMINI_MODEL, SYSTEM_PROMPT
+from config import (GEMINI_API_KEYS, GEMINI_MODEL, GEMINI_KEY_RPM, GEMINI_KEY_TPM, SYSTEM_PROMPT,
+                    MAX_HISTORY_TURNS, SUMMARIZE_AFTER)
+from gemini_keys import GeminiKeyPool, is_rate_limit_error
+from conversation import ConversationBuffer, Summarizer, format_transcript
 
 
 class GeminiClient:
@@ -13,16 +16,17 @@ class GeminiClient:
     
     def __init__(self):
         self.api_keys = GEMINI_API_KEYS.copy()
+        self.key_pool = get_key_pool()
         self.current_key_index = 0
         self.client = None
         self.model = GEMINI_MODEL
         
-        # Conversation history
-        self.history = []
-        self.history_summary = ""
-        
-        # Track key failures
-        self.key_failures = {}
+        # Conversation history; old turns are summarized in the background
+        self.conversation = ConversationBuffer(
+            Summarizer(self._summarize, name="aria-summary"),
+            summarize_after=SUMMARIZE_AFTER * 2,  # *2 because user+model pairs
+            keep_turns=MAX_HISTORY_TURNS * 2,
+        )
         
         # Safety settings (allow all)
         self.safety_settings = [
@@ -34,6 +38,14 @@ class GeminiClient:
         
         self._init_client()
     
+    @property
+    def history(self):
+        return self.conversation.recent()
+    
+    @property
+    def history_summary(self):
+        return self.conversation.summary
+    
     def _init_client(self):
         """Initialize client with current API key"""
         if not self.api_keys:
@@ -43,14 +55,29 @@ class GeminiClient:
         self.client = genai.Client(api_key=key)
         print(f"[*] Using Gemini API key #{self.current_key_index + 1}")
     
+    def _acquire_key(self, exclude=()):
+        """Switch to the key the shared pool considers healthiest"""
+        lease = self.key_pool.acquire(exclude=exclude)
+        if lease is None:
+            return False
+        index, _key = lease
+        if index != self.current_key_index or self.client is None:
+            self.current_key_index = index
+            self._init_client()
+        return True
+    
     def _rotate_key(self):
-        """Rotate to next API key"""
+        """Switch to the best key other than the current one.
+
+        Like _acquire_key this reserves the key in the shared pool, so the
+        caller must report the outcome of the call made with it.
+        """
         if len(self.api_keys) <= 1:
-            print("[!] Only one API key available, cannot rotate")
             return False
         
-        self.current_key_index = (self.current_key_index + 1) % len(self.api_keys)
-        self._init_client()
+        if not self._acquire_key(exclude={self.current_key_index}):
+            print("[!] All other API keys are cooling down")
+            return False
         print(f"[*] Rotated to API key #{self.current_key_index + 1}")
         return True
     
@@ -58,6 +85,10 @@ class GeminiClient:
         """Build conversation contents for API"""
         contents = []
         
+        # Summary and history come from one snapshot so a background swap
+        # cannot make a turn appear twice or not at all
+        history_summary, history = self.conversation.snapshot()
+        
         # System prompt with memories
         system_text = SYSTEM_PROMPT
         
@@ -67,8 +98,8 @@ class GeminiClient:
                 system_text += f"{i}. {memory}\n"
             system_text += "--- Конец воспоминаний ---\n"
         
-        if self.history_summary:
-            system_text += f"\n--- Краткое содержание предыдущего разговора ---\n{self.history_summary}\n"
+        if history_summary:
+            system_text += f"\n--- Краткое содержание предыдущего разговора ---\n{history_summary}\n"
         
         # Add system prompt as first user message
         contents.append(types.Content(
@@ -81,7 +112,7 @@ class GeminiClient:
         ))
         
         # Add conversation history
-        for msg in self.history:
+        for msg in history:
             contents.append(types.Content(
                 role=msg["role"],
                 parts=[types.Part.from_text(text=msg["text"])]
@@ -121,96 +152,100 @@ class GeminiClient:
         last_error = None
         
         for attempt in range(max_retries):
+            # After a failure, move off the key that just failed if another is ready
+            if not ((attempt > 0 and self._rotate_key()) or self._acquire_key()):
+                wait_time = min(self.key_pool.next_available_in() or 1, 2 ** attempt)
+                print(f"[*] All keys cooling down, waiting {wait_time:.0f}s...")
+                time.sleep(wait_time)
+                last_error = Exception("All API keys are rate limited")
+                continue
+            index = self.current_key_index
+            t0 = time.time()
             try:
                 response = self.client.models.generate_content(
                     model=self.model,
                     contents=contents,
                     config=config
                 )
+                self.key_pool.record_success(index, time.time() - t0)
                 
                 ai_response = response.text
                 
-                # Add to history
+                # Add to history (may queue a background summary, never waits for it)
                 if image_data:
-                    self.history.append({"role": "user", "text": f"[Изображение с камеры] {message}"})
+                    self.conversation.append("user", f"[Изображение с камеры] {message}")
                 else:
-                    self.history.append({"role": "user", "text": message})
-                self.history.append({"role": "model", "text": ai_response})
-                
-                # Check if we need to summarize
-                self._maybe_summarize()
+                    self.conversation.append("user", message)
+                self.conversation.append("model", ai_response)
                 
                 return ai_response
                 
             except Exception as e:
                 last_error = e
-                error_str = str(e).lower()
                 
                 # Check if it's a rate limit error
-                if "429" in error_str or "rate" in error_str or "quota" in error_str:
-                    print(f"[!] Rate limit hit on key #{self.current_key_index + 1}")
-                    self.key_failures[self.current_key_index] = time.time()
-                    
-                    if not self._rotate_key():
-                        # Exponential backoff if can't rotate
-                        wait_time = 2 ** attempt
-                        print(f"[*] Waiting {wait_time}s before retry...")
-                        time.sleep(wait_time)
+                if is_rate_limit_error(e):
+                    print(f"[!] Rate limit hit on key #{index + 1}")
+                    # Cooldown comes from the error; the next attempt picks another key
+                    self.key_pool.record_rate_limit(index, str(e))
                 else:
+                    self.key_pool.record_failure(index, e)
                     print(f"[ERROR] Gemini error: {e}")
                     if attempt < max_retries - 1:
                         time.sleep(1)
         
         raise Exception(f"Failed after {max_retries} attempts: {last_error}")
     
-    def _maybe_summarize(self):
-        """Summarize conversation if history is too long"""
-        from config import MAX_HISTORY_TURNS, SUMMARIZE_AFTER
+    def _summarize(self, previous_summary, old_history):
+        """Fold old turns into the summary (runs on the summarizer thread)"""
+        print("[*] Summarizing conversation history in the background...")
         
-        if len(self.history) >= SUMMARIZE_AFTER * 2:  # *2 because user+model pairs
-            print("[*] Summarizing conversation history...")
-            
-            # Keep last N turns
-            keep_count = MAX_HISTORY_TURNS * 2
-            old_history = self.history[:-keep_count]
-            self.history = self.history[-keep_count:]
-            
-            # Summarize old history
-            summary_prompt = "Кратко резюмируй этот разговор (2-3 предложения):\n\n"
-            for msg in old_history:
-                role = "Пользователь" if msg["role"] == "user" else "ARIA"
-                summary_prompt += f"{role}: {msg['text']}\n"
-            
-            try:
-                contents = [types.Content(
+        summary_prompt = "Кратко резюмируй этот разговор (2-3 предложения):\n\n"
+        if previous_summary:
+            summary_prompt += f"Краткое содержание до этого:\n{previous_summary}\n\n"
+        summary_prompt += format_transcript(old_history, user="Пользователь", assistant="ARIA")
+        
+        # Own client on a leased key: self.client belongs to chat()
+        lease = self.key_pool.acquire(wait=10)
+        if lease is None:
+            raise RuntimeError("All API keys are rate limited")
+        index, key = lease
+        t0 = time.time()
+        try:
+            response = genai.Client(api_key=key).models.generate_content(
+                model=self.model,
+                contents=[types.Content(
                     role="user",
                     parts=[types.Part.from_text(text=summary_prompt)]
-                )]
-                
-                response = self.client.models.generate_content(
-                    model=self.model,
-                    contents=contents,
-                    config=types.GenerateContentConfig(max_output_tokens=200)
-                )
-                
-                if self.history_summary:
-                    self.history_summary = f"{self.history_summary}\n{response.text}"
-                else:
-                    self.history_summary = response.text
-                    
-            except Exception as e:
-                print(f"[!] Could not summarize: {e}")
+                )],
+                config=types.GenerateContentConfig(max_output_tokens=200)
+            )
+        except Exception as e:
+            if is_rate_limit_error(e):
+                self.key_pool.record_rate_limit(index, str(e))
+            else:
+                self.key_pool.record_failure(index, e)
+            raise
+        self.key_pool.record_success(index, time.time() - t0)
+        return response.text
     
     def clear_history(self):
         """Clear conversation history"""
-        self.history = []
-        self.history_summary = ""
+        self.conversation.clear()
         print("[*] Conversation history cleared")
 
 
-# Singleton
+# Singletons
+_key_pool = None
 _gemini = None
 
+def get_key_pool():
+    """Key pool shared by the chat client and RAG embeddings"""
+    global _key_pool
+    if _key_pool is None:
+        _key_pool = GeminiKeyPool(GEMINI_API_KEYS, rpm=GEMINI_KEY_RPM, tpm=GEMINI_KEY_TPM)
+    return _key_pool
+
 def get_gemini():
     global _gemini
     if _gemini is None:
@@ -18,9 +18,6 @@ class RAGMemory:
         self.client = None
         self.embedding_model = None
         
-        # API key rotation for embeddings
-        self._current_key_index = 0
-        
     def connect(self):
         """Connect to Qdrant"""
         if self.client is None:
@@ -48,22 +45,33 @@ class RAGMemory:
         import time
         from google import genai
         from config import GEMINI_API_KEYS
+        from gemini_client import get_key_pool
+        from gemini_keys import is_rate_limit_error
         
         if not GEMINI_API_KEYS:
             raise ValueError("No Gemini API key for embeddings")
         
-        num_keys = len(GEMINI_API_KEYS)
+        key_pool = get_key_pool()
         last_error = None
         
-        # Try each key at least once, plus some retries
-        max_attempts = num_keys * 2
+        # Every key gets one chance; keys on cooldown are skipped by the pool
+        max_attempts = len(GEMINI_API_KEYS) * 2
         keys_tried = set()
         
         for attempt in range(max_attempts):
+            lease = key_pool.acquire(exclude=keys_tried)
+            if lease is None:
+                # All keys tried or cooling down: wait for the first one to free up
+                wait_time = min(key_pool.next_available_in() or 2, 10)
+                print(f"[*] All keys busy, waiting {wait_time:.0f}s...")
+                time.sleep(wait_time)
+                keys_tried.clear()
+                continue
+            index, key = lease
+            keys_tried.add(index)
+            t0 = time.time()
             try:
-                # Use current key
-                key = GEMINI_API_KEYS[self._current_key_index]
-                print(f"[*] Embedding: trying key #{self._current_key_index+1}")
+                print(f"[*] Embedding: trying key #{index+1}")
                 
                 client = genai.Client(api_key=key)
                 
@@ -71,35 +79,24 @@ class RAGMemory:
                     model="text-embedding-004",
                     contents=text
                 )
+                key_pool.record_success(index, time.time() - t0)
                 
                 return response.embeddings[0].values
                 
             except Exception as e:
                 last_error = e
-                error_str = str(e).lower()
                 
                 # Check for rate limit
-                if "429" in error_str or "rate" in error_str or "quota" in error_str:
-                    keys_tried.add(self._current_key_index)
-                    old_index = self._current_key_index
-                    
-                    # Rotate to next key
-                    self._current_key_index = (self._current_key_index + 1) % num_keys
-                    
-                    print(f"[!] Key #{old_index+1} rate limited, switching to #{self._current_key_index+1}")
-                    
-                    # If we've tried all keys, wait before retrying
-                    if len(keys_tried) >= num_keys:
-                        wait_time = 2
-                        print(f"[*] All keys tried, waiting {wait_time}s...")
-                        time.sleep(wait_time)
-                        keys_tried.clear()
+                if is_rate_limit_error(e):
+                    key_pool.record_rate_limit(index, str(e))
+                    print(f"[!] Key #{index+1} rate limited")
                 else:
                     # Other error
+                    key_pool.record_failure(index, e)
                     print(f"[!] Embedding error: {str(e)[:60]}")
                     time.sleep(0.5)
         
-        raise last_error
+        raise last_error or RuntimeError("No Gemini API key became available for embeddings")
     
     def search(self, query, top_k=None):
         """
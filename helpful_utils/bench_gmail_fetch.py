@@ -0,0 +1,189 @@
+"""
+Benchmark: Gmail message fetch, one request per message vs batch requests
+
+Runs a fake Gmail API on localhost (messages.list, messages.get and the
+/batch endpoint) where every message takes a random 30-150 ms to "load",
+then times GmailService fetching the inbox both ways. The batch endpoint
+answers after its slowest message, like the real one.
+
+Usage:
+  python bench_gmail_fetch.py
+  python bench_gmail_fetch.py --messages 100 --batch-size 50 --format metadata
+"""
+
+import argparse
+import base64
+import email.parser
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+
+import httplib2
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "ARIA website"))
+from gmail_service import GmailService  # noqa: E402
+
+
+MESSAGE_RE = re.compile(r"^/gmail/v1/users/me/messages/([^/?]+)$")
+
+messages = {}      # id -> messages.get response (format=full)
+latencies = {}     # id -> seconds
+
+
+def make_messages(count, min_ms, max_ms, seed=1):
+    rnd = random.Random(seed)
+    for i in range(count):
+        mid = f"msg{i:05d}"
+        body = f"<p>Hello, this is test message {i}.</p>" * 20
+        messages[mid] = {
+            "id": mid,
+            "threadId": mid,
+            "snippet": f"Hello, this is test message {i}.",
+            "internalDate": str(1700000000000 + i * 60000),
+            "labelIds": ["INBOX"],
+            "payload": {
+                "mimeType": "text/html",
+                "headers": [
+                    {"name": "Subject", "value": f"Test message {i}"},
+                    {"name": "From", "value": "bench@example.com"},
+                    {"name": "Date", "value": "Tue, 14 Nov 2023 22:13:20 +0000"},
+                ],
+                "body": {"data": base64.urlsafe_b64encode(body.encode()).decode()},
+            },
+        }
+        latencies[mid] = rnd.uniform(min_ms, max_ms) / 1000.0
+
+
+def message_response(mid, query):
+    msg = dict(messages[mid])
+    if query.get("format", ["full"])[0] == "metadata":
+        payload = dict(msg["payload"])
+        payload.pop("body")
+        msg["payload"] = payload
+    return msg
+
+
+class FakeGmail(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    requests_served = 0
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body, content_type="application/json"):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        FakeGmail.requests_served += 1
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == "/gmail/v1/users/me/messages":
+            time.sleep(0.05)
+            limit = int(query.get("maxResults", ["100"])[0])
+            ids = sorted(messages, reverse=True)[:limit]
+            return self._send(200, {"messages": [{"id": m, "threadId": m} for m in ids]})
+        m = MESSAGE_RE.match(url.path)
+        if m and m.group(1) in messages:
+            time.sleep(latencies[m.group(1)])
+            return self._send(200, message_response(m.group(1), query))
+        self._send(404, {"error": {"code": 404, "message": "Not Found"}})
+
+    def do_POST(self):
+        FakeGmail.requests_served += 1
+        if not self.path.startswith("/batch"):
+            return self._send(404, {"error": {"code": 404, "message": "Not Found"}})
+        raw = self.rfile.read(int(self.headers["Content-Length"]))
+        header = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode()
+        parts = email.parser.BytesParser().parsebytes(header + raw).get_payload()
+
+        out, slowest = [], 0.0
+        for part in parts:
+            request_line = part.get_payload().splitlines()[0]
+            url = urlparse(request_line.split(" ")[1])
+            m = MESSAGE_RE.match(url.path)
+            if m and m.group(1) in messages:
+                slowest = max(slowest, latencies[m.group(1)])
+                status, body = "200 OK", message_response(m.group(1), parse_qs(url.query))
+            else:
+                status, body = "404 Not Found", {"error": {"code": 404, "message": "Not Found"}}
+            content_id = part["Content-ID"].replace("<", "<response-", 1)
+            out.append(
+                f"Content-Type: application/http\r\nContent-ID: {content_id}\r\n\r\n"
+                f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n\r\n{json.dumps(body)}\r\n"
+            )
+        # The items are processed in parallel: the batch takes as long as its slowest one
+        time.sleep(slowest)
+        boundary = "batch_bench"
+        body = "".join(f"--{boundary}\r\n{p}" for p in out) + f"--{boundary}--\r\n"
+        self._send(200, body.encode(), content_type=f"multipart/mixed; boundary={boundary}")
+
+
+def make_service(port):
+    doc = json.loads(get_static_doc("gmail", "v1"))
+    doc["rootUrl"] = f"http://127.0.0.1:{port}/"
+    return build_from_document(doc, http=httplib2.Http())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gmail fetch benchmark against a local fake API")
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--format", choices=["full", "metadata"], default="full")
+    parser.add_argument("--min-ms", type=float, default=30)
+    parser.add_argument("--max-ms", type=float, default=150)
+    args = parser.parse_args()
+
+    make_messages(args.messages, args.min_ms, args.max_ms)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeGmail)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+
+    gmail = GmailService(batch_size=args.batch_size)
+    ids = sorted(messages, reverse=True)
+
+    print(f"{args.messages} messages, {args.min_ms:.0f}-{args.max_ms:.0f} ms each, "
+          f"sum {sum(latencies.values()):.2f}s, slowest {max(latencies.values()):.2f}s\n")
+
+    FakeGmail.requests_served = 0
+    service = make_service(port)
+    t0 = time.time()
+    sequential = [gmail._get_message_details(service, mid, args.format) for mid in ids]
+    t_seq = time.time() - t0
+    seq_requests = FakeGmail.requests_served
+
+    FakeGmail.requests_served = 0
+    t0 = time.time()
+    batched = gmail.fetch_messages(make_service(port), ids, format=args.format)
+    t_batch = time.time() - t0
+    batch_requests = FakeGmail.requests_served
+
+    assert [m["id"] for m in batched] == [m["id"] for m in sequential], "results differ"
+
+    print(f"  one by one : {t_seq:6.2f}s  ({seq_requests} HTTP requests)")
+    print(f"  batched    : {t_batch:6.2f}s  ({batch_requests} HTTP requests, batch size {gmail.batch_size})")
+    print(f"  speed-up   : {t_seq / t_batch:.1f}x")
+
+    # Whole get_emails() call (list + details) through the service
+    gmail.service = make_service(port)
+    t0 = time.time()
+    result = gmail.get_emails(max_results=args.messages, format=args.format)
+    print(f"\n  get_emails({args.messages}, {args.format!r}): {time.time() - t0:.2f}s, "
+          f"{len(result.get('emails', []))} emails")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
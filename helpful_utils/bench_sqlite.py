@@ -0,0 +1,176 @@
+"""
+Benchmark: concurrent SQLite reads and writes, default settings vs tuned
+
+Builds a scratch database shaped like ARIA's email cache (email_messages,
+sessions), then for a fixed time runs reader threads that do what the
+dashboard does (session lookup + inbox page: one account, newest first)
+while a writer thread upserts batches of messages like the Gmail sync.
+Runs twice:
+
+  default  rollback journal, synchronous=FULL, only single-column indexes
+  tuned    models.sqlite_pragmas() (WAL, synchronous=NORMAL, page cache,
+           mmap) and the composite inbox index
+
+and prints throughput and latency percentiles for both.
+
+Usage:
+  python bench_sqlite.py
+  python bench_sqlite.py --rows 50000 --readers 8 --seconds 10
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "ARIA website"))
+from models import sqlite_pragmas  # noqa: E402
+
+ACCOUNTS = 3
+
+SCHEMA = """
+CREATE TABLE sessions (
+    id INTEGER PRIMARY KEY, token VARCHAR(255) NOT NULL UNIQUE, user_id INTEGER NOT NULL,
+    created_at DATETIME, expires_at DATETIME NOT NULL
+);
+CREATE TABLE email_messages (
+    id INTEGER PRIMARY KEY, gmail_id VARCHAR(255) NOT NULL, account_id INTEGER NOT NULL,
+    sender VARCHAR(255) NOT NULL, subject VARCHAR(500) NOT NULL, preview VARCHAR(200),
+    received_at DATETIME NOT NULL, is_read BOOLEAN, label_ids VARCHAR(500),
+    CONSTRAINT _gmail_id_account_uc UNIQUE (gmail_id, account_id)
+);
+CREATE INDEX ix_email_messages_gmail_id ON email_messages (gmail_id);
+"""
+TUNED_INDEXES = """
+CREATE INDEX ix_email_messages_account_received ON email_messages (account_id, received_at, id);
+CREATE INDEX ix_sessions_expires_at ON sessions (expires_at);
+"""
+
+INBOX_PAGE = """
+SELECT id, gmail_id, subject, sender, preview, received_at, is_read FROM email_messages
+WHERE account_id = ? ORDER BY received_at DESC, id DESC LIMIT 50
+"""
+SESSION_LOOKUP = "SELECT user_id, expires_at FROM sessions WHERE token = ?"
+UPSERT = """
+INSERT INTO email_messages (gmail_id, account_id, sender, subject, preview, received_at, is_read, label_ids)
+VALUES (?, ?, ?, ?, ?, ?, 0, 'INBOX,UNREAD')
+ON CONFLICT (gmail_id, account_id) DO UPDATE SET label_ids = excluded.label_ids, is_read = excluded.is_read
+"""
+
+
+def _received(i):
+    return f"2024-{1 + i % 12:02d}-{1 + i % 28:02d} {i % 24:02d}:{i % 60:02d}:{i % 59:02d}.{i:06d}"
+
+
+def build(path, rows, tuned):
+    con = sqlite3.connect(path)
+    if tuned:
+        for statement in sqlite_pragmas():
+            con.execute(statement)
+    con.executescript(SCHEMA + (TUNED_INDEXES if tuned else ""))
+    con.executemany(
+        "INSERT INTO sessions (token, user_id, created_at, expires_at) VALUES (?, ?, '2024-01-01', '2099-01-01')",
+        [(f"tok{i}", i) for i in range(1000)],
+    )
+    con.executemany(
+        UPSERT.split("ON CONFLICT")[0],
+        [(f"m{i}", i % ACCOUNTS, "bench@example.com", f"Subject {i}", "preview " * 10, _received(i))
+         for i in range(rows)],
+    )
+    con.commit()
+    con.close()
+
+
+def connect(path, tuned):
+    con = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    for statement in sqlite_pragmas() if tuned else ["PRAGMA busy_timeout=30000"]:
+        con.execute(statement)
+    return con
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(path, tuned, readers, seconds, batch, rows):
+    stop = time.time() + seconds
+    read_times, write_times = [], []
+    lock = threading.Lock()
+    errors = []
+
+    def reader(seed):
+        rnd = random.Random(seed)
+        con = connect(path, tuned)
+        local = []
+        try:
+            while time.time() < stop:
+                t0 = time.perf_counter()
+                con.execute(SESSION_LOOKUP, (f"tok{rnd.randrange(1000)}",)).fetchone()
+                con.execute(INBOX_PAGE, (rnd.randrange(ACCOUNTS),)).fetchall()
+                local.append(time.perf_counter() - t0)
+        except sqlite3.Error as e:
+            errors.append(str(e))
+        finally:
+            con.close()
+        with lock:
+            read_times.extend(local)
+
+    def writer():
+        con = connect(path, tuned)
+        i = rows
+        try:
+            while time.time() < stop:
+                t0 = time.perf_counter()
+                con.executemany(UPSERT, [
+                    (f"m{i + j}", (i + j) % ACCOUNTS, "bench@example.com", f"Subject {i + j}",
+                     "preview " * 10, _received(i + j)) for j in range(batch)
+                ])
+                con.commit()
+                write_times.append(time.perf_counter() - t0)
+                i += batch
+        except sqlite3.Error as e:
+            errors.append(str(e))
+        finally:
+            con.close()
+
+    threads = [threading.Thread(target=reader, args=(n,)) for n in range(readers)]
+    threads.append(threading.Thread(target=writer))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return read_times, write_times, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=20000, help="cached emails to start with")
+    parser.add_argument("--readers", type=int, default=4, help="concurrent reader threads")
+    parser.add_argument("--seconds", type=float, default=5.0, help="duration of each run")
+    parser.add_argument("--batch", type=int, default=50, help="messages per write transaction")
+    args = parser.parse_args()
+
+    print(f"{args.rows} emails, {args.readers} readers + 1 writer ({args.batch}/commit), {args.seconds:.0f}s per run\n")
+    print(f"{'':8} {'reads/s':>9} {'read p50':>9} {'read p99':>9} {'writes/s':>9} {'write p50':>9} {'write p99':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, tuned in (("default", False), ("tuned", True)):
+            path = os.path.join(tmp, f"{name}.db")
+            build(path, args.rows, tuned)
+            reads, writes, errors = run(path, tuned, args.readers, args.seconds, args.batch, args.rows)
+            print(f"{name:8} {len(reads) / args.seconds:9.0f} {percentile(reads, 0.5) * 1000:8.2f}ms "
+                  f"{percentile(reads, 0.99) * 1000:8.2f}ms {len(writes) * args.batch / args.seconds:9.0f} "
+                  f"{percentile(writes, 0.5) * 1000:8.2f}ms {percentile(writes, 0.99) * 1000:8.2f}ms")
+            if errors:
+                print(f"         {len(errors)} errors, first: {errors[0]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""
+Local stand-in for Gmail push notifications
+
+Posts a Cloud Pub/Sub push message, shaped like the ones a Gmail watch
+sends, to the ARIA webhook. The account's sync worker wakes up right away
+and open tabs get the changes as inbox_delta events. Use it to try push
+without a Pub/Sub topic, or as a cron-style nudge.
+
+Usage:
+  python send_gmail_push.py you@gmail.com
+  python send_gmail_push.py you@gmail.com --history-id 123456 --url http://localhost:5000 --token secret
+"""
+
+import argparse
+import base64
+import json
+import time
+
+import requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send a fake Gmail Pub/Sub push to ARIA")
+    parser.add_argument("email", help="Gmail address of a connected account")
+    parser.add_argument("--history-id", help="historyId to announce (default: always sync)")
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--token", default="", help="GMAIL_PUSH_TOKEN, if the server has one")
+    args = parser.parse_args()
+
+    payload = {"emailAddress": args.email}
+    if args.history_id:
+        payload["historyId"] = args.history_id
+    envelope = {
+        "message": {
+            "data": base64.b64encode(json.dumps(payload).encode()).decode(),
+            "messageId": str(int(time.time() * 1000)),
+        },
+        "subscription": "projects/local/subscriptions/aria-gmail-push",
+    }
+    resp = requests.post(f"{args.url}/api/gmail/push", params={"token": args.token} if args.token else None,
+                         json=envelope, timeout=10)
+    print(f"{resp.status_code} {resp.text.strip()}")
+
+
+if __name__ == "__main__":
+    main()
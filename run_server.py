@@ -6,5 +6,22 @@ website_dir = os.path.join(script_dir, "ARIA website")
 sys.path.insert(0, website_dir)
 os.chdir(website_dir)
 
+# --async: production mode on gevent (greenlets instead of one OS thread per
+# in-flight request). Monkey-patching has to happen before anything imports
+# socket/ssl/requests, i.e. before the app.
+ASYNC = "--async" in sys.argv or os.environ.get("ARIA_ASYNC_MODE") == "gevent"
+
+if ASYNC:
+    try:
+        from gevent import monkey
+    except ImportError:
+        sys.exit("--async needs gevent: pip install gevent gevent-websocket")
+    monkey.patch_all()
+    os.environ["ARIA_ASYNC_MODE"] = "gevent"
+
 from app import app, socketio
-socketio.run(app, host="0.0.0.0", port=5000, debug=True, use_reloader=False, allow_unsafe_werkzeug=True)
+
+if ASYNC:
+    socketio.run(app, host="0.0.0.0", port=5000)
+else:
+    socketio.run(app, host="0.0.0.0", port=5000, debug=True, use_reloader=False, allow_unsafe_werkzeug=True)